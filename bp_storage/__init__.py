@@ -2,3 +2,13 @@ from . import utils
 from . import beard
 from . import kitti
 from . import classification
+from . import convert
+from . import index
+from . import curriculum
+from . import dedup
+from . import stats
+from . import memory
+from . import bucket
+from . import archive
+from . import validate
+from . import shard
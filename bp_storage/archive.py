@@ -0,0 +1,245 @@
+'''Streaming loaders for datasets inside tar and zip archives.
+
+The archive is read in a single sequential pass (no extraction to disk). Image and label members of beard and
+kitti datasets are paired by their basename inside a bounded lookahead window, so the archive does not have to
+store the image directly next to its label. The folder layout inside the archive is the same as on disk.
+
+author: Felix Geilert
+'''
+
+import os, io, json
+import tarfile, zipfile
+import collections
+from . import utils
+from . import beard
+from . import kitti
+from . import classification
+
+
+#--------------------------------------------------------------------------------------------------
+# ARCHIVE ACCESS
+
+def _members(path):
+    '''Iterates the files of the archive in storage order.
+
+    Returns:
+        gen (Generator): Generator of `(name, data)` tuples (`data` as bytes)
+    '''
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield info.filename, zf.read(info)
+    elif tarfile.is_tarfile(path):
+        # note: stream mode, so compressed archives are never seeked
+        with tarfile.open(path, 'r|*') as tf:
+            for member in tf:
+                if member.isfile():
+                    yield member.name, tf.extractfile(member).read()
+    else:
+        raise IOError("File ({}) is no tar or zip archive!".format(path))
+
+def _compressed(path):
+    '''Checks if the archive is a compressed tar archive (gzip, bzip2 or xz).'''
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    return head[:2] == b'\x1f\x8b' or head[:3] == b'BZh' or head == b'\xfd7zXZ\x00'
+
+def _names(path):
+    '''Lists the names of all files in the archive.
+
+    Note: Reads only the directory of zip archives and the headers of uncompressed tar archives (the data is
+    skipped), compressed tar archives have to be decompressed completely.
+    '''
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            return [x.filename for x in zf.infolist() if not x.is_dir()]
+    with tarfile.open(path, 'r:*') as tf:
+        return [x.name for x in tf.getmembers() if x.isfile()]
+
+def _btype(parts, folders):
+    '''Finds the datatype folder in the path parts (searched from the back).
+
+    Returns:
+        id (int): Index of the datatype folder in the parts (-1 if not found)
+        btype (DataType): The regarding datatype
+    '''
+    for i in range(len(parts) - 2, -1, -1):
+        for btype, names in folders.items():
+            if parts[i] in names:
+                return i, btype
+    return -1, None
+
+def _member_info(name, fmt, folders):
+    '''Retrieves the role of the member in the dataset.
+
+    Returns:
+        role (str): One of `image`, `label` or None (if the member is not relevant)
+        key (tuple): Key to pair image and label (for classification the class name)
+        btype (DataType): Datatype of the member
+    '''
+    parts = name.replace('\\', '/').strip('/').split('/')
+    base, ext = os.path.splitext(parts[-1])
+    ext = ext.lower()
+    id, btype = _btype(parts, folders)
+    if btype is None:
+        return None, None, None
+
+    # classification: btype/class/image
+    if fmt == "classification":
+        if id == len(parts) - 3 and ext in utils.IMG_EXTS:
+            return "image", parts[-2].upper(), btype
+        return None, None, None
+
+    # beard & kitti: btype/images/image and btype/labels/label
+    if len(parts) < 2:
+        return None, None, None
+    key = ('/'.join(parts[:-2]), base)
+    if parts[-2] in utils.IMG_FOLDERS and ext in utils.IMG_EXTS:
+        return "image", key, btype
+    if parts[-2] in utils.LBL_FOLDERS and ext == '.txt':
+        return "label", key, btype
+    return None, None, None
+
+def read_config(path, json_name=".json"):
+    '''Reads the beard config from the archive (the first json member that ends with `json_name`).
+
+    Note: For tar archives the config should be the first member (otherwise all preceding members are read).
+    '''
+    for name, data in _members(path):
+        base = os.path.basename(name)
+        if base.endswith(json_name) and not base.startswith('.'):
+            return json.loads(data.decode('utf-8'))
+    raise IOError("Cannot find the config file ({}) in {}!".format(json_name, path))
+
+def pairs(path, fmt="beard", only=None, window=1024, debug=False):
+    '''Pairs the image and label members of the archive in a single pass.
+
+    Args:
+        path (str): Path of the tar or zip archive
+        fmt (str): Format of the dataset (`beard`, `kitti` or `classification`)
+        only (list): List of `DataType` to limit the loading
+        window (int): Maximal number of members that wait for their partner (oldest are dropped)
+
+    Returns:
+        gen (Generator): Generator of `(name, img_data, label, btype)`, where `label` are the bytes of the label
+            file (or the class name for classification data)
+    '''
+    folders = utils.only_folders(only)
+    pending = collections.OrderedDict()
+    dropped = 0
+    for name, data in _members(path):
+        role, key, btype = _member_info(name, fmt, folders)
+        if role is None:
+            continue
+        # classification images are complete on their own
+        if fmt == "classification":
+            yield name, data, key, btype
+            continue
+
+        # pair with the waiting partner
+        entry = pending.pop(key, None)
+        if entry is not None and role not in entry:
+            entry[role] = (name, data)
+            yield entry["image"][0], entry["image"][1], entry["label"][1], btype
+            continue
+        pending[key] = {role: (name, data)}
+
+        # safty: bound the lookahead window
+        if len(pending) > window:
+            pending.popitem(last=False)
+            dropped += 1
+
+    # debug output
+    dropped += len(pending)
+    if debug and dropped > 0: print("WARNING: {} members without partner in {} (increase window?)".format(dropped, path))
+
+#--------------------------------------------------------------------------------------------------
+# LOADERS
+
+def load(path, fmt="beard", config=None, classes=None, only=None, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, window=1024, workers=0, json_name=".json", debug=False, shard=None):
+    '''Loads a beard or kitti dataset directly from a tar or zip archive.
+
+    Args:
+        path (str): Path of the archive
+        fmt (str): Format of the dataset (`beard` or `kitti`)
+        config (dict): beard config of the dataset (if None, read from the archive or generated for kitti data)
+        classes (list): List of classes to use (see `beard.load` and `kitti.load`)
+        window (int): Lookahead window for the pairing of images and labels (see `pairs`)
+        workers (int): Number of threads that decode and resize images ahead of the generator
+        shard (Sharding): Decodes only the samples of the rank and worker (round robin in archive order, see `shard.Sharding.stream`)
+
+    Returns:
+        config (dict): Configuration of the dataset
+        gen (Generator): Generator that returns tuples of data: `(img, global, metadata, DataType)` (see `beard.load`)
+    '''
+    # safty: check if the archive exists
+    if not os.path.exists(path):
+        raise IOError("Specified archive ({}) does not exist!".format(path))
+
+    # load the config
+    if config is None:
+        config = kitti.create_config(classes if classes is not None else kitti.DEFAULT_CLASSES) if fmt == "kitti" else read_config(path, json_name)
+    global_config, boxes_config = beard._sort_config(config)
+    cmap = beard._class_map(config, classes) if fmt != "kitti" else None
+
+    # decode the samples (in a thread pool if requested)
+    def _load(sample):
+        _, img_data, lbl_data, btype = sample
+        img, scale, offset = utils.resize(utils.imdecode(img_data), size, resize, pad_color, pad_mode)
+        gdata, mdata = beard._parse_labels(io.StringIO(lbl_data.decode('utf-8')), global_config, boxes_config, scale, offset, cmap, debug)
+        return img, gdata, mdata, btype
+
+    def _gen():
+        samples = pairs(path, fmt, only, window, debug)
+        samples = shard.stream(samples) if shard is not None else samples
+        for img, gdata, mdata, btype in utils.ordered_map(_load, samples, workers):
+            yield beard._gen_single(img, gdata, mdata, btype, show_btype)
+
+    # update the classes of the output config
+    out_config = config
+    if cmap is not None:
+        cls_item = utils.classes.find_item(config["boxes"])
+        out_config = dict(config, boxes=[dict(item, values=cmap.classes) if item is cls_item else item for item in config["boxes"]])
+    return out_config, _gen()
+
+def load_cls(path, classes=None, only=None, size=None, one_hot=True, beard_format=False, show_btype=False, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, workers=0, debug=False, shard=None):
+    '''Loads a classification dataset directly from a tar or zip archive (in archive order, see `classification.load`).
+
+    `shard` selects the samples of the rank and worker (see `load`). If `classes` is None, they are listed from the
+    member names before the pass (not supported for compressed tar archives, which would be decompressed twice).
+
+    Returns:
+        classes (list): List of the classes
+        gen (Generator): Generator with the output of `classification.load`
+    '''
+    # safty: check if the archive exists
+    if not os.path.exists(path):
+        raise IOError("Specified archive ({}) does not exist!".format(path))
+
+    # find the classes from the member names
+    folders = utils.only_folders(only)
+    if classes is None:
+        # safty: listing the members of a compressed tar would decompress the archive twice
+        if not zipfile.is_zipfile(path) and _compressed(path):
+            raise ValueError("Compressed tar archives ({}) require the `classes` to be specified".format(path))
+        classes = []
+        for name in _names(path):
+            role, cls_name, _ = _member_info(name, "classification", folders)
+            if role is not None and cls_name not in classes:
+                classes.append(cls_name)
+    cmap = utils.classes.ClassMap([x.upper() for x in classes])
+
+    # decode the samples (in a thread pool if requested)
+    def _load(sample):
+        _, img_data, cls_name, btype = sample
+        img, _, _ = utils.resize(utils.imdecode(img_data), size, resize, pad_color, pad_mode)
+        return img, cls_name, btype
+
+    def _gen():
+        samples = (x for x in pairs(path, "classification", only, debug=debug) if x[2] in cmap)
+        samples = shard.stream(samples) if shard is not None else samples
+        for img, cls_name, btype in utils.ordered_map(_load, samples, workers):
+            yield classification._gen_single(img, cmap.name(cmap.index(cls_name)), cmap, btype, one_hot, beard_format, show_btype)
+
+    return classes, _gen()
@@ -5,12 +5,17 @@ author: Felix Geilert
 
 
 import numpy as np
-import os, glob, math
-import shutil
+import os, glob, math, time
+import shutil, hashlib
 import json, csv
 from . import utils
+from . import memory
 
 
+# note: hidden files, so the default config search (`*.json`) does not find them
+EXCLUDE_FILE = '.exclude.json'
+EXPORT_INDEX = '.export_index.json'
+
 #--------------------------------------------------------------------------------------------------
 # PUBLIC HELPER FUNCTIONS
 
@@ -37,23 +42,22 @@ def _load_value(row, item, debug):
         raise ValueError("Could not extract element ({}) from ({}) as it is empty".format(item["name"], row))
     # load the value
     if item["type"] == "enum":
-        # get the values as upper case for checking
+        # retrieve the (cached) lookup table of the values
         value = row[0]
-        value_list = [it.upper() for it in item["values"]]
+        cmap = utils.classes.from_item(item)
         oval = value
         row = row[1:]
 
         # check dtype
         if item["dtype"] == "str":
-            value = value.upper()
-            value = value_list.index(value) if value in value_list else -1
+            value = cmap.index(value)
         else:
             value = int(value)
 
         # generate output
-        if value == -1 or (type(value) == int and value > len(value_list)):
+        if value < 0 or value >= len(cmap):
             if debug: print("WARNING: the loaded class value ({}) is out of range ({}) or not in class list ({})".format(oval, len(item["values"]), item["values"]))
-            value = -1 if item["dtype"] == "int" else "UNKOWN"
+            value = -1 if item["dtype"] == "int" else utils.classes.UNKOWN
         else:
             # note: use default item here to restore cases
             value = value if item["dtype"] == "int" else item["values"][value]
@@ -81,32 +85,33 @@ def _write_value(item, out, item_config, pos, debug):
     if item_config is None:
         print("ERROR: The current element has no configuration!")
         return out
+    # skip optional elements that are not set
+    if item is None and "optional" in item_config and item_config["optional"]:
+        return out
 
     # load the data
     value = None
     if item_config["type"] == "enum":
         # retrieve values
         value = item
-        value_list = [it.upper() for it in item_config["values"]]
+        cmap = utils.classes.from_item(item_config)
         oval = value
 
         # convert to int as base type
         if item_config["dtype"] == "str":
-            value = value.upper()
-            if value in value_list: value = value_list.index(value)
-            else:
+            value = cmap.index(value)
+            if value < 0:
                 if debug: print("WARNING: the specificed class value ({}) is out of range ({}) or not in class list ({})".format(oval, len(item_config["values"]), item_config["values"]))
-                value = -1
         else:
             value = int(value)
 
         # convert back if required
         if item_config["dtype"] == "str":
-            value = "UNKOWN" if value == -1 else item_config["values"][value]
+            value = utils.classes.UNKOWN if value == -1 else item_config["values"][value]
     elif item_config["type"] == "array":
         value = []
         for i in range(item_config["length"]):
-            value.append(utils.set_dtype(item[i], item_config["dtype"]))
+            value.append(str(utils.set_dtype(item[i], item_config["dtype"])))
         value = ' '.join(value)
     elif item_config["type"] == "box-array":
         value = []
@@ -131,17 +136,36 @@ def _gen_single(img, gdata, mdata, btype, show_btype=False):
 #--------------------------------------------------------------------------------------------------
 # BEARD LOADING
 
-def _gen_beard(folder, config, only=None, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, classes=None, debug=False):
-    # convert the global and boxes config to the right order
+def _sort_config(config):
+    '''Sorts the global and boxes config according to the position of the elements.'''
     global_config = config["global"]
     global_config.sort(key=lambda x: x["pos"] if "pos" in x else 0)
     boxes_config = config["boxes"]
     boxes_config.sort(key=lambda x: x["pos"] if "pos" in x else 0)
+    return global_config, boxes_config
 
+def _read_exclude(folder):
+    '''Reads the set of excluded image paths (see `validate`) of the dataset (empty if there is no exclusion list).'''
+    sidecar = utils.read_sidecar(os.path.join(folder, EXCLUDE_FILE))
+    if sidecar is None:
+        return set()
+    return set([os.path.normpath(os.path.join(folder, x)) for x in sidecar["files"]])
+
+def _list_beard(folder, only=None, debug=False, exclude=True):
+    '''Lists all samples of the dataset without loading them.
+
+    Args:
+        exclude (bool): Skips the images in the exclusion list of the dataset (see `validate`)
+
+    Returns:
+        files (list): List of tuples `(img_path, lbl_path, btype)` in loading order
+    '''
     # generate data
     folders = utils.only_folders(only)
+    excluded = _read_exclude(folder) if exclude else set()
 
     # iterate through folders
+    files = []
     for btype in folders:
         found = False
         for dir in folders[btype]:
@@ -158,77 +182,275 @@ def _gen_beard(folder, config, only=None, size=None, show_btype=True, resize=uti
 
             # iterate through all data
             for img_path in imgs:
+                if len(excluded) > 0 and os.path.normpath(img_path) in excluded:
+                    continue
                 # get the basename of the image
                 lbl_path = os.path.splitext(os.path.basename(img_path))[0]
                 lbl_path = os.path.join(lbl_dir, lbl_path + '.txt')
-
-                # load the image (and convert it to RGB)
-                img = utils.imread(img_path)
-                gdata = {}
-                mdata = []
-
-                # resize the image
-                img, scale, offset = utils.resize(img, size, resize, pad_color, pad_mode)
-
-                # load the regarding labels
-                with open(lbl_path, 'r') as csvfile:
-                    lbl_reader = csv.reader(csvfile, delimiter=' ')
-
-                    # load global data (if there is any)
-                    if len(global_config) > 0:
-                        row = next(lbl_reader)
-                        for item in global_config:
-                            # load the value
-                            value, row = _load_value(row, item, debug)
-                            # store the element
-                            gdata[item["name"]] = value
-
-                    # load metadata
-                    for row in lbl_reader:
-                        meta = {}
-                        for item in boxes_config:
-                            # load the value
-                            value, row = _load_value(row, item, debug)
-
-                            # check for transformation
-                            if item["type"] == "box-array":
-                                is_rel = (item["bb_type"].lower() == "relative")
-                                # switch, as they are always stored in y-x format
-                                bb_scale = (scale[1], scale[0])    if item["order"] == "x-y" else scale
-                                bb_offset = (offset[1], offset[0]) if item["order"] == "x-y" else offset
-                                if is_rel:
-                                    value = [(value[0] * bb_scale[0]) + bb_offset[0],
-                                             (value[1] * bb_scale[1]) + bb_offset[1],
-                                             value[2] * bb_scale[0],
-                                             value[3] * bb_scale[1]]
-                                else:
-                                    value = [(value[0] * bb_scale[0]) + bb_offset[0],
-                                             (value[1] * bb_scale[1]) + bb_offset[1],
-                                             (value[2] * bb_scale[0]) + bb_offset[0],
-                                             (value[3] * bb_scale[1]) + bb_offset[1]]
-                                value = np.array(value).astype(int)
-
-                            # update classes according to limitations (IF: classes and config do not match, i.e. separate classes arg provided)
-                            if item["name"] == "class" and classes is not None:
-                                if value not in classes:
-                                    value = classes[0]
-
-                            # store the element
-                            meta[item["name"]] = value
-                        mdata.append(meta)
-
-                # return the loaded elements
-                yield _gen_single(img, gdata, mdata, btype, show_btype)
+                files.append((img_path, lbl_path, btype))
 
         # debug output
         if not found:
             if debug: print("Could not find folder for type: {}".format(btype.name))
 
+    return files
+
+def _load_class(row, item, cmap, debug):
+    '''Loads the class item from the row and maps it to the output classes of the `ClassMap`.'''
+    # safty: let the default loader handle optional and missing values
+    if len(row) == 0:
+        return _load_value(row, item, debug)
+
+    # map the value
+    if item["dtype"] == "str":
+        value = cmap.index(row[0])
+    else:
+        value = cmap.from_id(int(row[0]), item["values"])
+    if value < 0 and debug:
+        print("WARNING: the loaded class value ({}) is not in class list ({})".format(row[0], cmap.classes))
+    return (value if item["dtype"] == "int" else cmap.name(value)), row[1:]
+
+def _class_map(config, classes=None, remap=None):
+    '''Creates the `ClassMap` for the class item of the config (None if the classes are not changed).
+
+    Unkown classes are moved to the first class if a list of classes is given (i.e. dontcare).
+    '''
+    if isinstance(classes, utils.classes.ClassMap):
+        return classes
+    item = utils.classes.find_item(config["boxes"])
+    if item is None or (classes is None and remap is None):
+        return None
+    return utils.classes.create(classes, remap, item["values"], classes[0] if classes is not None else None)
+
+def _load_labels(lbl_path, global_config, boxes_config, scale=(1.0, 1.0), offset=(0, 0), classes=None, debug=False):
+    '''Loads the global and box data from a single label file and transforms the boxes according to scale and offset.
+
+    Args:
+        classes (ClassMap): Map for the class item (see `_class_map`), None to load the classes as defined in the config
+    '''
+    with open(lbl_path, 'r') as csvfile:
+        return _parse_labels(csvfile, global_config, boxes_config, scale, offset, classes, debug)
+
+def _parse_labels(lines, global_config, boxes_config, scale=(1.0, 1.0), offset=(0, 0), classes=None, debug=False):
+    '''Parses the lines of a label file (see `_load_labels`).'''
+    gdata = {}
+    mdata = []
+    cls_item = utils.classes.find_item(boxes_config) if classes is not None else None
+
+    # load the regarding labels
+    lbl_reader = csv.reader(lines, delimiter=' ')
+
+    # load global data (if there is any)
+    if len(global_config) > 0:
+        row = next(lbl_reader)
+        for item in global_config:
+            # load the value
+            value, row = _load_value(row, item, debug)
+            # store the element
+            gdata[item["name"]] = value
+
+    # load metadata
+    for row in lbl_reader:
+        meta = {}
+        for item in boxes_config:
+            # load the value (map classes if a separate classes arg is provided)
+            if item is cls_item:
+                value, row = _load_class(row, item, classes, debug)
+            else:
+                value, row = _load_value(row, item, debug)
+
+            # store the element
+            meta[item["name"]] = value
+        mdata.append(meta)
+
+    # transform all boxes of the file at once
+    for item in boxes_config:
+        if item["type"] != "box-array":
+            continue
+        metas = [meta for meta in mdata if meta[item["name"]] is not None]
+        if len(metas) == 0:
+            continue
+        bbs = utils.boxes.transform([meta[item["name"]] for meta in metas], scale, offset, item).astype(int)
+        for meta, bb in zip(metas, bbs):
+            meta[item["name"]] = bb
+
+    return gdata, mdata
+
+def _load_global(lbl_path, global_config, debug=False):
+    '''Loads only the global data (first line) of a label file.'''
+    gdata = {}
+    if len(global_config) == 0:
+        return gdata
+
+    with open(lbl_path, 'r') as csvfile:
+        row = next(csv.reader(csvfile, delimiter=' '), [])
+    for item in global_config:
+        # load the value
+        value, row = _load_value(row, item, debug)
+        gdata[item["name"]] = value
+    return gdata
+
+def _load_sample(img_path, lbl_path, global_config, boxes_config, size=None, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, classes=None, debug=False, stats=None, rng=None, channels=3):
+    '''Loads a single image with its labels (`stats` provides the cached mean color for `PAD_MEAN`, see `stats.compute`, `rng` the noise of `PAD_RANDOM`).'''
+    # load the image (and convert it to RGB)
+    img = utils.imread(img_path, channels)
+
+    # resize the image
+    mean = stats.image_mean(img_path) if stats is not None else None
+    img, scale, offset = utils.resize(img, size, resize, pad_color, pad_mode, mean, rng)
+
+    # load the regarding labels
+    gdata, mdata = _load_labels(lbl_path, global_config, boxes_config, scale, offset, classes, debug)
+    return img, gdata, mdata
+
+def _lazy_sample(img_path, lbl_path, global_config, boxes_config, size=None, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, classes=None, debug=False, stats=None, rng=None, channels=3):
+    '''Loads the labels of a single sample and defers the decoding of the image (see `utils.LazySample`).
+
+    The boxes are transformed with the scale and offset computed from the size in the image header. If the decoded
+    size differs, the labels are parsed again with the decoded size (updates `gdata` and `mdata` in place).
+
+    Returns:
+        load (fct): Function that decodes and resizes the image
+        gdata (dict): Global data of the image
+        mdata (list): Metadata of the image
+    '''
+    shape = utils.imsize(img_path)
+    scale, offset = utils.resize_params(shape, size, resize, pad_mode)
+    gdata, mdata = _load_labels(lbl_path, global_config, boxes_config, scale, offset, classes, debug)
+
+    def _load():
+        img = utils.imread(img_path, channels)
+        # safty: the labels are based on the size in the header, parse them again if the decoded size differs
+        if img.shape[:2] != tuple(shape[:2]):
+            img_scale, img_offset = utils.resize_params(img.shape, size, resize, pad_mode)
+            img_gdata, img_mdata = _load_labels(lbl_path, global_config, boxes_config, img_scale, img_offset, classes, debug)
+            gdata.clear()
+            gdata.update(img_gdata)
+            mdata[:] = img_mdata
+        mean = stats.image_mean(img_path) if stats is not None else None
+        return utils.resize(img, size, resize, pad_color, pad_mode, mean, rng)[0]
+    return _load, gdata, mdata
+
+def _gen_files(files, config, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, classes=None, debug=False, workers=0, stats=None, rng=None, channels=3, lazy=False):
+    '''Generates the beard output for the given list of `(img_path, lbl_path, btype)` tuples (`utils.LazySample` objects if `lazy` is set).'''
+    # convert the global and boxes config to the right order
+    global_config, boxes_config = _sort_config(config)
+    classes = _class_map(config, classes)
+    # note: independent generator per sample, so the noise does not depend on the thread scheduling
+    sample_rng = utils.streams(rng) if resize == utils.ResizeMode.PAD_RANDOM else lambda id: None
+
+    # only parse the labels for lazy samples (the image is decoded on access)
+    if lazy:
+        def _load_lazy(item):
+            id, (img_path, lbl_path, btype) = item
+            load, gdata, mdata = _lazy_sample(img_path, lbl_path, global_config, boxes_config, size, resize, pad_color, pad_mode, classes, debug, stats, sample_rng(id), channels)
+            return utils.LazySample(load, gdata, mdata, btype, img_path, show_btype, lbl_path)
+        for sample in utils.ordered_map(_load_lazy, enumerate(files), workers):
+            yield sample
+        return
+
+    # load the data (in a thread pool if requested)
+    def _load(item):
+        id, (img_path, lbl_path, btype) = item
+        return _load_sample(img_path, lbl_path, global_config, boxes_config, size, resize, pad_color, pad_mode, classes, debug, stats, sample_rng(id), channels) + (btype,)
+
+    # iterate through all data
+    for img, gdata, mdata, btype in utils.ordered_map(_load, enumerate(files), workers):
+        # return the loaded elements
+        yield _gen_single(img, gdata, mdata, btype, show_btype)
+
+def _box_item(boxes_config):
+    '''Finds the box item that defines the crops (`bbox` or the first `box-array`).'''
+    items = [item for item in boxes_config if item["type"] == "box-array"]
+    if len(items) == 0:
+        raise ValueError("ROI loading requires a box-array item in the config!")
+    return next((item for item in items if item["name"] == utils.const.ITEM_BBOX), items[0])
+
+def _load_rois(img_path, lbl_path, global_config, boxes_config, roi, margin=0.0, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), classes=None, debug=False, stats=None, rng=None, channels=3):
+    '''Loads the crops of all boxes of a single image (see `_gen_rois`, `stats` and `rng` are used for `PAD_MEAN` and `PAD_RANDOM`).
+
+    Returns:
+        crops (np.ndarray): `(N, HEIGHT, WIDTH, C)` array of the crops
+        gdata (dict): Global data of the image
+        mdata (list): Metadata of each crop (boxes in crop coordinates)
+    '''
+    gdata, mdata = _load_labels(lbl_path, global_config, boxes_config, classes=classes, debug=debug)
+    item = _box_item(boxes_config)
+    mdata = [meta for meta in mdata if meta.get(item["name"], None) is not None]
+    bbs = utils.boxes.from_item([meta[item["name"]] for meta in mdata], item)
+    valid = utils.boxes.filter_size(bbs, min_size=1)
+    mdata = [meta for meta, ok in zip(mdata, valid) if ok]
+    if len(mdata) == 0:
+        return None, gdata, mdata
+
+    # fill the regions outside of the image like the padding of `utils.resize`
+    img = utils.imread(img_path, channels)
+    mode, color = "constant", pad_color
+    if resize == utils.ResizeMode.PAD_EDGE:
+        mode = "edge"
+    elif resize == utils.ResizeMode.PAD_RANDOM:
+        mode = "random"
+    elif resize == utils.ResizeMode.PAD_MEAN:
+        color = stats.image_mean(img_path) if stats is not None else np.mean(img.reshape(img.shape[0], img.shape[1], -1), (0, 1), dtype=np.float64)
+        color = np.round(np.asarray(color, dtype=np.float64).reshape(-1))
+
+    # crop all boxes in a single step from the decoded frame
+    crops, windows = utils.crop_boxes(img, bbs[valid], roi, margin, mode, color, rng)
+
+    # move the boxes into the coordinates of the crops
+    scale = np.array(crops.shape[1:3], dtype=np.float64) / (windows[:, 2:] - windows[:, :2])
+    local = (bbs[valid] - np.tile(windows[:, :2], 2)) * np.tile(scale, 2)
+    mdata = [dict(meta, **{item["name"]: (np.round(bb).astype(int) if item["dtype"] == "int" else bb)}) for meta, bb in zip(mdata, utils.boxes.to_item(local, item))]
+    return crops, gdata, mdata
+
+def _gen_rois(files, config, roi, margin=0.0, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), classes=None, debug=False, workers=0, stats=None, rng=None, channels=3):
+    '''Generates a beard sample for each box of the given `(img_path, lbl_path, btype)` tuples.
+
+    The crops of an image are gathered and resized in a single vectorized step from the decoded frame (no
+    resize of the full frame). Each sample contains the crop and the box in the coordinates of the crop.
+    '''
+    global_config, boxes_config = _sort_config(config)
+    classes = _class_map(config, classes)
+    sample_rng = utils.streams(rng) if resize == utils.ResizeMode.PAD_RANDOM else lambda id: None
+
+    # load the crops (in a thread pool if requested)
+    def _load(item):
+        id, (img_path, lbl_path, btype) = item
+        return _load_rois(img_path, lbl_path, global_config, boxes_config, roi, margin, resize, pad_color, classes, debug, stats, sample_rng(id), channels) + (btype,)
+
+    for crops, gdata, mdata, btype in utils.ordered_map(_load, enumerate(files), workers):
+        for crop, meta in zip(crops if crops is not None else [], mdata):
+            yield _gen_single(crop, gdata, [meta], btype, show_btype)
+
+def _gen_beard(folder, config, only=None, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, classes=None, debug=False, workers=0, stats=None, rng=None, roi=None, roi_margin=0.0, shard=None, channels=3, lazy=False):
+    files = _list_beard(folder, only, debug)
+    if shard is not None:
+        files = shard.select(files)
+    if roi is not None:
+        gen = _gen_rois(files, config, roi, roi_margin, show_btype, resize, pad_color, classes, debug, workers, stats, rng, channels)
+    else:
+        gen = _gen_files(files, config, size, show_btype, resize, pad_color, pad_mode, classes, debug, workers, stats, rng, channels, lazy)
+    for sample in gen:
+        yield sample
+
     # debug output
     if debug: print("Loaded entire dataset")
 
+def _read_config(folder, json_name="*.json"):
+    '''Loads the config file of the dataset.'''
+    # find the config file
+    config_file = glob.glob(os.path.join(folder, json_name), recursive=False)
+    if len(config_file) == 0:
+        raise IOError("Cannot find the config file ({})!".format(json_name))
+
+    # load the config file
+    config = {}
+    with open(config_file[0]) as f:
+        config = json.load(f)
+    return config
+
 # data loading
-def load(folder, json_name="*.json", only=None, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, classes=None, debug=False):
+def load(folder, json_name="*.json", only=None, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, classes=None, debug=False, workers=0, remap=None, stats=None, in_memory=False, rng=None, roi=None, roi_margin=0.0, shard=None, channels=3, lazy=False):
     '''Creates a generator for the beard dataset.
 
     Args:
@@ -239,48 +461,284 @@ def load(folder, json_name="*.json", only=None, size=None, show_btype=True, resi
         pad (bool): If image is resized, use pad to change data
         classes (list): List of classes to use (if specificed in the model - other elements will be moved to dontcare) [if none use all classes]
         debug (bool): Gives debug output
+        workers (int): Number of threads that decode and resize images ahead of the generator (0 = load in the generator)
+        remap (dict): Merges source classes into output classes, e.g. `"Van,Truck->Car"` (see `utils.classes.parse_remap`)
+        stats (ImageStats): Cached image statistics (see `stats.compute`), used for the mean color of `PAD_MEAN`
+        in_memory (bool): Loads the entire dataset once into contiguous arrays (see `memory`). If a folder is given,
+            the arrays are stored there and memory mapped on the next call.
+        rng (RNG): Generator of the noise for `PAD_RANDOM` (default generator if None, see `utils.get_rng`)
+        roi (int): Size of the crops (single int or tuple) to load a sample per box instead of the full image.
+            The crops are taken from the decoded frame (`size` has to be None) and the metadata contains the box
+            in the coordinates of the crop. Regions outside of the image are filled like the padding of `resize` (edge for
+            `PAD_EDGE`, mean color for `PAD_MEAN`, noise for `PAD_RANDOM`, `pad_color` otherwise), `pad_mode` has to be `EDGE`.
+        roi_margin (float): Context around the boxes for `roi` as fraction of the box size per side
+        shard (Sharding): Loads only the files of the rank and worker (see `shard.Sharding`), selected when the
+            generator starts (so `set_epoch` can be called between the passes)
+        channels (int): Number of image channels (1 - gray, 3 - RGB, 4 - RGBA or extra channel, None - as stored), always uint8
+        lazy (bool): Yields `utils.LazySample` objects with the parsed labels, the image is only decoded and resized
+            on the first access of `img` (so filtered samples are never decoded). Ignored for `in_memory`. The boxes
+            are scaled with the size of the image header and parsed again on the access of `img` if the decoded size differs.
 
     Returns:
         config (dict): Configuration loaded for the generator/dataset
         gen (Generator): Generator that returns tuples of data: `(img, global, metadata, DataType)`.
             Whereby `global` and `metadata` are dicts (metadata is an array of dicts) that contain the names of the
-            elements in the config json.
+            elements in the config json. (`MemoryView` that can be iterated multiple times if `in_memory` is set)
     '''
     # safty: check if the folder exists
     if not os.path.exists(folder):
         raise IOError("Specified folder ({}) does not exist!".format(folder))
 
-    # find the config file
-    config_file = glob.glob(os.path.join(folder, json_name), recursive=False)
-    if len(config_file) == 0:
-        raise IOError("Cannot find the config file ({})!".format(json_name))
+    if roi is not None and size is not None:
+        raise ValueError("ROI crops are taken from the original image, size has to be None (got {})".format(size))
+    if roi is not None and lazy:
+        raise ValueError("Lazy loading is not supported for ROI crops!")
+    if roi is not None and pad_mode != utils.PadMode.EDGE:
+        raise ValueError("ROI crops are not placed on a padded canvas, pad_mode has to be EDGE (got {})".format(pad_mode))
 
     # load the config file
-    config = {}
-    with open(config_file[0]) as f:
-        config = json.load(f)
+    config = _read_config(folder, json_name)
 
-    # check the classes in the config file
+    # build the lookup tables of the classes (labels are parsed with the original config)
     out_config = config
-    if classes is not None:
-        for item in out_config["boxes"]:
-            if item["name"] == "class":
-                item["values"] = classes
-                break
+    cmap = _class_map(config, classes, remap)
+    if cmap is not None:
+        cls_item = utils.classes.find_item(config["boxes"])
+        out_config = dict(config, boxes=[dict(item, values=cmap.classes) if item is cls_item else item for item in config["boxes"]])
+
+    # materialize the dataset into contiguous arrays
+    if in_memory:
+        key = memory.loader_key(folder, only=only, size=size, resize=resize, pad_color=pad_color, pad_mode=pad_mode, classes=classes, remap=remap, stats=stats is not None, roi=roi, roi_margin=roi_margin, shard=shard.key() if shard is not None else None, channels=channels)
+        gen = _gen_beard(folder, config, only, size, True, resize, pad_color, pad_mode, cmap, debug, workers, stats, rng, roi, roi_margin, shard, channels)
+        data = memory.materialize(gen, out_config, in_memory, key, debug)
+        return out_config, data.view(None if show_btype else lambda x: x[:3])
 
     # create the generator and return data
-    return out_config, _gen_beard(folder, config, only, size, show_btype, resize, pad_color, pad_mode, classes, debug)
+    return out_config, _gen_beard(folder, config, only, size, show_btype, resize, pad_color, pad_mode, cmap, debug, workers, stats, rng, roi, roi_margin, shard, channels, lazy)
+
+def _sample_imgs(folder, config, cmap=None, only=None, size=None, count=10, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, workers=4, rng=None, channels=3, candidates=32):
+    '''Selects and loads random sample images stratified by the most frequent class of their boxes (see `load_sample_imgs`).'''
+    global_config, boxes_config = _sort_config(config)
+    cls_item = utils.classes.find_item(boxes_config)
+    rng = utils.get_rng(rng)
+
+    # read the labels of a random candidate set (instead of the entire dataset)
+    files = _list_beard(folder, only)
+    if candidates is not None and len(files) > count * candidates:
+        files = [files[id] for id in np.sort(rng.choice(len(files), count * candidates, replace=False))]
+    strata = []
+    for _, lbl_path, _ in files:
+        names = [meta[cls_item["name"]] for meta in _load_labels(lbl_path, global_config, boxes_config, classes=cmap)[1]] if cls_item is not None else []
+        strata.append(max(sorted(set(names), key=str), key=names.count) if len(names) > 0 else None)
+
+    # decode only the selected images and move the boxes into their coordinates
+    files = [files[id] for id in utils.stratified_sample(strata, count, rng)]
+    imgs, scales, offsets = utils.imread_into([x[0] for x in files], size, resize, pad_color, pad_mode, channels, workers, rng)
+    labels = [_load_labels(x[1], global_config, boxes_config, scale, offset, cmap) for x, scale, offset in zip(files, scales, offsets)]
+    return imgs, labels
+
+def load_sample_imgs(folder, only=None, size=None, count=10, classes=None, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, json_name="*.json", workers=4, rng=None, channels=3, candidates=32):
+    '''Loads `count` random sample images (e.g. for preview grids), stratified by the most frequent class of their boxes.
+
+    Only the labels of a random candidate set are read and only the selected images are decoded (in parallel,
+    directly into the output array, see `utils.imread_into`). Same api as `classification.load_sample_imgs`.
+
+    Args:
+        classes (list): List of classes to use (see `load`)
+        workers (int): Number of decoding threads
+        rng (RNG): Generator of the selection (default generator if None, see `utils.get_rng`)
+        candidates (int): Number of label files read per requested image (None to read all label files)
+
+    Returns:
+        imgs (np.ndarray): `(N, HEIGHT, WIDTH, C)` uint8 array (all images need the same size, e.g. `size` with a padding resize mode)
+        labels (list): Tuples of `(gdata, mdata)` for each image (boxes in the coordinates of the resized image)
+    '''
+    # safty: check if the folder exists
+    if not os.path.exists(folder):
+        raise IOError("Specified folder ({}) does not exist!".format(folder))
+    config = _read_config(folder, json_name)
+    return _sample_imgs(folder, config, _class_map(config, classes), only, size, count, resize, pad_color, pad_mode, workers, rng, channels, candidates)
+
+def _split_dir(folder, btype, clean=False):
+    '''Retrieves (and creates if required) the folder for the given datatype.'''
+    if btype == utils.DataType.TRAINING: fldr = os.path.join(folder, 'train')
+    elif btype == utils.DataType.DEVELOPMENT: fldr = os.path.join(folder, 'dev')
+    elif btype == utils.DataType.TESTING: fldr = os.path.join(folder, 'test')
+    else: raise ValueError("Unkown datatype ({})".format(btype))
+
+    # generate the folder structure
+    if os.path.exists(fldr) and clean:
+        shutil.rmtree(fldr)
+    if not os.path.exists(fldr):
+        os.mkdir(fldr)
+    if not os.path.exists(os.path.join(fldr, 'images')):
+        os.mkdir(os.path.join(fldr, 'images'))
+    if not os.path.exists(os.path.join(fldr, 'labels')):
+        os.mkdir(os.path.join(fldr, 'labels'))
+    return fldr
+
+def _label_text(gdata, mdata, config, debug=False):
+    '''Generates the content of the label file for the global and box data of a single sample.'''
+    lines = []
+    # write the global data (only if the config defines a global line)
+    if len(config["global"]) > 0:
+        gstr = []
+        for i, gd in enumerate(gdata):
+            conf = select_config(gd, config["global"])
+            gstr = _write_value(gdata[gd], gstr, conf, i, debug)
+        # convert data
+        lines.append( " ".join( [x[1] for x in sorted(gstr, key=lambda x: x[0])] ) )
+
+    # write the metadata
+    for items in mdata:
+        mstr = []
+        # generate the data
+        for i, item in enumerate(items):
+            conf = select_config(item, config["boxes"])
+            mstr = _write_value(items[item], mstr, conf, i, debug)
+        lines.append( " ".join( [x[1] for x in sorted(mstr, key=lambda x: x[0])] ) )
+    return '\n'.join(lines)
+
+def _write_labels(lbl_path, gdata, mdata, config, debug=False):
+    '''Writes the global and box data of a single sample to the label file.'''
+    with open(lbl_path, 'w+') as f:
+        f.write(_label_text(gdata, mdata, config, debug))
+
+def _write_files(img_path, img, lbl_path, text, encoding=None, report=None):
+    '''Writes the (already BGR) image and the label text of a sample.
+
+    Args:
+        encoding (Encoding): Encoding policy of the image (None for the default of the backend)
+        report (EncodeReport): Collects encode time and bytes of the image
+    '''
+    # safty: remove images of the same sample in other formats (would be loaded twice)
+    if encoding is not None:
+        base = os.path.splitext(img_path)[0]
+        for ext in utils.IMG_EXTS:
+            if base + ext != img_path and os.path.exists(base + ext):
+                os.remove(base + ext)
+
+    start = time.perf_counter()
+    utils.imwrite(img_path, img, encoding)
+    if report is not None:
+        report.add(encoding.name if encoding is not None else "jpg", time.perf_counter() - start, os.path.getsize(img_path))
+    with open(lbl_path, 'w+') as f:
+        f.write(text)
+
+def _sample_job(fldr, name, img, gdata, mdata, config, debug=False, encoding=None):
+    '''Prepares the arguments of `_write_files` for a single sample (copies all data that is referenced).'''
+    ext = encoding.ext if encoding is not None else '.jpg'
+    # note: jpeg can not store an alpha channel
+    if ext == '.jpg' and len(img.shape) > 2 and img.shape[2] == 4:
+        ext = '.png'
+    img_path = os.path.join(fldr, 'images', '{}{}'.format(name, ext))
+    lbl_path = os.path.join(fldr, 'labels', '{}.txt'.format(name))
+    return img_path, utils.to_bgr(img), lbl_path, _label_text(gdata, mdata, config, debug)
+
+def _write_sample(fldr, name, img, gdata, mdata, config, debug=False, encoding=None, report=None):
+    '''Writes image and labels of a single sample into the given split folder.'''
+    _write_files(*_sample_job(fldr, name, img, gdata, mdata, config, debug, encoding), encoding=encoding, report=report)
+
+#--------------------------------------------------------------------------------------------------
+# INCREMENTAL EXPORT
+
+def _source_key(sample):
+    '''Retrieves the source image of a sample and the keys of its source files to detect changes (see `utils.LazySample`).'''
+    path = getattr(sample, 'path', None)
+    if path is None:
+        raise ValueError("Incremental export requires samples with a source path (load the data with `lazy=True`)!")
+    key = [utils.file_key(path)]
+    label = getattr(sample, 'label', None)
+    if label is not None and os.path.exists(label):
+        key.append(utils.file_key(label))
+    return os.path.abspath(path), key
+
+def _read_index(folder, config):
+    '''Reads the source entries of the export index (empty if there is no index or the config changed).
+
+    Returns:
+        sources (dict): Dict of source image to `{key, id, outputs}`
+        outdated (dict): Entries of a previous config (their outputs have to be removed)
+    '''
+    sidecar = utils.read_sidecar(os.path.join(folder, EXPORT_INDEX))
+    if sidecar is None:
+        return {}, {}
+    # note: compare the json representation (tuples are stored as lists)
+    if sidecar["config"] != json.loads(json.dumps(config)):
+        return {}, sidecar["sources"]
+    return sidecar["sources"], {}
+
+def _is_current(entry, key, folder):
+    '''Checks if the outputs of a source entry are up to date.'''
+    return entry is not None and entry["key"] == key and all(os.path.exists(os.path.join(folder, x)) for x in entry["outputs"])
+
+def _remove_outputs(folder, entry):
+    '''Deletes the output files of a source entry.'''
+    for path in entry["outputs"]:
+        path = os.path.join(folder, path)
+        if os.path.exists(path):
+            os.remove(path)
+
+def _content_id(source, ids):
+    '''Derives a stable output id from the content of the source image (extended by a hash of the path for duplicates).'''
+    with open(source, 'rb') as f:
+        id = hashlib.sha1(f.read()).hexdigest()[:16]
+    if ids.get(id, source) != source:
+        id = '{}_{}'.format(id, hashlib.sha1(source.encode('utf-8')).hexdigest()[:8])
+    return id
+
+def changed(gen, config, folder):
+    '''Filters the samples whose source files are unchanged since the last incremental export into `folder` (see `store`).
+
+    Apply it directly to the generator of `load(..., lazy=True)`, so the unchanged samples are neither decoded nor
+    augmented. Removed sources are handled by `store`.
+
+    Args:
+        gen (Generator): Generator of `utils.LazySample` objects
+        config (dict): Config that is passed to `store`
+        folder (str): Output folder of the export
+
+    Returns:
+        gen (Generator): Samples of new or modified sources
+    '''
+    sources, _ = _read_index(folder, config)
+    for sample in gen:
+        source, key = _source_key(sample)
+        if not _is_current(sources.get(source, None), key, folder):
+            yield sample
 
 # data storing
-def store(gen, config, folder, clean=False, debug=False, start_id=0):
+def store(gen, config, folder, clean=False, debug=False, start_id=0, writers=0, queue_size=64, sync_every=256, encoding=None, report=None, incremental=False):
     '''Stores the data from the provided generator to folder.
 
+    If `writers` is set, the images are encoded and written by background threads (write-behind): the generator
+    yields as soon as the sample is queued, only `queue_size` samples are kept in memory and the files are synced
+    to disk in batches of `sync_every` samples. Errors of the writers are raised by the next iteration and all
+    pending samples are written (barrier) before the generator finishes or is closed.
+
     Args:
         gen (Generator): Beard generator that provides the relevant data.
         config (dict): Should contain both `global` and `boxes` data to be stored as config file.
         folder (str): folder to store the dataset into
         clean (bool): Defines clean storage (if true deletes any existing data in `folder`)
         debug (bool): If debug output should be shown
+        writers (int): Number of background writer threads (0 to write synchronous)
+        queue_size (int): Maximal number of samples that wait for the writers
+        sync_every (int): Number of samples between syncs to disk (0 to leave the flushing to the os)
+        encoding: Encoding policy of the images, either a format string (`jpg` or `png`), an `utils.Encoding` or a
+            dict of `DataType` to one of these (e.g. small png dev set and low quality jpg training data)
+        report (dict): Filled with the encode time and bytes per policy (`{name: {images, bytes, seconds}}`)
+            after the generator finished
+        incremental (bool): Only writes the samples of new or modified sources and deletes the outputs of sources
+            that no longer exist (or of all sources if the config changed). Requires samples that know their source
+            files (`load(..., lazy=True)`, see `changed` to also skip the processing). The outputs are named by a
+            content-derived id of the source (`<id>_<n>`, `start_id` is ignored) and the mapping is kept in the
+            `EXPORT_INDEX` file of the folder (the samples of a source have to be consecutive, sources whose outputs
+            were not completely written, e.g. after an interruption, are written again by the next run). Changes of the processing (e.g. augmentation) are not detected,
+            use `clean` in that case.
+
+    Returns:
+        gen (Generator): Generator that returns `(id, btype)` for each written sample (the name for `incremental`)
     '''
     # check to clean the folder
     if clean and os.path.exists(folder):
@@ -290,68 +748,96 @@ def store(gen, config, folder, clean=False, debug=False, start_id=0):
     if not os.path.exists(folder):
         os.mkdir(folder)
 
-    train_dir = os.path.join(folder, 'train')
-    val_dir = os.path.join(folder, 'dev')
-    test_dir = None
-
     # write the configuration
-    with open(os.path.join(folder, 'config.json'.format(id)), 'w') as f:
+    with open(os.path.join(folder, 'config.json'), 'w') as f:
         # store the file
         json.dump(config, f)
 
-    # generate the folder for the training data
-    for fldr_dir in [val_dir, train_dir]:
-        if os.path.exists(fldr_dir) and clean:
-            shutil.rmtree(fldr_dir)
-        if not os.path.exists(fldr_dir):
-            os.mkdir(fldr_dir)
-        if not os.path.exists(os.path.join(fldr_dir, 'images')):
-            os.mkdir(os.path.join(fldr_dir, 'images'))
-        if not os.path.exists(os.path.join(fldr_dir, 'labels')):
-            os.mkdir(os.path.join(fldr_dir, 'labels'))
+    # generate the folder for the training data (test folder is only created on demand)
+    dirs = {}
+    for btype in [utils.DataType.DEVELOPMENT, utils.DataType.TRAINING]:
+        dirs[btype] = _split_dir(folder, btype, clean)
+
+    # remove the outputs of vanished sources (or of a previous config)
+    if incremental:
+        sources, outdated = _read_index(folder, config)
+        outdated.update([(source, sources.pop(source)) for source in list(sources) if not os.path.exists(source)])
+        for entry in outdated.values():
+            _remove_outputs(folder, entry)
+        ids = dict([(entry["id"], source) for source, entry in sources.items()])
+        # note: entries of the sources seen in this run (None if the outputs are up to date), an entry is complete
+        # once the generator moves on to the next source or ends
+        run = {}
+        complete = set()
+        current = None
+        if debug: print("Removed the outputs of {} sources".format(len(outdated)))
 
     # iterate the counter
     counter = start_id
-    for img, gdata, mdata, btype in gen:
-        counter += 1
-        if btype == utils.DataType.TRAINING: fldr = train_dir
-        elif btype == utils.DataType.DEVELOPMENT: fldr = val_dir
-        elif btype == utils.DataType.TESTING:
-            # check folder and create new
-            if test_dir is None:
-                test_dir = os.path.join(folder, 'test')
-                if os.path.exists(test_dir) and clean:
-                    shutil.rmtree(test_dir)
-                if not os.path.exists(test_dir):
-                    os.mkdir(test_dir)
-                if not os.path.exists(os.path.join(test_dir, 'images')):
-                    os.mkdir(os.path.join(test_dir, 'images'))
-                if not os.path.exists(os.path.join(test_dir, 'labels')):
-                    os.mkdir(os.path.join(test_dir, 'labels'))
-            fldr = test_dir
-
-        #cv2.imwrite(os.path.join(fldr, 'images', '{:06d}.jpg'.format(counter)), img)
-        img = img[...,[2,1,0]]
-        utils.imwrite(os.path.join(fldr, 'images', '{:06d}.jpg'.format(counter)), img)
-        #scipy.misc.imsave(os.path.join(fldr, 'images', '{:06d}.jpg'.format(counter)), img)
-        with open(os.path.join(fldr, 'labels', '{:06d}.txt'.format(counter)), 'w+') as f:
-            # write the global data
-            gstr = []
-            for i, gd in enumerate(gdata):
-                conf = select_config(gd, config["global"])
-                gstr = _write_value(gdata[gd], gstr, conf, i, debug)
-            # convert data
-            f.write( " ".join( [x[1] for x in sorted(gstr, key=lambda x: x[0])] ) )
-
-            # write the metadata
-            for items in mdata:
-                f.write('\n')
-                mstr = []
-                # generate the data
-                for i, item in enumerate(items):
-                    conf = select_config(item, config["boxes"])
-                    mstr = _write_value(items[item], mstr, conf, i, debug)
-                f.write( " ".join( [x[1] for x in sorted(mstr, key=lambda x: x[0])] ) )
-
-        # output current data as generator
-        yield counter, btype
+    writer = utils.AsyncWriter(writers, queue_size, sync_every) if writers > 0 else None
+    stats = utils.EncodeReport() if report is not None or debug else None
+    try:
+        for sample in gen:
+            name = None
+            if incremental:
+                # check the source (note: skipped lazy samples are not decoded)
+                source, key = _source_key(sample)
+                if source != current:
+                    if current is not None:
+                        complete.add(current)
+                    complete.discard(source)
+                    current = source
+                if source not in run:
+                    entry = sources.get(source, None)
+                    if _is_current(entry, key, folder):
+                        run[source] = None
+                    else:
+                        if entry is not None:
+                            _remove_outputs(folder, entry)
+                        entry = {"key": key, "id": _content_id(source, ids), "outputs": []}
+                        sources[source] = run[source] = entry
+                        ids[entry["id"]] = source
+                entry = run[source]
+                if entry is None:
+                    continue
+                name = '{}_{:02d}'.format(entry["id"], len(entry["outputs"]) // 2)
+
+            img, gdata, mdata, btype = sample
+            counter += 1
+            name = '{:06d}'.format(counter) if name is None else name
+            if btype not in dirs:
+                dirs[btype] = _split_dir(folder, btype, clean)
+            enc = utils.encoding(encoding, btype) if encoding is not None else None
+
+            job = _sample_job(dirs[btype], name, img, gdata, mdata, config, debug, enc)
+            if writer is None:
+                _write_files(*job, encoding=enc, report=stats)
+            else:
+                writer.submit(_write_files, *job, enc, stats, paths=[job[0], job[2]])
+            if incremental:
+                entry["outputs"] += [os.path.relpath(job[0], folder), os.path.relpath(job[2], folder)]
+
+            # output current data as generator
+            yield (name if incremental else counter), btype
+        if incremental and current is not None:
+            complete.add(current)
+    finally:
+        # note: waits for all pending samples (also if the generator is closed early)
+        try:
+            if writer is not None:
+                writer.close()
+        finally:
+            if incremental:
+                # safty: a failed write can belong to any source of the run
+                if writer is not None and writer.failed:
+                    complete.clear()
+                # drop the sources with partial outputs (interrupted or failed), so the next run writes them again
+                for source, entry in run.items():
+                    if entry is not None and source not in complete:
+                        _remove_outputs(folder, entry)
+                        del sources[source]
+                utils.write_sidecar(os.path.join(folder, EXPORT_INDEX), {"config": config, "sources": sources})
+                if debug: print("Exported {} samples of {} sources ({} sources unchanged)".format(counter - start_id, sum(x is not None for x in run.values()), sum(x is None for x in run.values())))
+        if stats is not None:
+            if report is not None: report.update(stats.policies)
+            if debug: print(stats.summary())
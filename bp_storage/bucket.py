@@ -0,0 +1,158 @@
+'''Aspect ratio bucketing of datasets with mixed resolutions.
+
+Instead of padding all images to a single size, the samples are grouped into a few target shapes with similar
+pixel count but different aspect ratios. The image sizes are read from the image headers, so the buckets are
+created without decoding any image. Each sample is fitted into the shape of its bucket (only the small remainder
+is padded) and the batches are generated per bucket, so every batch has a fixed shape.
+
+author: Felix Geilert
+'''
+
+import numpy as np
+import math
+from . import utils
+from . import convert
+
+
+#--------------------------------------------------------------------------------------------------
+# BUCKETS
+
+def _area(size):
+    '''Computes the pixel budget of the given size (see `utils.resize`).'''
+    if isinstance(size, int):
+        return size * size
+    return size[0] * size[1]
+
+def bucket_shapes(aspects, count=4, size=512, multiple=32):
+    '''Generates the target shapes of the buckets.
+
+    The aspect ratios of the buckets are the quantiles of the (log) aspect ratios in the dataset, each shape has
+    about the pixel count of `size`.
+
+    Args:
+        aspects (np.ndarray): Aspect ratio (`width / height`) of each image
+        count (int): Maximal number of buckets
+        size (int): Either single int of tuple of ints that defines the pixel budget of each bucket
+        multiple (int): Height and width of the buckets are rounded down to a multiple of this value
+
+    Returns:
+        shapes (np.ndarray): `(count, 2)` int array of `(height, width)` sorted by aspect ratio (duplicates are removed)
+    '''
+    logs = np.log(np.asarray(aspects, dtype=np.float64))
+    centers = np.exp(np.quantile(logs, (np.arange(count) + 0.5) / count)) if len(logs) > 0 else np.ones([1])
+    area = _area(size)
+
+    shapes = []
+    for aspect in centers:
+        height = math.sqrt(area / aspect)
+        shape = (max(multiple, int(height // multiple) * multiple), max(multiple, int(height * aspect // multiple) * multiple))
+        if shape not in shapes:
+            shapes.append(shape)
+    shapes.sort(key=lambda x: x[1] / x[0])
+    return np.array(shapes, dtype=np.int64).reshape(-1, 2)
+
+def assign(aspects, shapes):
+    '''Assigns each image to the bucket with the closest (log) aspect ratio.
+
+    Returns:
+        ids (np.ndarray): Bucket id of each image
+    '''
+    logs = np.log(np.asarray(aspects, dtype=np.float64))
+    centers = np.log(shapes[:, 1] / shapes[:, 0])
+    return np.argmin(np.abs(logs[:, None] - centers[None, :]), axis=1)
+
+def padding_ratio(img_shapes, shapes, ids=None):
+    '''Computes the fraction of padded pixels if the images are fitted into the shapes.
+
+    Args:
+        img_shapes (np.ndarray): `(N, 2)` array of the image sizes
+        shapes (np.ndarray): `(M, 2)` array of target shapes (single shape for all images if `ids` is None)
+        ids (np.ndarray): Bucket id of each image
+    '''
+    img_shapes = np.asarray(img_shapes, dtype=np.float64).reshape(-1, 2)
+    targets = np.asarray(shapes, dtype=np.float64).reshape(-1, 2)
+    targets = targets[ids] if ids is not None else np.repeat(targets[:1], len(img_shapes), axis=0)
+    scale = np.min(targets / img_shapes, axis=1)
+    used = np.minimum(np.ceil(img_shapes * scale[:, None]), targets).prod(axis=1)
+    return 1 - used.sum() / max(1, targets.prod(axis=1).sum())
+
+def create(folder, fmt="beard", count=4, size=512, multiple=32, only=None, classes=None, json_name="*.json", workers=0, debug=False, shard=None):
+    '''Creates the buckets of the dataset from the image headers (only of the files of the `shard`, if given).
+
+    Returns:
+        config (dict): beard-style config of the samples
+        files (list): List of tuples `(img_path, label, btype)` (see `convert._list_source`)
+        shapes (np.ndarray): `(M, 2)` array of the bucket shapes
+        ids (np.ndarray): Bucket id of each file
+    '''
+    config, files = convert._list_source(folder, fmt, only, classes, json_name, debug)
+    if shard is not None:
+        files = shard.select(files)
+    img_shapes = np.array(list(utils.ordered_map(utils.imsize, [x[0] for x in files], workers)), dtype=np.int64).reshape(-1, 3)[:, :2]
+    aspects = img_shapes[:, 1] / np.maximum(img_shapes[:, 0], 1)
+
+    shapes = bucket_shapes(aspects, count, size, multiple)
+    ids = assign(aspects, shapes) if len(files) > 0 else np.zeros([0], dtype=np.int64)
+    if debug and len(files) > 0:
+        single = np.array(size if not isinstance(size, int) else (size, size))
+        print("Padding with buckets: {:.1%} (single size: {:.1%})".format(padding_ratio(img_shapes, shapes, ids), padding_ratio(img_shapes, single)))
+    return config, files, shapes, ids
+
+#--------------------------------------------------------------------------------------------------
+# LOADING
+
+def _stack(samples):
+    '''Combines the samples of a bucket into a batch.'''
+    return np.stack([x[0] for x in samples], axis=0), [x[1] for x in samples], [x[2] for x in samples], [x[3] for x in samples]
+
+def load(folder, fmt="beard", batch_size=8, count=4, size=512, multiple=32, only=None, shuffle=True, drop_last=False, resize=utils.ResizeMode.PAD_EDGE, pad_color=(0,0,0), pad_mode=utils.PadMode.CENTER, classes=None, json_name="*.json", workers=0, seed=None, debug=False, shard=None):
+    '''Loads the dataset in batches of homogeneous shape.
+
+    Args:
+        folder (str): Folder of the dataset
+        fmt (str): Format of the dataset (one of `convert.FORMATS`)
+        batch_size (int): Number of samples per batch
+        count (int): Maximal number of buckets (see `bucket_shapes`)
+        size (int): Pixel budget of each bucket
+        shuffle (bool): Shuffles the samples before they are sorted into the buckets
+        drop_last (bool): Drops the incomplete batches at the end instead of returning them
+        resize (ResizeMode): Padding mode for the remainder of the bucket (images are fitted into the bucket)
+        workers (int): Number of threads that decode and resize images ahead of the generator
+        seed (int): Seed of the shuffling
+        shard (Sharding): Buckets and loads only the files of the rank and worker (see `shard.Sharding`)
+
+    Returns:
+        config (dict): beard-style config of the samples
+        shapes (np.ndarray): `(M, 2)` array of the bucket shapes
+        gen (Generator): Generator that returns batches of `(imgs, globals, metadata, DataTypes)`, where `imgs` is a
+            `(batch_size, height, width, channels)` array with the shape of the bucket and the others are lists
+    '''
+    # safty: the shape of the batches requires padding
+    if resize in (utils.ResizeMode.FIT, utils.ResizeMode.STRETCH):
+        raise ValueError("Bucketing requires a padding mode, but got {}".format(resize))
+    config, files, shapes, ids = create(folder, fmt, count, size, multiple, only, classes, json_name, workers, debug, shard)
+
+    def _gen():
+        order = utils.RNG(seed).permutation(len(files)) if shuffle else np.arange(len(files))
+
+        # load the samples (in a thread pool if requested)
+        def _load(i):
+            img_path, label, btype = files[i]
+            sample = convert._load_sample(fmt, config, img_path, label, tuple(int(x) for x in shapes[ids[i]]), resize, pad_color, pad_mode, debug)
+            return ids[i], sample + (btype,)
+
+        # sort the samples into the buckets
+        buffers = [[] for _ in range(len(shapes))]
+        for bucket, sample in utils.ordered_map(_load, order, workers):
+            buffers[bucket].append(sample)
+            if len(buffers[bucket]) >= batch_size:
+                yield _stack(buffers[bucket])
+                buffers[bucket] = []
+
+        # return incomplete batches
+        if not drop_last:
+            for buffer in buffers:
+                if len(buffer) > 0:
+                    yield _stack(buffer)
+
+    return config, shapes, _gen()
@@ -3,17 +3,12 @@
 author: Felix Geilert
 '''
 
-from random import randint
 import numpy as np
 import os, glob, math
 import shutil
 from . import utils
+from . import memory
 
-def _img_gen(folder):
-    imgs = utils.search_imgs(folder)
-    for img in imgs:
-        yield utils.imread(img)
-        
 def _find_classes(folder, only):
     '''Retrieves the relevant classes from the '''
     # generate data
@@ -40,10 +35,56 @@ def _find_classes(folder, only):
     # return the generated classess
     return rel_classes
 
-def _gen_single(img, cls_name, classes, btype, one_hot=True, beard_format=False, show_btype=False):
-    '''Generate tuple for a single output.'''
+def _list_cls(folder, classes, only=None, debug=False):
+    '''Lists all images of the dataset without loading them.
+
+    Returns:
+        files (list): List of tuples `(img_path, cls_name, btype)` ordered by datatype and class
+    '''
+    # generate data
+    folders = utils.only_folders(only)
+    classes = [x.upper() for x in classes]
+
+    files = []
+    for btype in folders:
+        found = False
+        for dir in folders[btype]:
+            # check if folder exists
+            dir = os.path.join(folder, dir)
+            if not os.path.exists(dir):
+                continue
+            found = True
+
+            # iterate through all class folders
+            _, dirs, _ = next(os.walk(dir))
+            for cls_dir in sorted(dirs):
+                cls_name = cls_dir.upper()
+                if cls_name not in classes:
+                    continue
+                for img_path in utils.search_imgs(os.path.join(dir, cls_dir)):
+                    files.append((img_path, cls_name, btype))
+
+        # debug output
+        if not found:
+            if debug: print("Could not find folder for type: {}".format(btype.name))
+
+    return files
+
+def _write_sample(folder, btype, name, img, cls_name):
+    '''Writes a single image into the class folder of the regarding datatype.'''
+    # retrieve the folder for the class
+    fldr = {utils.DataType.TRAINING: 'train', utils.DataType.DEVELOPMENT: 'dev', utils.DataType.TESTING: 'test'}[btype]
+    fldr = os.path.join(folder, fldr, cls_name.upper())
+    os.makedirs(fldr, exist_ok=True)
+
+    # note: jpeg can not store an alpha channel
+    ext = 'png' if len(img.shape) > 2 and img.shape[2] == 4 else 'jpg'
+    utils.imwrite(os.path.join(fldr, '{}.{}'.format(name, ext)), utils.to_bgr(img))
+
+def _gen_single(img, cls_name, cmap, btype, one_hot=True, beard_format=False, show_btype=False):
+    '''Generate tuple for a single output (`cmap` is the `ClassMap` of the output classes).'''
     if one_hot:
-        cls_name = np.eye(len(classes))[classes.index(cls_name)]
+        cls_name = cmap.one_hot(cmap.index(cls_name))
     if beard_format:
         if show_btype: return img, {}, [{utils.const.ITEM_CLASS: cls_name, utils.const.ITEM_BBOX: [0,0,0,0]}], btype
         else: return img, {}, [{utils.const.ITEM_CLASS: cls_name, utils.const.ITEM_BBOX: [0,0,0,0]}]
@@ -51,25 +92,14 @@ def _gen_single(img, cls_name, classes, btype, one_hot=True, beard_format=False,
         if show_btype: return img, cls_name, btype
         else: return img, cls_name
 
-def _gen_cls(folder, classes, shuffle=True, only=None, size=None, one_hot=True, beard_format=False, show_btype=False, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, debug=False):
-    '''Loads the images from the given folder.
-    
-    Default output format is img, label, btype
-    
-    Args:
-        folder (str): folder to load the data from
-        classes (list): list of classes (prefered upper case)
-        shuffle (bool): defines if the data should be shuffled (default: True)
-        only (DataType):
-        size (int):
-        one_hot (bool): defines if the classes should be given as one_hot vectors
-        beard_format (bool): defines if the generator should output in the same format as the beard & kitti generators
+def _order_cls(folder, cmap, shuffle=True, only=None, debug=False, rng=None):
+    '''Generates the order of the images (as tuples of `(img_path, cls_name, btype)`) without loading them.
+
+    Class folders are selected and renamed through the `ClassMap`, `rng` interleaves the classes if `shuffle` is set.
     '''
     # generate data
     folders = utils.only_folders(only)
-    if classes is None:
-        raise ValueError("Expected list of classes, but got None!")
-    classes = [x.upper() for x in classes]
+    rng = utils.get_rng(rng)
 
     # iterate through folders
     for btype in folders:
@@ -89,23 +119,20 @@ def _gen_cls(folder, classes, shuffle=True, only=None, size=None, one_hot=True,
                 cls_dir = os.path.join(dir, cls_dir)
                 if not os.path.isdir(cls_dir):
                     continue
-                if classes is None or cls_name in classes:
-                    cls_gens.append((cls_name, _img_gen(cls_dir)))
+                if cls_name in cmap:
+                    cls_gens.append((cmap.name(cmap.index(cls_name)), iter(utils.search_imgs(cls_dir))))
 
             # shuffle the classes
             if not shuffle:
                 for cls_name, gen in cls_gens:
-                    for img in gen:
-                        img, _, _ = lib.resize(img, size, resize, pad_color, pad_mode)
-                        yield _gen_single(img, cls_name, classes, btype, one_hot, beard_format, show_btype)
+                    for img_path in gen:
+                        yield img_path, cls_name, btype
             else:
                 while len(cls_gens) > 0:
-                    id = randint(0, len(cls_gens) - 1)
+                    id = int(rng.randint(0, len(cls_gens)))
                     try:
                         cls_name, gen = cls_gens[id]
-                        img = next(gen)
-                        img, _, _ = utils.resize(img, size, resize, pad_color, pad_mode)
-                        yield _gen_single(img, cls_name, classes, btype, one_hot, beard_format, show_btype)
+                        yield next(gen), cls_name, btype
                     except StopIteration:
                         del cls_gens[id]
 
@@ -113,12 +140,61 @@ def _gen_cls(folder, classes, shuffle=True, only=None, size=None, one_hot=True,
         if not found:
             if debug: print("Could not find folder for type: {}".format(btype.name))
 
-def load(folder, classes=None, only=None, size=None, one_hot=True, beard_format=False, show_btype=False, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, debug=False, shuffle=True):
+def _gen_cls(folder, classes, shuffle=True, only=None, size=None, one_hot=True, beard_format=False, show_btype=False, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, debug=False, workers=0, remap=None, stats=None, rng=None, shard=None, channels=3):
+    '''Loads the images from the given folder.
+    
+    Default output format is img, label, btype
+    
+    Args:
+        folder (str): folder to load the data from
+        classes (list): list of classes (prefered upper case)
+        shuffle (bool): defines if the data should be shuffled (default: True)
+        only (DataType):
+        size (int):
+        one_hot (bool): defines if the classes should be given as one_hot vectors
+        beard_format (bool): defines if the generator should output in the same format as the beard & kitti generators
+        workers (int): Number of threads that decode and resize images ahead of the generator (0 = load in the generator)
+        remap (dict): Additional class folders that are merged into the classes (see `utils.classes.parse_remap`)
+        stats (ImageStats): Cached image statistics (see `stats.compute`), used for the mean color of `PAD_MEAN`
+        rng (RNG): Generator of the shuffling and the noise of `PAD_RANDOM` (default generator if None, see `utils.get_rng`)
+        shard (Sharding): Loads only the files of the rank and worker (see `shard.Sharding`)
+        channels (int): Number of image channels (see `beard.load`)
+    '''
+    if classes is None:
+        raise ValueError("Expected list of classes, but got None!")
+    cmap = utils.classes.ClassMap([x.upper() for x in classes], remap)
+    rng = utils.get_rng(rng)
+    sample_rng = utils.streams(rng) if resize == utils.ResizeMode.PAD_RANDOM else lambda id: None
+
+    # load the images (in a thread pool if requested)
+    def _load(item):
+        id, (img_path, cls_name, btype) = item
+        mean = stats.image_mean(img_path) if stats is not None else None
+        img, _, _ = utils.resize(utils.imread(img_path, channels), size, resize, pad_color, pad_mode, mean, sample_rng(id))
+        return img, cls_name, btype
+
+    # note: the shard is selected from the sorted files, so the loader shuffles the selected files afterwards
+    files = _order_cls(folder, cmap, shuffle and shard is None, only, debug, rng)
+    if shard is not None:
+        files = shard.select(list(files))
+        if shuffle:
+            files = [files[i] for i in rng.permutation(len(files))]
+    for img, cls_name, btype in utils.ordered_map(_load, enumerate(files), workers):
+        yield _gen_single(img, cls_name, cmap, btype, one_hot, beard_format, show_btype)
+
+def load(folder, classes=None, only=None, size=None, one_hot=True, beard_format=False, show_btype=False, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, debug=False, shuffle=True, workers=0, remap=None, stats=None, in_memory=False, rng=None, shard=None, channels=3):
     '''Loads the classification data from file.
 
     Returns:
         folder (str): Folder that contains the classification structure
         debug (bool): Defines if debugs messages should be shown
+        remap (dict): Merges class folders into output classes, e.g. `"Van,Truck->Car"` (see `utils.classes.parse_remap`)
+        stats (ImageStats): Cached image statistics (see `stats.compute`), used for the mean color of `PAD_MEAN`
+        in_memory (bool): Loads the entire dataset once into contiguous arrays (or a folder to store them, see `beard.load`),
+            the data is shuffled for each iteration
+        rng (RNG): Generator of the shuffling and the noise of `PAD_RANDOM` (default generator if None, see `utils.get_rng`)
+        shard (Sharding): Loads only the files of the rank and worker (see `shard.Sharding`)
+        channels (int): Number of image channels (1 - gray, 3 - RGB, 4 - RGBA or extra channel, None - as stored), always uint8
     '''
     # safty: check if the folder exists
     if not os.path.exists(folder):
@@ -126,36 +202,80 @@ def load(folder, classes=None, only=None, size=None, one_hot=True, beard_format=
         
     # load the relevant classes
     if classes is None:
-        classes = _find_classes(folder, only)
+        classes = utils.classes.remap_classes(_find_classes(folder, only), remap)
 
-    return classes, _gen_cls(folder, classes, shuffle, only, size, one_hot, beard_format, show_btype, resize, pad_color, pad_mode, debug)
+    # materialize the dataset into contiguous arrays (class stored as global value)
+    if in_memory:
+        cmap = utils.classes.ClassMap([x.upper() for x in classes], remap)
+        config = {"global": [{"type": "enum", "pos": 0, "name": utils.const.ITEM_CLASS, "dtype": "str", "values": cmap.classes}], "boxes": []}
+        key = memory.loader_key(folder, classes=classes, only=only, size=size, resize=resize, pad_color=pad_color, pad_mode=pad_mode, remap=remap, stats=stats is not None, shard=shard.key() if shard is not None else None, channels=channels)
+        gen = _gen_cls(folder, classes, False, only, size, False, False, True, resize, pad_color, pad_mode, debug, workers, remap, stats, rng, shard, channels)
+        gen = ((img, {utils.const.ITEM_CLASS: cls_name}, [], btype) for img, cls_name, btype in gen)
+        data = memory.materialize(gen, config, in_memory, key, debug)
+        return classes, data.view(lambda x: _gen_single(x[0], x[1][utils.const.ITEM_CLASS], cmap, x[3], one_hot, beard_format, show_btype), shuffle, rng)
 
-def load_sample_imgs(folder, only, size=None, count=10, classes=None, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE):
-    '''Loads relevant count of sample images'''
+    return classes, _gen_cls(folder, classes, shuffle, only, size, one_hot, beard_format, show_btype, resize, pad_color, pad_mode, debug, workers, remap, stats, rng, shard, channels)
+
+def load_sample_imgs(folder, only, size=None, count=10, classes=None, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, workers=4, rng=None, channels=3):
+    '''Loads `count` random sample images (e.g. for preview grids), stratified by class.
+
+    The paths are selected up front (see `utils.stratified_sample`) and only the selected images are decoded
+    (in parallel, directly into the output array, see `utils.imread_into`).
+
+    Args:
+        workers (int): Number of decoding threads
+        rng (RNG): Generator of the selection (default generator if None, see `utils.get_rng`)
+
+    Returns:
+        imgs (np.ndarray): `(N, HEIGHT, WIDTH, C)` uint8 array (all images need the same size, e.g. `size` with a padding resize mode)
+        labels (np.ndarray): One-hot labels of the images
+    '''
     # safty: check if the folder exists
     if not os.path.exists(folder):
         raise IOError("Specified folder ({}) does not exist!".format(folder))
-        
+
     # load the relevant classes
     if classes is None:
         classes = _find_classes(folder, only)
-        
-    gen = _gen_cls(folder, classes, True, only, size, True, False, False, resize, pad_color, pad_mode, False)
-    
-    imgs = []
-    labels = []
-    for img, lbl in gen:
-        # check for end
-        if len(imgs) >= count: break
-        if np.random.randint(0, 10) > 5: continue
-        # add data
-        imgs.append(img)
-        labels.append(lbl)
-        
-    # compress
-    imgs = np.stack(imgs, axis=0)
-    labels = np.stack(labels, axis=0)
+    cmap = utils.classes.ClassMap([x.upper() for x in classes])
+
+    # select the files and decode them
+    files = _list_cls(folder, classes, only)
+    files = [files[id] for id in utils.stratified_sample([x[1] for x in files], count, rng)]
+    imgs, _, _ = utils.imread_into([x[0] for x in files], size, resize, pad_color, pad_mode, channels, workers, rng)
+    labels = np.array([cmap.one_hot(cmap.index(x[1])) for x in files]).reshape(len(files), -1)
     return imgs, labels
 
-def write(folder, debug=False):
-    raise NotImplementedError
+def write(gen, folder, classes=None, clean=False, debug=False, start_id=0):
+    '''Stores the data from the provided generator in the classification structure.
+
+    Args:
+        gen (Generator): Generator that provides tuples of `(img, label, DataType)`, where label is either the class name or a one-hot vector
+        folder (str): folder to store the dataset into
+        classes (list): List of classes (required if labels are given as one-hot vectors)
+        clean (bool): Defines clean storage (if true deletes any existing data in `folder`)
+        debug (bool): If debug output should be shown
+    '''
+    # check to clean the folder
+    if clean and os.path.exists(folder):
+        shutil.rmtree(folder)
+
+    # generate folder structure
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+
+    # iterate the counter
+    counter = start_id
+    for img, label, btype in gen:
+        counter += 1
+        # retrieve the class name
+        if not isinstance(label, str):
+            if classes is None:
+                raise ValueError("Expected list of classes to decode one-hot labels, but got None!")
+            label = classes[int(np.argmax(label))]
+
+        _write_sample(folder, btype, '{:06d}'.format(counter), img, label)
+        if debug: print("Stored image {} ({})".format(counter, label))
+
+        # output current data as generator
+        yield counter, btype
@@ -0,0 +1,304 @@
+'''Parallel conversion between the classification, kitti and beard formats.
+
+The conversion lists all samples of the source dataset, splits them into chunks and converts the chunks
+in a pool of worker processes. Finished chunks are recorded in a state file inside the target folder,
+so an interrupted conversion continues where it stopped.
+
+author: Felix Geilert
+'''
+
+import os, json
+import shutil
+import argparse
+import multiprocessing
+from . import utils
+from . import beard
+from . import kitti
+from . import classification
+
+
+FORMATS = ["beard", "kitti", "classification"]
+STATE_FILE = '.convert_state.json'
+
+#--------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+
+def _cls_config(classes):
+    '''Generates a beard config for classification data (each image contains a single box over the entire image).'''
+    return {
+        "global": [],
+        "boxes": [
+            {
+                "type": "enum",
+                "pos": 0,
+                "name": utils.const.ITEM_CLASS,
+                "dtype": "str",
+                "values": classes
+            },
+            {
+                "type": "box-array",
+                "length": 4,
+                "name": utils.const.ITEM_BBOX,
+                "bb_type": "absolute",
+                "order": "y-x",
+                "dtype": "int",
+                "pos": 1
+            }
+        ]
+    }
+
+def _class_values(config):
+    '''Retrieves the list of class values from a beard config.'''
+    for item in config["boxes"]:
+        if item["type"] == "enum" and item["name"] in (utils.const.ITEM_CLASS, "type"):
+            return item["values"]
+    return []
+
+def _list_source(folder, fmt, only=None, classes=None, json_name="*.json", debug=False):
+    '''Lists all samples of the source dataset.
+
+    Returns:
+        config (dict): beard-style config that describes the loaded samples
+        files (list): List of tuples `(img_path, label, btype)` sorted for a stable order between runs
+    '''
+    if fmt == "beard":
+        config = beard._read_config(folder, json_name)
+        files = beard._list_beard(folder, only, debug)
+    elif fmt == "kitti":
+        config = kitti.create_config(classes if classes is not None else kitti.DEFAULT_CLASSES, beard_style=True)
+        files = beard._list_beard(folder, only, debug)
+    elif fmt == "classification":
+        if classes is None:
+            classes = classification._find_classes(folder, only)
+        config = _cls_config([x.upper() for x in classes])
+        files = classification._list_cls(folder, classes, only, debug)
+    else:
+        raise ValueError("Unkown dataset format ({}), expected one of {}".format(fmt, FORMATS))
+
+    # sort the files (glob order is not guaranteed to be stable)
+    files.sort(key=lambda x: (x[2].value, x[0]))
+    return config, files
+
+def _load_sample(src_fmt, config, img_path, label, size, resize, pad_color, pad_mode, debug):
+    '''Loads a single sample of the source dataset in beard style.'''
+    if src_fmt == "classification":
+        img = utils.imread(img_path)
+        img, _, _ = utils.resize(img, size, resize, pad_color, pad_mode)
+        return img, {}, [{utils.const.ITEM_CLASS: label, utils.const.ITEM_BBOX: [0, 0, img.shape[0], img.shape[1]]}]
+
+    global_config, boxes_config = beard._sort_config(config)
+    return beard._load_sample(img_path, label, global_config, boxes_config, size, resize, pad_color, pad_mode, debug=debug)
+
+def _convert_chunk(args):
+    '''Converts a single chunk of samples (executed inside the worker processes).
+
+    Returns:
+        chunk_id (int): Id of the converted chunk
+        counts (dict): Number of written images for each datatype name
+    '''
+    chunk_id, files, src_fmt, dst_fmt, config, dst_config, folder, size, resize, pad_color, pad_mode, debug = args
+
+    counts = {}
+    dirs = {}
+    for name, img_path, label, btype in files:
+        img, gdata, mdata = _load_sample(src_fmt, config, img_path, label, size, resize, pad_color, pad_mode, debug)
+
+        # write the data in the target format
+        written = 1
+        if dst_fmt != "classification" and btype not in dirs:
+            dirs[btype] = beard._split_dir(folder, btype)
+        if dst_fmt == "beard":
+            beard._write_sample(dirs[btype], name, img, gdata, mdata, dst_config, debug)
+        elif dst_fmt == "kitti":
+            mdata = kitti.convert_mdata(mdata, config)
+            beard._write_sample(dirs[btype], name, img, {}, mdata, dst_config, debug)
+        else:
+            # store a crop for each box
+            written = 0
+            for i, meta in enumerate(kitti.convert_mdata(mdata, config)):
+                x1, y1, x2, y2 = [int(x) for x in meta[utils.const.ITEM_BBOX]]
+                x1, y1 = max(0, x1), max(0, y1)
+                if x2 <= x1 or y2 <= y1:
+                    continue
+                classification._write_sample(folder, btype, '{}_{:03d}'.format(name, i), img[y1:y2, x1:x2], meta["type"])
+                written += 1
+
+        counts[btype.name] = counts.get(btype.name, 0) + written
+
+    return chunk_id, counts
+
+#--------------------------------------------------------------------------------------------------
+# CONVERSION
+
+def count(folder, fmt):
+    '''Counts the images and labels of a dataset for each datatype.
+
+    Returns:
+        counts (dict): Dict of datatype name to tuple of `(images, labels)` (labels is None for classification data)
+    '''
+    counts = {}
+    for btype, dirs in utils.dict_folders().items():
+        for dir in dirs:
+            dir = os.path.join(folder, dir)
+            if not os.path.exists(dir):
+                continue
+            imgs, lbls = counts.get(btype.name, (0, 0))
+            if fmt == "classification":
+                _, cls_dirs, _ = next(os.walk(dir))
+                imgs += sum([len(utils.search_imgs(os.path.join(dir, x))) for x in cls_dirs])
+                lbls = None
+            else:
+                img_dir, lbl_dir = utils.detect_folders(dir)
+                imgs += len(utils.search_imgs(img_dir))
+                lbls += len([x for x in os.listdir(lbl_dir) if x.endswith('.txt')]) if os.path.exists(lbl_dir) else 0
+            counts[btype.name] = (imgs, lbls)
+    return counts
+
+def verify(folder, fmt, expected):
+    '''Verifies the number of images and labels in the converted dataset.
+
+    Args:
+        folder (str): Folder of the converted dataset
+        fmt (str): Format of the converted dataset
+        expected (dict): Dict of datatype name to number of expected images
+
+    Returns:
+        errors (list): List of error messages (empty if the dataset is valid)
+    '''
+    counts = count(folder, fmt)
+    errors = []
+    for name, num in expected.items():
+        imgs, lbls = counts.get(name, (0, 0))
+        if imgs != num:
+            errors.append("{}: expected {} images, but found {}".format(name, num, imgs))
+        if lbls is not None and lbls != imgs:
+            errors.append("{}: found {} images, but {} labels".format(name, imgs, lbls))
+    return errors
+
+def convert(src, dst, src_fmt, dst_fmt, only=None, classes=None, size=None, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE,
+            workers=None, chunk_size=256, clean=False, check=True, json_name="*.json", debug=False):
+    '''Converts a dataset between the classification, kitti and beard format using multiple processes.
+
+    The conversion is resumable: finished chunks are stored in a state file in `dst` and skipped when the same
+    conversion is started again. Images are named by their (sorted) position in the source dataset.
+
+    Args:
+        src (str): Folder of the source dataset
+        dst (str): Folder to store the converted dataset into
+        src_fmt (str): Format of the source dataset (one of `FORMATS`)
+        dst_fmt (str): Format of the target dataset (one of `FORMATS`). Conversion to classification stores a crop for each box.
+        only (list): List of `DataType` to limit the conversion
+        classes (list): List of classes (for kitti the default kitti classes are used if None, for classification they are searched in the folder)
+        size (int): Either single int of tuple of ints to resize the images to (see `utils.resize`). If None images are not resized.
+        workers (int): Number of worker processes (default: number of cpus)
+        chunk_size (int): Number of samples that are converted (and checkpointed) together
+        clean (bool): Deletes any existing data (and conversion state) in `dst`
+        check (bool): Verifies the number of images and labels after conversion
+        debug (bool): Gives debug output
+
+    Returns:
+        counts (dict): Dict of datatype name to number of written images
+    '''
+    # safty: check the input
+    if not os.path.exists(src):
+        raise IOError("Specified folder ({}) does not exist!".format(src))
+    if dst_fmt not in FORMATS:
+        raise ValueError("Unkown dataset format ({}), expected one of {}".format(dst_fmt, FORMATS))
+
+    # list the source data and generate target config
+    config, files = _list_source(src, src_fmt, only, classes, json_name, debug)
+    if dst_fmt == "beard":
+        dst_config = config
+    elif dst_fmt == "kitti":
+        dst_config = kitti.create_config(_class_values(config))
+    else:
+        dst_config = None
+
+    # check for existing state
+    if clean and os.path.exists(dst):
+        shutil.rmtree(dst)
+    os.makedirs(dst, exist_ok=True)
+    state = {"source": os.path.abspath(src), "src_format": src_fmt, "dst_format": dst_fmt, "size": size,
+             "total": len(files), "chunk_size": chunk_size, "done": [], "counts": {}}
+    old_state = utils.read_sidecar(os.path.join(dst, STATE_FILE))
+    if old_state is not None:
+        keys = ["source", "src_format", "dst_format", "size", "total", "chunk_size"]
+        if any([json.dumps(old_state[k]) != json.dumps(state[k]) for k in keys]):
+            raise ValueError("Folder ({}) contains a different conversion, use clean to restart!".format(dst))
+        state = old_state
+        if debug: print("Resuming conversion ({} chunks done)".format(len(state["done"])))
+    if dst_config is not None and dst_fmt == "beard":
+        with open(os.path.join(dst, 'config.json'), 'w') as f:
+            json.dump(dst_config, f)
+
+    # generate the chunks (names are based on the sorted position)
+    files = [('{:06d}'.format(i + 1), img_path, label, btype) for i, (img_path, label, btype) in enumerate(files)]
+    chunks = [(i // chunk_size, files[i:i + chunk_size]) for i in range(0, len(files), chunk_size)]
+    done = set(state["done"])
+    tasks = [(cid, chunk, src_fmt, dst_fmt, config, dst_config, dst, size, resize, pad_color, pad_mode, debug) for cid, chunk in chunks if cid not in done]
+
+    # convert the data (create split folders upfront to avoid races in the workers)
+    if dst_fmt != "classification":
+        for btype in set([x[3] for x in files]):
+            beard._split_dir(dst, btype)
+    def _update(chunk_id, counts):
+        state["done"].append(chunk_id)
+        for name in counts:
+            state["counts"][name] = state["counts"].get(name, 0) + counts[name]
+        utils.write_sidecar(os.path.join(dst, STATE_FILE), state)
+        if debug: print("Converted chunk {} ({}/{} chunks)".format(chunk_id, len(state["done"]), len(chunks)))
+
+    workers = workers if workers is not None else multiprocessing.cpu_count()
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            _update(*_convert_chunk(task))
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            for chunk_id, counts in pool.imap_unordered(_convert_chunk, tasks):
+                _update(chunk_id, counts)
+
+    # verify the output
+    if check:
+        errors = verify(dst, dst_fmt, state["counts"])
+        if len(errors) > 0:
+            raise RuntimeError("Verification of converted dataset failed:\n{}".format("\n".join(errors)))
+
+    return state["counts"]
+
+#--------------------------------------------------------------------------------------------------
+# COMMAND LINE
+
+def main(argv=None):
+    '''Entry point of the `bp-convert` console script.'''
+    parser = argparse.ArgumentParser(description="Converts datasets between the classification, kitti and beard format.")
+    parser.add_argument("src", help="folder of the source dataset")
+    parser.add_argument("dst", help="folder to store the converted dataset")
+    parser.add_argument("--src-format", choices=FORMATS, required=True, help="format of the source dataset")
+    parser.add_argument("--dst-format", choices=FORMATS, required=True, help="format of the converted dataset")
+    parser.add_argument("--only", nargs="+", choices=[x.name.lower() for x in utils.DataType], help="datatypes to convert")
+    parser.add_argument("--classes", nargs="+", help="list of classes in the source dataset")
+    parser.add_argument("--size", nargs="+", type=int, help="size of the output images as `HEIGHT [WIDTH]`")
+    parser.add_argument("--resize", choices=[x.name.lower() for x in utils.ResizeMode], default="fit", help="resize mode")
+    parser.add_argument("--pad-mode", choices=[x.name.lower() for x in utils.PadMode], default="edge", help="padding mode")
+    parser.add_argument("--pad-color", nargs=3, type=int, default=[0, 0, 0], help="color of the padding (for pad_color)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--chunk-size", type=int, default=256, help="number of samples per checkpointed chunk")
+    parser.add_argument("--clean", action="store_true", help="delete existing data instead of resuming")
+    parser.add_argument("--no-verify", action="store_true", help="skip verification of the output")
+    parser.add_argument("--debug", action="store_true", help="show debug output")
+    args = parser.parse_args(argv)
+
+    # convert the arguments
+    only = [utils.DataType[x.upper()] for x in args.only] if args.only is not None else None
+    size = None
+    if args.size is not None:
+        size = args.size[0] if len(args.size) == 1 else tuple(args.size[:2])
+
+    counts = convert(args.src, args.dst, args.src_format, args.dst_format, only, args.classes, size,
+                     utils.ResizeMode[args.resize.upper()], tuple(args.pad_color), utils.PadMode[args.pad_mode.upper()],
+                     args.workers, args.chunk_size, args.clean, not args.no_verify, debug=args.debug)
+    for name in counts:
+        print("{}: {} images".format(name, counts[name]))
+
+if __name__ == "__main__":
+    main()
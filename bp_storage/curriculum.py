@@ -0,0 +1,163 @@
+'''Curriculum sampling based on the global `complexity` value of beard datasets.
+
+The global data (first line of each label file) is cached in a sidecar file next to the config, so only
+new or changed label files are read again. The sampler sorts the dataset by complexity once and then
+selects (or weights) the samples of each epoch according to a competence schedule. Images and boxes are
+only loaded for the selected samples.
+
+author: Felix Geilert
+'''
+
+import numpy as np
+import os, math
+from . import utils
+from . import beard
+
+
+# note: hidden file, so the default config search (`*.json`) does not find it
+GLOBAL_INDEX = '.global_index.json'
+
+#--------------------------------------------------------------------------------------------------
+# GLOBAL INDEX
+
+def load_globals(folder, config=None, only=None, json_name="*.json", update=True, debug=False):
+    '''Loads the global data of all samples in the dataset (using the sidecar cache).
+
+    Args:
+        folder (str): the folder of the dataset (root folder containing the json file)
+        config (dict): beard config of the dataset (if None, loaded from `json_name`)
+        only (list): List of `DataType` to limit the loading of the dataset
+        update (bool): Defines if the sidecar file should be updated with new or changed label files
+        debug (bool): Gives debug output
+
+    Returns:
+        files (list): List of tuples `(img_path, lbl_path, btype)`
+        gdata (list): List of global data dicts for each file
+    '''
+    # safty: check if the folder exists
+    if not os.path.exists(folder):
+        raise IOError("Specified folder ({}) does not exist!".format(folder))
+    if config is None:
+        config = beard._read_config(folder, json_name)
+    global_config, _ = beard._sort_config(config)
+
+    # load the cache (invalidate if the global config changed)
+    path = os.path.join(folder, GLOBAL_INDEX)
+    sidecar = utils.read_sidecar(path)
+    if sidecar is None or sidecar["global"] != global_config:
+        sidecar = {"global": global_config, "files": {}}
+    cache = sidecar["files"]
+
+    # read all new or changed files
+    files = beard._list_beard(folder, only, debug)
+    gdata = []
+    changed = 0
+    for _, lbl_path, _ in files:
+        name = os.path.relpath(lbl_path, folder)
+        key = utils.file_key(lbl_path)
+        if name not in cache or cache[name][0] != key:
+            cache[name] = [key, beard._load_global(lbl_path, global_config, debug)]
+            changed += 1
+        gdata.append(cache[name][1])
+
+    # update the cache
+    if update and changed > 0:
+        utils.write_sidecar(path, sidecar)
+        if debug: print("Updated global data of {} files".format(changed))
+
+    return files, gdata
+
+#--------------------------------------------------------------------------------------------------
+# SAMPLER
+
+class CurriculumSampler(object):
+    '''Selects the samples of each epoch according to their complexity.
+
+    The competence `c` of an epoch grows from `start` to 1 over `epochs` (square root schedule), all samples
+    with a complexity rank below `c` are part of the epoch.
+
+    Args:
+        complexity (np.ndarray): Complexity of each sample (None or NaN values are treated as easiest samples)
+        epochs (int): Number of epochs until the entire dataset is used
+        start (float): Initial competence (fraction of the easiest samples used in the first epoch)
+        seed (int): Seed for shuffling and drawing (combined with the epoch)
+    '''
+    def __init__(self, complexity, epochs=10, start=0.2, seed=None):
+        complexity = np.array([np.nan if x is None else x for x in complexity], dtype=np.float64)
+        complexity[np.isnan(complexity)] = -np.inf
+        self.complexity = complexity
+        self.epochs = epochs
+        self.start = start
+        self.seed = seed
+
+        # precompute the order and the rank (fraction of easier samples) of each sample
+        self.order = np.argsort(complexity, kind='stable')
+        self.rank = np.empty([len(complexity)], dtype=np.float64)
+        self.rank[self.order] = (np.arange(len(complexity)) + 1) / max(1, len(complexity))
+
+    def _rng(self, epoch):
+        '''Generates the random generator for the given epoch (independent stream per epoch if seeded).'''
+        return utils.get_rng() if self.seed is None else utils.RNG(self.seed).stream(epoch, "curriculum")
+
+    def competence(self, epoch):
+        '''Retrieves the competence (fraction of usable samples) for the given epoch.'''
+        if self.epochs <= 0:
+            return 1.0
+        return min(1.0, math.sqrt(epoch * (1 - self.start ** 2) / self.epochs + self.start ** 2))
+
+    def indices(self, epoch, shuffle=True):
+        '''Retrieves the indices of all samples of the epoch.
+
+        Args:
+            epoch (int): Current epoch (starting at 0)
+            shuffle (bool): Shuffles the samples, otherwise they are sorted from easy to hard
+
+        Returns:
+            ids (np.ndarray): Indices into the list of samples
+        '''
+        count = int(math.ceil(self.competence(epoch) * len(self.order)))
+        ids = self.order[:count]
+        if shuffle:
+            ids = ids[self._rng(epoch).permutation(len(ids))]
+        return ids
+
+    def weights(self, epoch, softness=0.1):
+        '''Computes sampling weights for the epoch (1 for samples below competence, exponential decay above).'''
+        return np.exp(-np.maximum(self.rank - self.competence(epoch), 0) / max(softness, 1e-6))
+
+    def draw(self, epoch, count, softness=0.1):
+        '''Draws `count` samples (with replacement) according to the weights of the epoch.'''
+        weights = self.weights(epoch, softness)
+        return self._rng(epoch).choice(len(weights), size=count, p=weights / weights.sum())
+
+#--------------------------------------------------------------------------------------------------
+# LOADING
+
+def create(folder, field="complexity", epochs=10, start=0.2, seed=None, only=None, json_name="*.json", debug=False):
+    '''Creates a curriculum sampler for the dataset.
+
+    Returns:
+        config (dict): Configuration of the dataset
+        files (list): List of tuples `(img_path, lbl_path, btype)` (indexed by the sampler)
+        sampler (CurriculumSampler): Sampler over the files
+    '''
+    config = beard._read_config(folder, json_name)
+    files, gdata = load_globals(folder, config, only, debug=debug)
+    if debug and not any([field in x for x in gdata]):
+        print("WARNING: the dataset contains no global value ({})".format(field))
+    sampler = CurriculumSampler([x.get(field, None) for x in gdata], epochs, start, seed)
+    return config, files, sampler
+
+def load(files, config, ids, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, classes=None, debug=False, shard=None):
+    '''Creates a beard generator over the selected samples (see `CurriculumSampler.indices` and `CurriculumSampler.draw`).
+
+    With a `shard` the selected ids are split between the ranks in their drawn order (deterministic, as the
+    sampler draws the same ids on all ranks for a seeded epoch), so drawn duplicates stay possible.
+
+    Returns:
+        gen (Generator): Generator that returns tuples of data: `(img, global, metadata, DataType)` (see `beard.load`)
+    '''
+    ids = np.asarray(ids)
+    if shard is not None:
+        ids = ids[shard.indices(shard.weights([files[i] for i in ids]))]
+    return beard._gen_files([files[i] for i in ids], config, size, show_btype, resize, pad_color, pad_mode, classes, debug)
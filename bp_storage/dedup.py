@@ -0,0 +1,206 @@
+'''Detection of duplicated and near-duplicated images across datasets.
+
+Each image gets a content hash (exact duplicates) and optionally a perceptual difference hash (dHash on a
+9x8 thumbnail, near duplicates). Hashes are computed in parallel and cached in a sidecar file next to the
+dataset, so only new or changed images are hashed again.
+
+author: Felix Geilert
+'''
+
+import numpy as np
+import os
+import hashlib
+import multiprocessing
+from . import utils
+from . import beard
+from . import convert
+
+
+# note: hidden file, so the default config search (`*.json`) does not find it
+HASH_INDEX = '.hash_index.json'
+
+# priority of the datatypes when selecting the copy to keep (evaluation data is kept to avoid leaks)
+KEEP_PRIORITY = {utils.DataType.TESTING: 0, utils.DataType.DEVELOPMENT: 1, utils.DataType.TRAINING: 2}
+
+#--------------------------------------------------------------------------------------------------
+# HASHING
+
+def dhash(img, size=8):
+    '''Computes the difference hash of an image.
+
+    Returns:
+        hash (int): Integer with `size * size` bits
+    '''
+    small = utils.imresize(img, size + 1, size).astype(np.float32)
+    if len(small.shape) > 2:
+        small = np.mean(small, axis=-1)
+    bits = np.packbits((small[:, 1:] > small[:, :-1]).flatten())
+    return int.from_bytes(bits.tobytes(), 'big')
+
+def _hash_file(args):
+    '''Computes the content (and perceptual) hash of a single file (executed inside the worker processes).'''
+    img_path, perceptual = args
+    content = hashlib.blake2b(digest_size=16)
+    with open(img_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            content.update(block)
+    phash = '{:016x}'.format(dhash(utils.imread(img_path))) if perceptual else None
+    return content.hexdigest(), phash
+
+def _hamming(a, b):
+    '''Computes the bitwise hamming distance between two arrays of uint64 hashes.'''
+    return np.unpackbits(np.bitwise_xor(a, b).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+def compute(folder, fmt="beard", only=None, perceptual=True, classes=None, workers=None, update=True, json_name="*.json", debug=False):
+    '''Computes the hashes of all images in the dataset (using the sidecar cache).
+
+    Args:
+        folder (str): Folder of the dataset
+        fmt (str): Format of the dataset (one of `convert.FORMATS`)
+        only (list): List of `DataType` to limit the hashing
+        perceptual (bool): Defines if the perceptual hash should be computed (requires decoding of the images)
+        workers (int): Number of worker processes (default: number of cpus)
+        update (bool): Defines if the sidecar file should be updated with new or changed images
+
+    Returns:
+        files (list): List of tuples `(img_path, label, btype)` (see `convert._list_source`)
+        hashes (list): List of tuples `(content_hash, perceptual_hash)` (perceptual hash as hex string or None)
+    '''
+    _, files = convert._list_source(folder, fmt, only, classes, json_name, debug)
+
+    # load the cache
+    path = os.path.join(folder, HASH_INDEX)
+    sidecar = utils.read_sidecar(path) or {"files": {}}
+    cache = sidecar["files"]
+
+    # find all files that require hashing
+    names = [os.path.relpath(x[0], folder) for x in files]
+    keys = [utils.file_key(x[0]) for x in files]
+    todo = [i for i, name in enumerate(names) if name not in cache or cache[name][0] != keys[i] or (perceptual and cache[name][2] is None)]
+
+    # compute the hashes
+    tasks = [(files[i][0], perceptual) for i in todo]
+    workers = workers if workers is not None else multiprocessing.cpu_count()
+    if workers <= 1 or len(tasks) <= 1:
+        results = [_hash_file(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_hash_file, tasks, chunksize=64)
+    for i, (content, phash) in zip(todo, results):
+        cache[names[i]] = [keys[i], content, phash]
+
+    # update the cache
+    if update and len(todo) > 0:
+        utils.write_sidecar(path, sidecar)
+        if debug: print("Hashed {} images in {}".format(len(todo), folder))
+
+    return files, [(cache[name][1], cache[name][2]) for name in names]
+
+#--------------------------------------------------------------------------------------------------
+# DUPLICATES
+
+def find(folders, fmt="beard", only=None, perceptual=True, threshold=4, classes=None, workers=None, debug=False):
+    '''Finds duplicated images across all given datasets.
+
+    Exact duplicates are found through the content hash. Near duplicates are images with a perceptual hash
+    that differs in at most `threshold` bits (found through bands of the hash, so not all pairs are compared).
+
+    Args:
+        folders (list): Single or list of dataset folders (or `(folder, fmt)` tuples to mix formats)
+        fmt (str): Default format of the datasets
+        perceptual (bool): Defines if near duplicates should be searched
+        threshold (int): Maximal number of different bits for near duplicates
+
+    Returns:
+        report (dict): json-serializable report with:
+            `groups` - list of duplicate groups, each a list of `[img_path, DataType name]` (first element is kept)
+            `duplicates` - list of image paths that should be removed (all but the first element of each group)
+            `cross_split` - number of groups that contain multiple datatypes
+    '''
+    if isinstance(folders, str):
+        folders = [folders]
+
+    # load the hashes of all datasets
+    paths, btypes, contents, phashes = [], [], [], []
+    for folder in folders:
+        folder, ffmt = folder if isinstance(folder, tuple) else (folder, fmt)
+        files, hashes = compute(folder, ffmt, only, perceptual, classes, workers, debug=debug)
+        paths += [x[0] for x in files]
+        btypes += [x[2] for x in files]
+        contents += [x[0] for x in hashes]
+        phashes += [x[1] for x in hashes]
+
+    # union find over all duplicate pairs
+    parent = list(range(len(paths)))
+    def _root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    def _union(i, j):
+        i, j = _root(i), _root(j)
+        if i != j: parent[max(i, j)] = min(i, j)
+
+    # exact duplicates
+    first = {}
+    for i, content in enumerate(contents):
+        if content in first: _union(first[content], i)
+        else: first[content] = i
+
+    # near duplicates (pigeonhole: hashes within threshold share at least one of `threshold + 1` bands)
+    if perceptual and len(paths) > 1:
+        values = np.array([int(x, 16) for x in phashes], dtype=np.uint64)
+        bands = threshold + 1
+        bounds = np.linspace(0, 64, bands + 1).astype(int)
+        for b in range(bands):
+            mask = np.uint64(((1 << int(bounds[b + 1] - bounds[b])) - 1) << int(bounds[b]))
+            keys = values & mask
+            order = np.argsort(keys, kind='stable')
+            # find the buckets with more than one element
+            starts = np.concatenate([[0], np.flatnonzero(np.diff(keys[order])) + 1])
+            sizes = np.diff(np.concatenate([starts, [len(order)]]))
+            for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+                bucket = order[start:start + size]
+                # compare all pairs in the bucket
+                i, j = np.triu_indices(len(bucket), k=1)
+                close = _hamming(values[bucket[i]], values[bucket[j]]) <= threshold
+                for a, b2 in zip(bucket[i[close]], bucket[j[close]]):
+                    _union(int(a), int(b2))
+
+    # collect the groups (sorted by keep priority)
+    groups = {}
+    for i in range(len(paths)):
+        groups.setdefault(_root(i), []).append(i)
+    report = {"groups": [], "duplicates": [], "cross_split": 0}
+    for ids in groups.values():
+        if len(ids) < 2:
+            continue
+        ids.sort(key=lambda x: (KEEP_PRIORITY[btypes[x]], x))
+        report["groups"].append([[paths[x], btypes[x].name] for x in ids])
+        report["duplicates"] += [paths[x] for x in ids[1:]]
+        if len(set([btypes[x] for x in ids])) > 1:
+            report["cross_split"] += 1
+
+    if debug: print("Found {} duplicate groups ({} across datatypes)".format(len(report["groups"]), report["cross_split"]))
+    return report
+
+def load(folder, duplicates, config=None, only=None, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, classes=None, json_name="*.json", debug=False, shard=None):
+    '''Creates a beard generator for a beard or kitti dataset that skips the given duplicates.
+
+    Args:
+        folder (str): Folder of the dataset
+        duplicates (list): List of image paths to skip (see `find`)
+        config (dict): beard config of the dataset (if None, loaded from `json_name`, use `kitti.create_config` for kitti data)
+        shard (Sharding): Loads only the remaining files of the rank and worker (see `shard.Sharding`)
+
+    Returns:
+        config (dict): Configuration of the dataset
+        gen (Generator): Generator that returns tuples of data: `(img, global, metadata, DataType)` (see `beard.load`)
+    '''
+    if config is None:
+        config = beard._read_config(folder, json_name)
+    duplicates = set([os.path.abspath(x) for x in duplicates])
+    files = [x for x in beard._list_beard(folder, only, debug) if os.path.abspath(x[0]) not in duplicates]
+    if shard is not None:
+        files = shard.select(files)
+    return config, beard._gen_files(files, config, size, show_btype, resize, pad_color, pad_mode, classes, debug)
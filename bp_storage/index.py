@@ -0,0 +1,262 @@
+'''Spatial index over the boxes of a beard (or kitti) dataset.
+
+The index stores all boxes in normalized `[TOP, LEFT, BOTTOM, RIGHT]` coordinates and sorts them into a
+uniform grid, which is partitioned by class. Region queries and crop sampling therefore only look at the
+grid cells that overlap the region instead of scanning all labels.
+
+author: Felix Geilert
+'''
+
+import numpy as np
+import os
+from . import utils
+from . import beard
+
+
+INDEX_FILE = 'box_index.npz'
+
+#--------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+
+def _find_items(config):
+    '''Retrieves the class and box item of the config.'''
+    cls_item = None
+    box_item = None
+    for item in config["boxes"]:
+        if item["type"] == "enum" and item["name"] in (utils.const.ITEM_CLASS, "type") and cls_item is None:
+            cls_item = item
+        elif item["type"] == "box-array" and box_item is None:
+            box_item = item
+    if cls_item is None or box_item is None:
+        raise ValueError("Config requires a class enum and a box-array element!")
+    return cls_item, box_item
+
+def _norm_boxes(bbs, item, shape):
+    '''Converts boxes to normalized `[TOP, LEFT, BOTTOM, RIGHT]` coordinates.'''
+    bbs = utils.boxes.from_item(np.asarray(bbs, dtype=np.float32), item)
+    return np.clip(bbs / np.array([shape[0], shape[1], shape[0], shape[1]], dtype=np.float32), 0, 1)
+
+def _cell_range(bbs, grid):
+    '''Computes the range of grid cells that are covered by the boxes (inclusive).'''
+    cells = np.floor(bbs * grid).astype(np.int64)
+    return np.clip(cells, 0, grid - 1)
+
+#--------------------------------------------------------------------------------------------------
+# INDEX
+
+class BoxIndex(object):
+    '''Grid index over all boxes of a dataset.
+
+    Attributes:
+        files (np.ndarray): Image paths of the dataset
+        btypes (np.ndarray): `DataType` value of each image
+        shapes (np.ndarray): `(height, width)` of each image
+        classes (np.ndarray): Class names (in order of the class ids)
+        boxes (np.ndarray): `(N, 4)` float array of normalized boxes in y-x format
+        box_cls (np.ndarray): Class id of each box
+        box_img (np.ndarray): Image id of each box
+        grid (int): Number of grid cells in each dimension
+    '''
+    def __init__(self, files, btypes, shapes, classes, boxes, box_cls, box_img, grid=16):
+        self.files = np.asarray(files)
+        self.btypes = np.asarray(btypes, dtype=np.int8)
+        self.shapes = np.asarray(shapes, dtype=np.int32).reshape(-1, 2)
+        self.classes = np.asarray(classes)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.box_cls = np.asarray(box_cls, dtype=np.int32)
+        self.box_img = np.asarray(box_img, dtype=np.int32)
+        self.grid = int(grid)
+        self._build()
+
+    def _build(self):
+        '''Sorts the boxes into the class partitioned grid (stored as offsets into a sorted id array).'''
+        grid = self.grid
+        num_cells = len(self.classes) * grid * grid
+
+        # compute the covered cells of each box
+        cells = _cell_range(self.boxes, grid)
+        ny = cells[:, 2] - cells[:, 0] + 1
+        nx = cells[:, 3] - cells[:, 1] + 1
+        count = ny * nx
+
+        # expand each box to all of its cells
+        ids = np.repeat(np.arange(len(self.boxes)), count)
+        local = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        yy = cells[ids, 0] + local // nx[ids]
+        xx = cells[ids, 1] + local % nx[ids]
+        keys = (self.box_cls[ids].astype(np.int64) * grid + yy) * grid + xx
+
+        # sort by cell
+        order = np.argsort(keys, kind='stable')
+        self.cell_ids = ids[order].astype(np.int32)
+        self.cell_start = np.searchsorted(keys[order], np.arange(num_cells + 1))
+
+        # partition the boxes by class (for sampling)
+        self.cls_ids = np.argsort(self.box_cls, kind='stable').astype(np.int32)
+        self.cls_start = np.searchsorted(self.box_cls[self.cls_ids], np.arange(len(self.classes) + 1))
+
+    def _class_ids(self, cls):
+        '''Converts class names (or ids) into a list of class ids.'''
+        if cls is None:
+            return list(range(len(self.classes)))
+        if isinstance(cls, (str, int, np.integer)):
+            cls = [cls]
+        upper = [x.upper() for x in self.classes]
+        out = []
+        for c in cls:
+            if isinstance(c, str):
+                if c.upper() not in upper:
+                    raise ValueError("Class ({}) is not part of the index ({})".format(c, self.classes))
+                c = upper.index(c.upper())
+            out.append(int(c))
+        return out
+
+    def query(self, region, cls=None):
+        '''Retrieves all boxes that intersect the given region.
+
+        Args:
+            region (list): Normalized region as `[TOP, LEFT, BOTTOM, RIGHT]`
+            cls (list): Single or list of class names (or ids) to search for (None for all classes)
+
+        Returns:
+            ids (np.ndarray): Sorted ids of the intersecting boxes (use `boxes`, `box_img` and `box_cls` to retrieve the data)
+        '''
+        region = np.asarray(region, dtype=np.float32)
+        cells = _cell_range(region.reshape(1, 4), self.grid)[0]
+        grid = self.grid
+
+        # gather candidates from all covered cells
+        parts = []
+        for c in self._class_ids(cls):
+            for y in range(cells[0], cells[2] + 1):
+                start = (c * grid + y) * grid
+                parts.append(self.cell_ids[self.cell_start[start + cells[1]]:self.cell_start[start + cells[3] + 1]])
+        if len(parts) == 0:
+            return np.zeros([0], dtype=np.int32)
+        ids = np.unique(np.concatenate(parts))
+
+        # exact intersection test
+        bbs = self.boxes[ids]
+        hit = (bbs[:, 0] < region[2]) & (bbs[:, 2] > region[0]) & (bbs[:, 1] < region[3]) & (bbs[:, 3] > region[1])
+        return ids[hit]
+
+    def images(self, region, cls=None):
+        '''Retrieves the paths of all images with boxes that intersect the given region (see `query`).'''
+        ids = np.unique(self.box_img[self.query(region, cls)])
+        return [str(x) for x in self.files[ids]]
+
+    def sample_crop(self, size, cls=None, rng=None):
+        '''Samples a crop that contains at least one box.
+
+        A box of the requested classes is drawn uniformly and the crop is randomly placed around it. If the
+        box is larger than the crop, the crop is placed inside the box.
+
+        Args:
+            size (tuple): Normalized `(height, width)` of the crop
+            cls (list): Single or list of class names (or ids) to sample from (None for all classes)
+            rng (RNG): Generator used for sampling (default generator if None, see `utils.get_rng`)
+
+        Returns:
+            img_path (str): Path of the image
+            crop (np.ndarray): Crop in absolute pixel coordinates as `[TOP, LEFT, BOTTOM, RIGHT]`
+            box_id (int): Id of the box the crop was sampled around
+        '''
+        # draw a box of the relevant classes
+        cls_ids = np.array(self._class_ids(cls))
+        starts = self.cls_start[cls_ids]
+        counts = self.cls_start[cls_ids + 1] - starts
+        if counts.sum() == 0:
+            raise ValueError("Index contains no boxes for classes ({})".format(cls))
+        rng = utils.get_rng(rng)
+        pos = rng.randint(0, counts.sum())
+        part = int(np.searchsorted(np.cumsum(counts), pos, side='right'))
+        box_id = self.cls_ids[starts[part] + pos - (np.cumsum(counts)[part] - counts[part])]
+
+        # place the crop around the box (or inside the box if it is larger than the crop)
+        box = self.boxes[box_id]
+        crop = np.zeros([4], dtype=np.float32)
+        for dim in range(2):
+            if size[dim] >= box[dim + 2] - box[dim]:
+                lo, hi = max(0.0, box[dim + 2] - size[dim]), min(box[dim], 1.0 - size[dim])
+            else:
+                lo, hi = box[dim], box[dim + 2] - size[dim]
+            crop[dim] = lo if hi <= lo else rng.uniform(lo, hi)
+            crop[dim + 2] = crop[dim] + size[dim]
+
+        # convert to pixel coordinates
+        img = self.box_img[box_id]
+        shape = self.shapes[img]
+        crop = np.round(crop * np.array([shape[0], shape[1], shape[0], shape[1]])).astype(np.int32)
+        return str(self.files[img]), crop, int(box_id)
+
+    def save(self, folder, name=INDEX_FILE):
+        '''Stores the index in the given folder (usually next to the config file).'''
+        np.savez(os.path.join(folder, name), files=self.files, btypes=self.btypes, shapes=self.shapes, classes=self.classes,
+                 boxes=self.boxes, box_cls=self.box_cls, box_img=self.box_img, grid=np.array(self.grid))
+
+#--------------------------------------------------------------------------------------------------
+# PUBLIC FUNCTIONS
+
+def build(folder, config=None, only=None, grid=16, json_name="*.json", debug=False):
+    '''Builds the box index from the label files of the dataset.
+
+    Image sizes are read from the image headers, so no image is decoded.
+
+    Args:
+        folder (str): the folder of the dataset (root folder containing the json file)
+        config (dict): beard config of the dataset (if None, loaded from `json_name`, use `kitti.create_config` for kitti data)
+        only (list): List of `DataType` to limit the index
+        grid (int): Number of grid cells in each dimension
+        debug (bool): Gives debug output
+
+    Returns:
+        index (BoxIndex): Index over all boxes in the dataset
+    '''
+    # safty: check if the folder exists
+    if not os.path.exists(folder):
+        raise IOError("Specified folder ({}) does not exist!".format(folder))
+    if config is None:
+        config = beard._read_config(folder, json_name)
+    global_config, boxes_config = beard._sort_config(config)
+    cls_item, box_item = _find_items(config)
+    classes = list(cls_item["values"])
+    cmap = utils.classes.from_item(cls_item)
+
+    # load all labels
+    files, btypes, shapes = [], [], []
+    boxes, box_cls, box_img = [], [], []
+    for img_path, lbl_path, btype in beard._list_beard(folder, only, debug):
+        shape = utils.imsize(img_path)
+        _, mdata = beard._load_labels(lbl_path, global_config, boxes_config, debug=debug)
+
+        # convert the classes
+        bbs, ids = [], []
+        for meta in mdata:
+            value = meta[cls_item["name"]]
+            if cls_item["dtype"] == "str":
+                value = cmap.index(value)
+            if value < 0 or value >= len(classes):
+                if debug: print("WARNING: skipping box of unkown class ({}) in {}".format(meta[cls_item["name"]], lbl_path))
+                continue
+            bbs.append(meta[box_item["name"]])
+            ids.append(value)
+
+        # store the data
+        if len(bbs) > 0:
+            boxes.append(_norm_boxes(bbs, box_item, shape))
+            box_cls += ids
+            box_img += [len(files)] * len(ids)
+        files.append(img_path)
+        btypes.append(btype.value)
+        shapes.append(shape[:2])
+
+    boxes = np.concatenate(boxes, axis=0) if len(boxes) > 0 else np.zeros([0, 4], dtype=np.float32)
+    return BoxIndex(files, btypes, shapes, classes, boxes, box_cls, box_img, grid)
+
+def load(folder, name=INDEX_FILE):
+    '''Loads a stored box index from the folder.'''
+    path = os.path.join(folder, name)
+    if not os.path.exists(path):
+        raise IOError("Cannot find the box index ({})!".format(path))
+    data = np.load(path)
+    return BoxIndex(data["files"], data["btypes"], data["shapes"], data["classes"], data["boxes"], data["box_cls"], data["box_img"], int(data["grid"]))
@@ -4,13 +4,27 @@ author: Felix Geilert
 '''
 
 import os
+import shutil
 from . import utils
 from . import beard
+from . import memory
 
 
+DEFAULT_CLASSES = ['Car', 'Van', 'Truck', 'Pedestrian', 'Person_sitting', 'Cyclist', 'Tram', 'Misc', 'DontCare']
+
+# default values for kitti items that are not provided (see `writeLabels.m` of the kitti devkit)
+DEFAULTS = {
+    "truncated": -1,
+    "occluded": -1,
+    "alpha": -10,
+    "dimensions": [-1, -1, -1],
+    "location": [-1000, -1000, -1000],
+    "rotation_y": -10
+}
+
 #--------------------------------------------------------------------------------------------------
 
-def load(folder, classes=None, only=None, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, beard_style=False, debug=False):
+def load(folder, classes=None, only=None, size=None, show_btype=True, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, beard_style=False, debug=False, workers=0, remap=None, stats=None, in_memory=False, rng=None, roi=None, roi_margin=0.0, shard=None, channels=3, lazy=False):
     '''Loads the kitti data and returns generator.
 
     Args:
@@ -21,6 +35,16 @@ def load(folder, classes=None, only=None, size=None, show_btype=True, resize=uti
         pad (bool): If image is resized, use pad to change data
         beard_style (bool): Converts the config to beard style for easier compatibility
         debug (bool): Gives debug output
+        workers (int): Number of threads that decode and resize images ahead of the generator (0 = load in the generator)
+        remap (dict): Merges source classes into output classes, e.g. `"Van,Truck->Car"` (see `utils.classes.parse_remap`)
+        stats (ImageStats): Cached image statistics (see `stats.compute`), used for the mean color of `PAD_MEAN`
+        in_memory (bool): Loads the entire dataset once into contiguous arrays (or a folder to store them, see `beard.load`)
+        rng (RNG): Generator of the noise for `PAD_RANDOM` (default generator if None, see `utils.get_rng`)
+        roi (int): Size of the crops to load a sample per box (see `beard.load`)
+        roi_margin (float): Context around the boxes for `roi` as fraction of the box size per side
+        shard (Sharding): Loads only the files of the rank and worker (see `shard.Sharding`)
+        channels (int): Number of image channels (see `beard.load`)
+        lazy (bool): Decodes the images only on access (see `beard.load`)
 
     Returns:
         config (dict): Configuration loaded for the generator/dataset
@@ -32,17 +56,121 @@ def load(folder, classes=None, only=None, size=None, show_btype=True, resize=uti
     if not os.path.exists(folder):
         raise IOError("Specified folder ({}) does not exist!".format(folder))
 
+    if roi is not None and size is not None:
+        raise ValueError("ROI crops are taken from the original image, size has to be None (got {})".format(size))
+    if roi is not None and lazy:
+        raise ValueError("Lazy loading is not supported for ROI crops!")
+    if roi is not None and pad_mode != utils.PadMode.EDGE:
+        raise ValueError("ROI crops are not placed on a padded canvas, pad_mode has to be EDGE (got {})".format(pad_mode))
+
     # load the config file
     if classes is None:
-        classes = ['Car', 'Van', 'Truck', 'Pedestrian', 'Person_sitting', 'Cyclist', 'Tram', 'Misc', 'DontCare']
-    config = create_config(classes, beard_style)
+        classes = DEFAULT_CLASSES
+    cmap = utils.classes.create(None, remap, classes)
+    config = create_config(classes if cmap is None else cmap.classes, beard_style)
+
+    # materialize the dataset into contiguous arrays
+    if in_memory:
+        key = memory.loader_key(folder, classes=classes, only=only, size=size, resize=resize, pad_color=pad_color, pad_mode=pad_mode, beard_style=beard_style, remap=remap, stats=stats is not None, roi=roi, roi_margin=roi_margin, shard=shard.key() if shard is not None else None, channels=channels)
+        gen = beard._gen_beard(folder, config, only, size, True, resize, pad_color, pad_mode, cmap, debug=debug, workers=workers, stats=stats, rng=rng, roi=roi, roi_margin=roi_margin, shard=shard, channels=channels)
+        data = memory.materialize(gen, config, in_memory, key, debug)
+        return config, data.view(None if show_btype else lambda x: x[:3])
 
     # create the generator and return data
-    return config, beard._gen_beard(folder, config, only, size, show_btype, resize, pad_color, pad_mode, debug=debug)
+    return config, beard._gen_beard(folder, config, only, size, show_btype, resize, pad_color, pad_mode, cmap, debug=debug, workers=workers, stats=stats, rng=rng, roi=roi, roi_margin=roi_margin, shard=shard, channels=channels, lazy=lazy)
+
+def load_sample_imgs(folder, only=None, size=None, count=10, classes=None, resize=utils.ResizeMode.FIT, pad_color=(0,0,0), pad_mode=utils.PadMode.EDGE, beard_style=False, workers=4, rng=None, channels=3, candidates=32):
+    '''Loads `count` random sample images stratified by class (see `beard.load_sample_imgs`).
+
+    Returns:
+        imgs (np.ndarray): `(N, HEIGHT, WIDTH, C)` uint8 array
+        labels (list): Tuples of `(gdata, mdata)` for each image
+    '''
+    # safty: check if the folder exists
+    if not os.path.exists(folder):
+        raise IOError("Specified folder ({}) does not exist!".format(folder))
+    config = create_config(classes if classes is not None else DEFAULT_CLASSES, beard_style)
+    return beard._sample_imgs(folder, config, None, only, size, count, resize, pad_color, pad_mode, workers, rng, channels, candidates)
+
+def convert_mdata(mdata, config, beard_style=False):
+    '''Converts the metadata of a beard-style dataset into kitti metadata.
+
+    Boxes are converted to absolute coordinates in x-y order and all missing kitti items are filled with their default values.
+
+    Args:
+        mdata (list): List of dicts with the metadata of the boxes
+        config (dict): Beard config that describes the given metadata
+        beard_style (bool): Defines if the class should be stored as `class` instead of `type`
+
+    Returns:
+        mdata (list): List of dicts in kitti format
+    '''
+    # find the relevant config items
+    cls_name = "class" if beard_style else "type"
+    cls_item = None
+    box_item = None
+    for item in config["boxes"]:
+        if item["type"] == "enum" and item["name"] in ("class", "type") and cls_item is None:
+            cls_item = item
+        elif item["type"] == "box-array" and box_item is None:
+            box_item = item
+
+    out = []
+    for meta in mdata:
+        kmeta = {}
+        # convert the class
+        if cls_item is not None:
+            value = meta[cls_item["name"]]
+            if cls_item["dtype"] == "int":
+                value = cls_item["values"][value] if 0 <= value < len(cls_item["values"]) else "DontCare"
+            kmeta[cls_name] = value
+        # convert the box to absolute x-y coordinates
+        if box_item is not None:
+            kmeta[utils.const.ITEM_BBOX] = utils.boxes.convert(meta[box_item["name"]], box_item["bb_type"], box_item["order"], "absolute", "x-y")[0]
+        # copy all other kitti values
+        for key in DEFAULTS:
+            kmeta[key] = meta[key] if key in meta else DEFAULTS[key]
+        if "score" in meta:
+            kmeta["score"] = meta["score"]
+        out.append(kmeta)
+    return out
+
+def store(gen, folder, classes=None, clean=False, debug=False, start_id=0, beard_style=False):
+    '''Stores data in the kitti format.
+
+    Args:
+        gen (Generator): Generator that provides kitti data as `(img, global, metadata, DataType)` (see `convert_mdata`)
+        folder (str): folder to store the dataset into
+        classes (list): List of classes expected in the dataset (if None, assume default kitti classes)
+        clean (bool): Defines clean storage (if true deletes any existing data in `folder`)
+        debug (bool): If debug output should be shown
+        beard_style (bool): Defines if the metadata provides the class as `class` instead of `type`
+    '''
+    # load the config
+    if classes is None:
+        classes = DEFAULT_CLASSES
+    config = create_config(classes, beard_style)
+
+    # check to clean the folder
+    if clean and os.path.exists(folder):
+        shutil.rmtree(folder)
+
+    # generate folder structure
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+
+    # iterate the counter
+    dirs = {}
+    counter = start_id
+    for img, gdata, mdata, btype in gen:
+        counter += 1
+        if btype not in dirs:
+            dirs[btype] = beard._split_dir(folder, btype, clean)
+
+        beard._write_sample(dirs[btype], '{:06d}'.format(counter), img, {}, mdata, config, debug)
 
-def store(folder, debug=False):
-    '''Stores data in the kitti format.'''
-    raise NotImplementedError
+        # output current data as generator
+        yield counter, btype
 
 def create_config(classes, beard_style=False):
     '''Generates a beard-like config for the Kitti dataset (to work with various input functions).
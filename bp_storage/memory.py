@@ -0,0 +1,301 @@
+'''In-memory storage of entire datasets as contiguous arrays.
+
+The samples of a beard-style generator are materialized once: all images are concatenated into a single
+uint8 buffer (with an offset table, so the images can have different sizes), the numeric box items into a
+single `(total_boxes, K)` array (with an offset table per image) and the global items into a structured
+array. Iterating the dataset only slices these arrays. The arrays can be stored as `.npy` files and memory
+mapped for an instant warm start.
+
+author: Felix Geilert
+'''
+
+import numpy as np
+import os, json
+from enum import Enum
+from . import utils
+
+
+META_FILE = 'meta.json'
+ARRAYS = ["images", "img_offsets", "shapes", "btypes", "boxes", "box_offsets", "globals"]
+
+#--------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+
+def _item_width(item):
+    '''Retrieves the number of numeric columns of a config item.'''
+    return item["length"] if item["type"] in ("array", "box-array") else 1
+
+def _is_text(item):
+    '''Checks if the item contains strings (that are not stored as enum ids).'''
+    return item["type"] != "enum" and item["dtype"] == "str"
+
+def _encode(value, item):
+    '''Converts a loaded value into numeric columns (None becomes NaN).'''
+    if value is None:
+        return [np.nan] * _item_width(item)
+    if item["type"] == "enum":
+        return [value if item["dtype"] == "int" else utils.classes.from_item(item).index(value)]
+    if item["type"] in ("array", "box-array"):
+        return list(np.asarray(value, dtype=np.float64).reshape(-1))
+    return [value]
+
+def _decode(values, item):
+    '''Converts numeric columns back into the loaded value.'''
+    if np.isnan(values[0]):
+        return None
+    if item["type"] == "enum":
+        id = int(values[0])
+        if item["dtype"] == "int": return id
+        return utils.classes.UNKOWN if id < 0 or id >= len(item["values"]) else item["values"][id]
+    if item["type"] == "box-array":
+        return values.astype(int) if item["dtype"] == "int" else values.astype(np.float64)
+    if item["type"] == "array":
+        return [utils.set_dtype(x, item["dtype"]) for x in values.tolist()]
+    return utils.set_dtype(values[0].item(), item["dtype"])
+
+def _columns(items):
+    '''Computes the column ranges of the numeric items as `(item, start, end)`.'''
+    cols = []
+    start = 0
+    for item in items:
+        if _is_text(item):
+            continue
+        cols.append((item, start, start + _item_width(item)))
+        start += _item_width(item)
+    return cols, start
+
+#--------------------------------------------------------------------------------------------------
+# DATASET
+
+class MemoryDataset(object):
+    '''Dataset that is stored in contiguous arrays.
+
+    Attributes:
+        config (dict): beard-style config of the samples
+        images (np.ndarray): uint8 buffer of all images
+        img_offsets (np.ndarray): `(N + 1,)` offsets of the images in the buffer
+        shapes (np.ndarray): `(N, 3)` shape of each image
+        btypes (np.ndarray): `DataType` value of each image
+        boxes (np.ndarray): `(total_boxes, K)` float array of the numeric box items
+        box_offsets (np.ndarray): `(N + 1,)` offsets of the boxes of each image
+        globals (np.ndarray): Structured array with the global items of each image
+        texts (dict): Arrays of string box items (by name)
+    '''
+    def __init__(self, config, images, img_offsets, shapes, btypes, boxes, box_offsets, globals, texts=None):
+        self.config = config
+        self.images = images
+        self.img_offsets = img_offsets
+        self.shapes = shapes
+        self.btypes = btypes
+        self.boxes = boxes
+        self.box_offsets = box_offsets
+        self.globals = globals
+        self.texts = texts if texts is not None else {}
+        self._columns, _ = _columns(config["boxes"])
+
+    def __len__(self):
+        return len(self.btypes)
+
+    def stacked(self):
+        '''Retrieves all images as `(N, H, W, C)` array (only if all images have the same shape).'''
+        if len(self) == 0 or np.any(self.shapes != self.shapes[0]):
+            raise ValueError("Images have different shapes and can not be stacked!")
+        return self.images.reshape([len(self)] + list(self.shapes[0]))
+
+    def image(self, id):
+        '''Retrieves the image (as view into the buffer).'''
+        return self.images[self.img_offsets[id]:self.img_offsets[id + 1]].reshape(self.shapes[id])
+
+    def box_array(self, id):
+        '''Retrieves the numeric box items of the image as `(num_boxes, K)` array (view).'''
+        return self.boxes[self.box_offsets[id]:self.box_offsets[id + 1]]
+
+    def __getitem__(self, id):
+        '''Retrieves the sample as `(img, global, metadata, DataType)`.
+
+        Note: The image is a copy, so consumers that modify it in place (e.g. `utils.gen_negative`) do not change
+        the dataset for later passes (use `image` for a view into the buffer).
+        '''
+        # decode the global data
+        gdata = {}
+        for item in self.config["global"]:
+            value = self.globals[item["name"]][id]
+            gdata[item["name"]] = value.item() if _is_text(item) else _decode(np.asarray(value, dtype=np.float64).reshape(-1), item)
+
+        # decode the boxes
+        start, end = self.box_offsets[id], self.box_offsets[id + 1]
+        bbs = self.boxes[start:end]
+        mdata = []
+        for i in range(end - start):
+            meta = {}
+            for item, cstart, cend in self._columns:
+                meta[item["name"]] = _decode(bbs[i, cstart:cend], item)
+            for name, text in self.texts.items():
+                meta[name] = str(text[start + i])
+            mdata.append(meta)
+
+        return self.image(id).copy(), gdata, mdata, utils.DataType(int(self.btypes[id]))
+
+    def __iter__(self):
+        for id in range(len(self)):
+            yield self[id]
+
+    def view(self, fct=None, shuffle=False, rng=None):
+        '''Creates an iterable over the dataset that converts each sample with the given function.'''
+        return MemoryView(self, fct, shuffle, rng)
+
+    def save(self, folder, key=None):
+        '''Stores the arrays as `.npy` files in the folder (`key` describes the loading parameters, see `materialize`).'''
+        os.makedirs(folder, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(folder, name + '.npy'), getattr(self, name))
+        for name, text in self.texts.items():
+            np.save(os.path.join(folder, 'text_{}.npy'.format(name)), text)
+        with open(os.path.join(folder, META_FILE), 'w') as f:
+            json.dump({"config": self.config, "texts": list(self.texts.keys()), "key": key}, f)
+
+class MemoryView(object):
+    '''Iterable over a `MemoryDataset` that converts the samples into the output format of a loader.
+
+    Args:
+        data (MemoryDataset): Dataset to iterate
+        fct (fct): Function that converts the `(img, global, metadata, DataType)` tuples (None to keep them)
+        shuffle (bool): Iterates the samples in a new random order on each pass
+        rng (RNG): Generator of the shuffling (default generator if None, see `utils.get_rng`)
+    '''
+    def __init__(self, data, fct=None, shuffle=False, rng=None):
+        self.data = data
+        self.fct = fct
+        self.shuffle = shuffle
+        self.rng = rng
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, id):
+        sample = self.data[id]
+        return sample if self.fct is None else self.fct(sample)
+
+    def __iter__(self):
+        order = utils.get_rng(self.rng).permutation(len(self.data)) if self.shuffle else range(len(self.data))
+        for id in order:
+            yield self[id]
+
+#--------------------------------------------------------------------------------------------------
+# PUBLIC FUNCTIONS
+
+def build(gen, config):
+    '''Materializes a beard-style generator (with btype) into a `MemoryDataset`.
+
+    Args:
+        gen (Generator): Generator that returns tuples of `(img, global, metadata, DataType)`
+        config (dict): beard-style config of the samples
+
+    Returns:
+        data (MemoryDataset): Dataset in contiguous arrays
+    '''
+    columns, width = _columns(config["boxes"])
+    text_items = [item for item in config["boxes"] if _is_text(item)]
+
+    imgs, shapes, btypes = [], [], []
+    rows, counts, texts = [], [], {item["name"]: [] for item in text_items}
+    gdatas = []
+    for img, gdata, mdata, btype in gen:
+        img = np.asarray(img).astype(np.uint8, copy=False)
+        img = img.reshape(img.shape[0], img.shape[1], -1)
+        imgs.append(img.reshape(-1))
+        shapes.append(img.shape)
+        btypes.append(btype.value)
+        gdatas.append(gdata)
+
+        # encode the boxes
+        for meta in mdata:
+            row = []
+            for item, _, _ in columns:
+                row += _encode(meta.get(item["name"], None), item)
+            rows.append(row)
+            for item in text_items:
+                texts[item["name"]].append(str(meta.get(item["name"], "")))
+        counts.append(len(mdata))
+
+    # generate the global data as structured array
+    fields = []
+    for item in config["global"]:
+        if _is_text(item):
+            fields.append((item["name"], 'U{}'.format(max([1] + [len(str(x.get(item["name"], ""))) for x in gdatas]))))
+        else:
+            fields.append((item["name"], np.float64, (_item_width(item),)))
+    globs = np.zeros([len(gdatas)], dtype=fields)
+    for i, gdata in enumerate(gdatas):
+        for item in config["global"]:
+            value = gdata.get(item["name"], None)
+            globs[item["name"]][i] = str(value) if _is_text(item) else _encode(value, item)
+
+    # concatenate the arrays
+    sizes = [len(x) for x in imgs]
+    images = np.concatenate(imgs) if len(imgs) > 0 else np.zeros([0], dtype=np.uint8)
+    img_offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    box_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    boxes = np.array(rows, dtype=np.float64).reshape(len(rows), width)
+    shapes = np.array(shapes, dtype=np.int64).reshape(-1, 3)
+    texts = {name: np.array(values, dtype=str) for name, values in texts.items()}
+    return MemoryDataset(config, images, img_offsets, shapes, np.array(btypes, dtype=np.int8), boxes, box_offsets, globs, texts)
+
+def load(folder, mmap=True):
+    '''Loads a stored `MemoryDataset` (memory mapped by default).'''
+    path = os.path.join(folder, META_FILE)
+    if not os.path.exists(path):
+        raise IOError("Cannot find the in-memory dataset ({})!".format(path))
+    with open(path) as f:
+        meta = json.load(f)
+
+    mode = 'r' if mmap else None
+    arrays = [np.load(os.path.join(folder, name + '.npy'), mmap_mode=mode) for name in ARRAYS]
+    texts = {name: np.load(os.path.join(folder, 'text_{}.npy'.format(name)), mmap_mode=mode) for name in meta["texts"]}
+    return MemoryDataset(meta["config"], *arrays, texts=texts)
+
+def materialize(gen, config, cache=None, key=None, debug=False):
+    '''Materializes the generator (or loads the stored dataset from the cache folder).
+
+    Note: Changes of the dataset itself are not detected, delete the cache folder to rebuild it.
+
+    Args:
+        gen (Generator): beard-style generator (with btype), only consumed if the cache is missing or outdated
+        config (dict): beard-style config of the samples
+        cache (str): Folder to store the arrays (None or True to keep them only in memory)
+        key (dict): json-serializable parameters of the loader, the cache is rebuild if they change
+
+    Returns:
+        data (MemoryDataset): Dataset in contiguous arrays
+    '''
+    cache = cache if isinstance(cache, str) else None
+    if cache is not None and os.path.exists(os.path.join(cache, META_FILE)):
+        with open(os.path.join(cache, META_FILE)) as f:
+            valid = json.load(f)["key"] == key
+        if valid:
+            if debug: print("Loaded in-memory dataset from {}".format(cache))
+            return load(cache)
+
+    data = build(gen, config)
+    if cache is not None:
+        data.save(cache, key)
+        if debug: print("Stored in-memory dataset in {}".format(cache))
+    return data
+
+def _key_value(value):
+    '''Converts a loader parameter into a json-serializable value.'''
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, (list, tuple)):
+        return [_key_value(x) for x in value]
+    if isinstance(value, dict):
+        return {str(k): _key_value(v) for k, v in value.items()}
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value if isinstance(value, (str, int, float, bool, type(None))) else type(value).__name__
+
+def loader_key(folder, **kwargs):
+    '''Generates the cache key of a loader from its parameters.'''
+    key = {name: _key_value(value) for name, value in kwargs.items()}
+    key["folder"] = os.path.abspath(folder)
+    return json.loads(json.dumps(key))
@@ -0,0 +1,197 @@
+'''Distributed sharding of datasets across ranks (nodes or processes) and their loader workers.
+
+The files are assigned at the file-list level before any image is read, so every rank only reads its own part
+of the dataset. The assignment is deterministic for a given seed and epoch (all ranks compute the same
+partition without communication) and can be balanced by the byte size of the images or the number of boxes
+in the label files, so that no rank becomes the straggler.
+
+author: Felix Geilert
+'''
+
+import numpy as np
+import os
+import heapq
+from . import utils
+
+
+# supported balancing modes
+BALANCE = [None, "bytes", "boxes"]
+# supported modes to equalize the number of items per rank
+EQUAL = [None, "pad", "drop"]
+# relative width of the weight groups that are shuffled for the balancing (see `assign`)
+GROUP_WIDTH = 0.1
+
+#--------------------------------------------------------------------------------------------------
+# HELPER FUNCTIONS
+
+def _count_lines(path):
+    '''Counts the non-empty lines of a label file (i.e. the number of boxes plus the global line).'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    return max(1, sum(1 for line in data.split(b'\n') if line.strip()))
+
+def file_weight(file, balance=None):
+    '''Computes the cost of a single `(img_path, label, btype)` tuple for the balancing.
+
+    Args:
+        balance (str): One of `BALANCE` (`bytes` - size of the image file, `boxes` - lines of the label file)
+    '''
+    if balance == "bytes":
+        return float(os.path.getsize(file[0]))
+    if balance == "boxes":
+        label = file[1] if len(file) > 2 else None
+        return float(_count_lines(label)) if isinstance(label, str) and os.path.isfile(label) else 1.0
+    return 1.0
+
+def assign(weights, world_size, shuffle=True, seed=0, epoch=0):
+    '''Assigns the items to the ranks.
+
+    Without weights the (shuffled) items are distributed round robin, otherwise greedy by decreasing weight to
+    the rank with the lowest load (longest processing time first). The items are ordered by groups of similar
+    weight (`GROUP_WIDTH`) and shuffled inside the groups, so the assignment changes with the epoch.
+
+    Note: The balancing equalizes the load, so the ranks get different numbers of items (see `Sharding.equal`).
+
+    Args:
+        weights (np.ndarray): Cost of each item
+        world_size (int): Number of ranks
+        shuffle (bool): Shuffles the items (same order on all ranks for the same seed and epoch)
+
+    Returns:
+        order (np.ndarray): Shuffled indices of the items
+        ranks (np.ndarray): Rank of each item in `order`
+    '''
+    count = len(weights)
+    order = utils.RNG(seed).stream(epoch, "shard").permutation(count) if shuffle else np.arange(count)
+    if count == 0 or np.all(weights == weights[0]):
+        return order, np.arange(count) % world_size
+
+    # greedy balancing (note: ties are resolved by the rank id, so the result is deterministic)
+    weights = np.asarray(weights, dtype=np.float64)[order]
+    groups = np.floor(np.log(np.maximum(weights, 1e-12)) / np.log(1.0 + GROUP_WIDTH))
+    ranks = np.empty([count], dtype=np.int64)
+    loads = [(0.0, rank) for rank in range(world_size)]
+    for id in np.argsort(-groups, kind='stable'):
+        load, rank = heapq.heappop(loads)
+        ranks[id] = rank
+        heapq.heappush(loads, (load + weights[id], rank))
+    return order, ranks
+
+#--------------------------------------------------------------------------------------------------
+# SHARDING
+
+class Sharding(object):
+    '''Defines the part of the dataset that is loaded by a rank (and a worker of the rank).
+
+    Call `set_epoch` before each epoch to reshuffle the assignment (the loaders select the files lazily when
+    the generator starts).
+
+    Args:
+        rank (int): Id of the current rank
+        world_size (int): Number of ranks
+        worker (int): Id of the loader worker inside the rank (sub-shard)
+        workers (int): Number of loader workers per rank
+        shuffle (bool): Reshuffles the assignment (and the order) for each epoch
+        seed (int): Seed of the shuffling (has to be equal on all ranks)
+        epoch (int): Current epoch
+        balance (str): Balancing of the ranks (one of `BALANCE`), note that the ranks get different numbers of items
+        equal (str): Equalizes the number of items of the ranks (one of `EQUAL`, e.g. for distributed training that
+            expects the same number of steps on all ranks): `pad` repeats items of the rank, `drop` skips the surplus
+    '''
+    def __init__(self, rank=0, world_size=1, worker=0, workers=1, shuffle=True, seed=0, epoch=0, balance=None, equal=None):
+        # safty: check the values
+        if not 0 <= rank < world_size:
+            raise ValueError("Rank ({}) has to be in [0, {})".format(rank, world_size))
+        if not 0 <= worker < workers:
+            raise ValueError("Worker ({}) has to be in [0, {})".format(worker, workers))
+        if balance not in BALANCE:
+            raise ValueError("Unkown balance mode ({}), expected one of {}".format(balance, BALANCE))
+        if equal not in EQUAL:
+            raise ValueError("Unkown equal mode ({}), expected one of {}".format(equal, EQUAL))
+        self.rank = rank
+        self.world_size = world_size
+        self.worker = worker
+        self.workers = workers
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = epoch
+        self.balance = balance
+        self.equal = equal
+        self._weights = {}
+
+    @staticmethod
+    def from_env(worker=0, workers=1, **kwargs):
+        '''Creates the sharding from the `RANK` and `WORLD_SIZE` environment variables (as set by torchrun or mpirun).'''
+        rank = int(os.environ.get("RANK", os.environ.get("OMPI_COMM_WORLD_RANK", 0)))
+        world_size = int(os.environ.get("WORLD_SIZE", os.environ.get("OMPI_COMM_WORLD_SIZE", 1)))
+        return Sharding(rank, world_size, worker, workers, **kwargs)
+
+    def set_epoch(self, epoch):
+        '''Sets the epoch for the next selection.'''
+        self.epoch = epoch
+
+    def weights(self, files):
+        '''Retrieves the (cached) balancing weights of the files (equal weights without balancing).'''
+        if self.balance is None:
+            return np.ones([len(files)], dtype=np.float64)
+        out = np.empty([len(files)], dtype=np.float64)
+        for i, file in enumerate(files):
+            key = (file[0], self.balance)
+            if key not in self._weights:
+                self._weights[key] = file_weight(file, self.balance)
+            out[i] = self._weights[key]
+        return out
+
+    def indices(self, weights):
+        '''Selects the items of the rank and worker.
+
+        Args:
+            weights (np.ndarray): Cost of each item (the items have to be in the same order on all ranks)
+
+        Returns:
+            ids (np.ndarray): Indices of the selected items (in shuffled order if `shuffle` is set)
+        '''
+        weights = np.asarray(weights, dtype=np.float64)
+        order, ranks = assign(weights, self.world_size, self.shuffle, self.seed, self.epoch)
+        ids = order[ranks == self.rank]
+
+        # equalize the number of items of the ranks
+        if self.equal is not None and len(order) > 0:
+            counts = np.bincount(ranks, minlength=self.world_size)
+            if self.equal == "drop":
+                ids = ids[:counts.min()]
+            elif len(ids) < counts.max():
+                ids = np.resize(ids if len(ids) > 0 else order, counts.max())
+
+        # split the items of the rank among the workers (already shuffled)
+        if self.workers > 1:
+            _, workers = assign(weights[ids], self.workers, False)
+            ids = ids[workers == self.worker]
+        return ids
+
+    def select(self, files):
+        '''Selects the files of the rank and worker.
+
+        Args:
+            files (list): List of tuples `(img_path, label, btype)` (sorted by path, so the file system order does not matter)
+
+        Returns:
+            files (list): Files of the shard (in shuffled order if `shuffle` is set)
+        '''
+        files = sorted(files, key=lambda x: x[0])
+        return [files[i] for i in self.indices(self.weights(files))]
+
+    def stream(self, items):
+        '''Selects the items of the rank and worker from a stream (round robin, e.g. for archives that can only be read sequentially).
+
+        Note: The stream is neither shuffled nor balanced, all ranks have to iterate the items in the same order.
+        '''
+        count = self.world_size * self.workers
+        id = self.rank * self.workers + self.worker
+        for i, item in enumerate(items):
+            if i % count == id:
+                yield item
+
+    def key(self):
+        '''Retrieves a json-serializable description (e.g. for the cache key of `memory.loader_key`).'''
+        return [self.rank, self.world_size, self.worker, self.workers, self.shuffle, self.seed, self.epoch, self.balance, self.equal]
@@ -0,0 +1,133 @@
+'''Image statistics of datasets (per-channel mean/std and per-image means).
+
+The statistics are computed in parallel in a single pass over the images and cached in a sidecar file next
+to the dataset, so only new or changed images are decoded again. The cached values can be used for padding
+(`ResizeMode.PAD_MEAN`), filling (`FillMode.MEAN`) and the normalization of the images.
+
+author: Felix Geilert
+'''
+
+import numpy as np
+import os
+import multiprocessing
+from . import utils
+from . import convert
+
+
+# note: hidden file, so the default config search (`*.json`) does not find it
+STATS_FILE = '.image_stats.json'
+
+#--------------------------------------------------------------------------------------------------
+# STATISTICS
+
+def _image_stats(img_path):
+    '''Computes the statistics of a single image (executed inside the worker processes).
+
+    Returns:
+        shape (list): `[HEIGHT, WIDTH]` of the image
+        mean (list): Mean of each channel
+        sqmean (list): Mean of the squared values of each channel (to combine the std of multiple images)
+    '''
+    img = utils.imread(img_path)
+    img = img.reshape(img.shape[0], img.shape[1], -1)
+    pixels = img.reshape(-1, img.shape[2]).astype(np.float64)
+    return [img.shape[0], img.shape[1]], np.mean(pixels, axis=0).tolist(), np.mean(pixels ** 2, axis=0).tolist()
+
+class ImageStats(object):
+    '''Statistics of the images of a dataset.
+
+    Attributes:
+        files (list): Image paths
+        shapes (np.ndarray): `(N, 2)` array of the `(height, width)` of each image
+        means (np.ndarray): `(N, C)` array of the mean color of each image
+        mean (np.ndarray): Mean of each channel over all pixels of the dataset
+        std (np.ndarray): Standard deviation of each channel over all pixels of the dataset
+    '''
+    def __init__(self, files, shapes, means, sqmeans):
+        self.files = list(files)
+        self.shapes = np.asarray(shapes, dtype=np.int64).reshape(-1, 2)
+        self.means = np.asarray(means, dtype=np.float64).reshape(len(self.files), -1) if len(self.files) > 0 else np.zeros([0, 3])
+        self._ids = {os.path.abspath(x): i for i, x in enumerate(self.files)}
+
+        # combine the images (weighted by the number of pixels)
+        counts = self.shapes[:, 0] * self.shapes[:, 1]
+        total = max(1, counts.sum())
+        sqmeans = np.asarray(sqmeans, dtype=np.float64).reshape(self.means.shape)
+        self.mean = np.sum(self.means * counts[:, None], axis=0) / total
+        self.std = np.sqrt(np.maximum(np.sum(sqmeans * counts[:, None], axis=0) / total - self.mean ** 2, 0))
+
+    def __len__(self):
+        return len(self.files)
+
+    def image_mean(self, img_path, default=None):
+        '''Retrieves the mean color of the image (`default` if the image is not part of the stats).'''
+        id = self._ids.get(os.path.abspath(img_path), None)
+        return default if id is None else self.means[id]
+
+    def normalize(self, img):
+        '''Normalizes the image with the mean and std of the dataset.
+
+        Returns:
+            img (np.ndarray): float32 array with zero mean and unit variance (per channel)
+        '''
+        return ((img - self.mean) / np.maximum(self.std, 1e-6)).astype(np.float32)
+
+    def denormalize(self, img):
+        '''Reverts `normalize` (output is converted back to uint8).'''
+        return np.clip(np.round(img * np.maximum(self.std, 1e-6) + self.mean), 0, 255).astype(np.uint8)
+
+def compute(folder, fmt="beard", only=None, classes=None, workers=None, update=True, json_name="*.json", debug=False):
+    '''Computes the image statistics of the dataset (using the sidecar cache).
+
+    Args:
+        folder (str): Folder of the dataset
+        fmt (str): Format of the dataset (one of `convert.FORMATS`)
+        only (list): List of `DataType` to limit the statistics (e.g. only training data for normalization)
+        workers (int): Number of worker processes (default: number of cpus)
+        update (bool): Defines if the sidecar file should be updated with new or changed images
+
+    Returns:
+        stats (ImageStats): Statistics of the selected images
+    '''
+    _, files = convert._list_source(folder, fmt, only, classes, json_name, debug)
+
+    # load the cache
+    path = os.path.join(folder, STATS_FILE)
+    sidecar = utils.read_sidecar(path) or {"files": {}}
+    cache = sidecar["files"]
+
+    # find all files that require decoding
+    names = [os.path.relpath(x[0], folder) for x in files]
+    keys = [utils.file_key(x[0]) for x in files]
+    todo = [i for i, name in enumerate(names) if name not in cache or cache[name][0] != keys[i]]
+
+    # compute the stats
+    tasks = [files[i][0] for i in todo]
+    workers = workers if workers is not None else multiprocessing.cpu_count()
+    if workers <= 1 or len(tasks) <= 1:
+        results = [_image_stats(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_image_stats, tasks, chunksize=64)
+    for i, (shape, mean, sqmean) in zip(todo, results):
+        cache[names[i]] = [keys[i], shape, mean, sqmean]
+
+    # update the cache
+    if update and len(todo) > 0:
+        utils.write_sidecar(path, sidecar)
+        if debug: print("Computed stats of {} images in {}".format(len(todo), folder))
+
+    entries = [cache[name] for name in names]
+    return ImageStats([x[0] for x in files], [x[1] for x in entries], [x[2] for x in entries], [x[3] for x in entries])
+
+#--------------------------------------------------------------------------------------------------
+# GENERATORS
+
+def normalize(gen, stats):
+    '''Normalizes the images of a generator (any tuple format with the image as first element).
+
+    Returns:
+        gen (Generator): Generator with float32 images (see `ImageStats.normalize`)
+    '''
+    for sample in gen:
+        yield (stats.normalize(sample[0]),) + tuple(sample[1:])
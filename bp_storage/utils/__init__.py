@@ -1,4 +1,10 @@
 from . import const
 from .common import *
+from .rng import *
 from .images import *
 from .datasets import *
+from . import boxes
+from . import classes
+from .transform import *
+from .writer import *
+from .profiling import *
@@ -0,0 +1,172 @@
+'''Vectorized operations on arrays of bounding boxes.
+
+All functions work on `(N, 4)` arrays. Unless stated otherwise boxes are expected in absolute coordinates,
+i.e. `[TOP, LEFT, BOTTOM, RIGHT]` for `y-x` order and `[LEFT, TOP, RIGHT, BOTTOM]` for `x-y` order.
+'''
+
+import numpy as np
+
+
+def _as_boxes(bbs):
+    '''Converts the input into a `(N, 4)` array.'''
+    bbs = np.asarray(bbs)
+    return bbs.reshape(-1, 4)
+
+def area(bbs):
+    '''Computes the area of each box (negative sizes count as zero).'''
+    bbs = _as_boxes(bbs)
+    return np.maximum(bbs[:, 2] - bbs[:, 0], 0) * np.maximum(bbs[:, 3] - bbs[:, 1], 0)
+
+def iou(a, b):
+    '''Computes the pairwise intersection over union of two sets of boxes.
+
+    Args:
+        a (np.ndarray): `(N, 4)` array of boxes
+        b (np.ndarray): `(M, 4)` array of boxes (same order as `a`)
+
+    Returns:
+        iou (np.ndarray): `(N, M)` float array of the iou values
+    '''
+    a = _as_boxes(a).astype(np.float32)
+    b = _as_boxes(b).astype(np.float32)
+
+    # compute the intersection (separately for each dimension to avoid `(N, M, 2)` temporaries)
+    inter = np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])
+    np.maximum(inter, 0, out=inter)
+    width = np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])
+    np.maximum(width, 0, out=width)
+    inter *= width
+
+    # compute the union
+    union = area(a)[:, None] + area(b)[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+def clip(bbs, shape, order="y-x"):
+    '''Clips the boxes to the image.
+
+    Args:
+        bbs (np.ndarray): `(N, 4)` array of absolute boxes
+        shape (tuple): Shape of the image as `(height, width)`
+        order (str): Order of the coordinates (`y-x` or `x-y`)
+    '''
+    bbs = _as_boxes(bbs)
+    size = (shape[0], shape[1]) if order == "y-x" else (shape[1], shape[0])
+    return np.clip(bbs, 0, np.array([size[0], size[1], size[0], size[1]], dtype=bbs.dtype))
+
+def filter_size(bbs, min_size=1, min_area=0):
+    '''Generates a mask of all boxes that have at least the given size in both dimensions and the given area.
+
+    Returns:
+        mask (np.ndarray): Boolean array that is True for all valid boxes (use `bbs[mask]` to filter)
+    '''
+    bbs = _as_boxes(bbs)
+    size = bbs[:, 2:] - bbs[:, :2]
+    return np.all(size >= min_size, axis=1) & (area(bbs) >= min_area)
+
+def convert(bbs, src_type="absolute", src_order="y-x", dst_type="absolute", dst_order="y-x"):
+    '''Converts boxes between the `bb_type` (`absolute` or `relative`) and `order` (`y-x` or `x-y`) formats.
+
+    Relative boxes are stored as `[TOP, LEFT, HEIGHT, WIDTH]` (respectively `[LEFT, TOP, WIDTH, HEIGHT]` for `x-y`).
+    '''
+    bbs = np.array(_as_boxes(bbs))
+    # convert to absolute
+    if src_type.lower() == "relative":
+        bbs[:, 2:] += bbs[:, :2]
+    # switch the order
+    if src_order != dst_order:
+        bbs = bbs[:, [1, 0, 3, 2]]
+    # convert to relative
+    if dst_type.lower() == "relative":
+        bbs[:, 2:] -= bbs[:, :2]
+    return bbs
+
+def from_item(bbs, item):
+    '''Converts boxes stored in the format of the config item to absolute `y-x` boxes.'''
+    return convert(bbs, item["bb_type"], item["order"], "absolute", "y-x")
+
+def to_item(bbs, item):
+    '''Converts absolute `y-x` boxes to the format of the config item.'''
+    return convert(bbs, "absolute", "y-x", item["bb_type"], item["order"])
+
+def transform(bbs, scale, offset, item):
+    '''Applies the scale and offset (as provided by `resize`) to boxes in the format of the config item.
+
+    Args:
+        bbs (np.ndarray): `(N, 4)` array of boxes
+        scale (tuple): Scale of the image in `y-x` order
+        offset (tuple): Offset of the image in `y-x` order
+        item (dict): Config item that defines `bb_type` and `order` of the boxes
+
+    Returns:
+        bbs (np.ndarray): `(N, 4)` float array of transformed boxes in the same format
+    '''
+    bbs = _as_boxes(bbs).astype(np.float64)
+    # switch, as scale and offset are always given in y-x format
+    if item["order"] == "x-y":
+        scale, offset = (scale[1], scale[0]), (offset[1], offset[0])
+    scale = np.array([scale[0], scale[1], scale[0], scale[1]])
+    # relative boxes only move their origin
+    if item["bb_type"].lower() == "relative":
+        offset = np.array([offset[0], offset[1], 0, 0])
+    else:
+        offset = np.array([offset[0], offset[1], offset[0], offset[1]])
+    return bbs * scale + offset
+
+def warp(bbs, matrix):
+    '''Transforms absolute `y-x` boxes with an affine matrix and returns the enclosing axis aligned boxes.
+
+    Args:
+        bbs (np.ndarray): `(N, 4)` array of absolute boxes in `y-x` order
+        matrix (np.ndarray): `3x3` (or `2x3`) affine matrix that maps `(x, y, 1)` coordinates
+
+    Returns:
+        bbs (np.ndarray): `(N, 4)` float array of the transformed boxes
+    '''
+    bbs = _as_boxes(bbs).astype(np.float64)
+    matrix = np.asarray(matrix, dtype=np.float64)[:2]
+
+    # transform all four corners as (x, y) points
+    xs = bbs[:, [1, 3, 1, 3]]
+    ys = bbs[:, [0, 0, 2, 2]]
+    tx = matrix[0, 0] * xs + matrix[0, 1] * ys + matrix[0, 2]
+    ty = matrix[1, 0] * xs + matrix[1, 1] * ys + matrix[1, 2]
+    return np.stack([ty.min(axis=1), tx.min(axis=1), ty.max(axis=1), tx.max(axis=1)], axis=1)
+
+def nms(bbs, scores, threshold=0.5, block=1024):
+    '''Performs greedy non maximum suppression.
+
+    Boxes are processed in blocks of descending score. The suppression inside a block is solved as fixed point
+    iteration over the iou matrix of the block, so the memory stays at `block * N`.
+
+    Args:
+        bbs (np.ndarray): `(N, 4)` array of absolute boxes
+        scores (np.ndarray): `(N,)` array of scores
+        threshold (float): Boxes with a higher iou than this to a box with higher score are removed
+        block (int): Number of boxes that are processed together
+
+    Returns:
+        keep (np.ndarray): Indices of the remaining boxes (sorted by descending score)
+    '''
+    bbs = _as_boxes(bbs)
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    keep = np.zeros([0], dtype=np.int64)
+
+    for start in range(0, len(order), block):
+        ids = order[start:start + block]
+        # remove all boxes that overlap with already kept boxes
+        if len(keep) > 0:
+            ids = ids[~np.any(iou(bbs[ids], bbs[keep]) > threshold, axis=1)]
+        if len(ids) == 0:
+            continue
+
+        # solve the greedy suppression inside the block (each iteration fixes at least one more element)
+        over = np.tril(iou(bbs[ids], bbs[ids]) > threshold, k=-1)
+        valid = np.ones([len(ids)], dtype=bool)
+        while True:
+            update = ~np.any(over & valid[None, :], axis=1)
+            if np.array_equal(update, valid):
+                break
+            valid = update
+        keep = np.concatenate([keep, ids[valid]])
+
+    return keep
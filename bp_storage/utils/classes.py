@@ -0,0 +1,144 @@
+'''Lookup tables to map the class values of a dataset to output classes.
+
+A `ClassMap` is built once per load and maps class names (case insensitive) or class ids in constant time.
+Remaps allow to merge several source classes into a single output class (e.g. `"Van,Truck->Car"`).
+'''
+
+import numpy as np
+from . import const
+
+
+# name of the unkown class (for `str` enums)
+UNKOWN = "UNKOWN"
+
+def parse_remap(remap):
+    '''Parses the remapping of classes.
+
+    Args:
+        remap (dict): Either dict of `{source: target}`, a string like `"Van,Truck->Car;Tram->Train"` (`→` is
+            also accepted as arrow) or a list of such strings
+
+    Returns:
+        remap (dict): Dict of upper case `{source: target}` names
+    '''
+    if remap is None:
+        return {}
+    if isinstance(remap, dict):
+        return {str(src).upper(): str(dst) for src, dst in remap.items()}
+    if isinstance(remap, str):
+        remap = remap.split(";")
+
+    out = {}
+    for rule in remap:
+        rule = rule.replace("→", "->").strip()
+        if len(rule) == 0:
+            continue
+        if "->" not in rule:
+            raise ValueError("Remap rule ({}) requires the form `source,source->target`!".format(rule))
+        srcs, dst = rule.split("->", 1)
+        for src in srcs.split(","):
+            out[src.strip().upper()] = dst.strip()
+    return out
+
+def remap_classes(classes, remap):
+    '''Generates the output classes of a remap (removes the source classes and adds missing targets).'''
+    remap = parse_remap(remap)
+    targets = set([x.upper() for x in remap.values()])
+    out = [x for x in classes if x.upper() not in remap or x.upper() in targets]
+    for dst in remap.values():
+        if dst.upper() not in [x.upper() for x in out]:
+            out.append(dst)
+    return out
+
+def find_item(items):
+    '''Retrieves the class enum from a list of config items (or None if there is no class).'''
+    for item in items:
+        if item["type"] == "enum" and item["name"] in (const.ITEM_CLASS, "type"):
+            return item
+    return None
+
+class ClassMap(object):
+    '''Maps source class names or ids to the ids of the output classes.
+
+    Args:
+        classes (list): Output classes
+        remap (dict): Additional source classes that are mapped to output classes (see `parse_remap`)
+        default (str): Output class for unkown values (None to mark them as unkown, i.e. `-1`)
+    '''
+    def __init__(self, classes, remap=None, default=None):
+        self.classes = list(classes)
+        self.lookup = {}
+        for i, name in enumerate(self.classes):
+            self.lookup.setdefault(str(name).upper(), i)
+        for src, dst in parse_remap(remap).items():
+            if dst.upper() not in self.lookup:
+                raise ValueError("Remap target ({}) is not part of the classes ({})".format(dst, self.classes))
+            self.lookup[src] = self.lookup[dst.upper()]
+        self.default = -1 if default is None else self.lookup[str(default).upper()]
+
+        # note: the additional zero row is used as one-hot vector of unkown classes (id -1)
+        self._eye = np.eye(len(self.classes) + 1, len(self.classes))
+        self._tables = {}
+
+    def __len__(self):
+        return len(self.classes)
+
+    def __contains__(self, name):
+        return str(name).upper() in self.lookup
+
+    def index(self, name):
+        '''Retrieves the output id of the class name (or `default` if unkown).'''
+        return self.lookup.get(name.upper(), self.default)
+
+    def table(self, values):
+        '''Generates (and caches) the array that maps the ids of the given source classes to output ids.'''
+        key = tuple(values)
+        if key not in self._tables:
+            self._tables[key] = np.array([self.index(str(x)) for x in values] + [self.default], dtype=np.int64)
+        return self._tables[key]
+
+    def from_id(self, value, values):
+        '''Maps the id of a source class (from the list of source `values`) to the output id.'''
+        table = self.table(values)
+        return int(table[value]) if 0 <= value < len(values) else self.default
+
+    def name(self, id):
+        '''Retrieves the name of the output id.'''
+        return UNKOWN if id < 0 else self.classes[id]
+
+    def one_hot(self, ids):
+        '''Retrieves the one-hot vectors of the ids from the cached identity matrix (unkown ids are all zero).'''
+        # safty: copy the rows, otherwise an inplace change of a label would change the cached matrix
+        return np.take(self._eye, ids, axis=0)
+
+# cache of the maps for the enum values of config items
+_ITEM_MAPS = {}
+
+def from_item(item):
+    '''Retrieves the (cached) map of the values of an enum config item.'''
+    key = tuple(item["values"])
+    cmap = _ITEM_MAPS.get(key, None)
+    if cmap is None:
+        cmap = _ITEM_MAPS[key] = ClassMap(item["values"])
+    return cmap
+
+def create(classes=None, remap=None, values=None, default=None):
+    '''Creates the map for a loader.
+
+    Args:
+        classes (list): Output classes (if None, generated from `values` and `remap`)
+        values (list): Classes of the dataset
+        default (str): Output class for unkown values
+
+    Returns:
+        cmap (ClassMap): Map of the classes (None if neither classes nor remap are given)
+    '''
+    if isinstance(classes, ClassMap):
+        return classes
+    if classes is None and remap is None:
+        return None
+    if classes is None:
+        if values is None:
+            raise ValueError("Expected list of classes or dataset values, but got None!")
+        classes = remap_classes(values, remap)
+    return ClassMap(classes, remap, default)
@@ -2,7 +2,7 @@
 
 
 from enum import Enum
-import os, glob
+import os, glob, json
 
 
 class DataType(Enum):
@@ -31,6 +31,79 @@ class PadMode(Enum):
     EDGE    = 0
     CENTER  = 1
 
+# chroma subsampling of jpeg images (as opencv `IMWRITE_JPEG_SAMPLING_FACTOR` values)
+try:
+    import cv2
+    JPEG_SUBSAMPLING = {"420": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420, "422": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422, "444": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444}
+except (ImportError, AttributeError):
+    JPEG_SUBSAMPLING = {"420": 0x221111, "422": 0x211111, "444": 0x111111}
+
+class Encoding(object):
+    '''Encoding policy of stored images.
+
+    Args:
+        format (str): Image format (`jpg` or `png`)
+        quality (int): jpeg quality between 0 and 100 (None for the default of the backend)
+        subsampling (str): jpeg chroma subsampling (`420`, `422` or `444`, None for the default of the backend)
+        compression (int): png compression level between 0 (uncompressed) and 9 (None for the default of the backend)
+    '''
+    def __init__(self, format="jpg", quality=None, subsampling=None, compression=None):
+        format = format.lower().strip('.')
+        format = "jpg" if format == "jpeg" else format
+        # safty: check the values
+        if format not in ("jpg", "png"):
+            raise ValueError("Unkown image format ({}), expected jpg or png".format(format))
+        if subsampling is not None and str(subsampling) not in JPEG_SUBSAMPLING:
+            raise ValueError("Unkown chroma subsampling ({}), expected one of {}".format(subsampling, list(JPEG_SUBSAMPLING.keys())))
+        self.format = format
+        self.quality = quality
+        self.subsampling = str(subsampling) if subsampling is not None else None
+        self.compression = compression
+
+    @property
+    def ext(self):
+        '''Extension of the image files.'''
+        return '.' + self.format
+
+    @property
+    def name(self):
+        '''Short name of the policy (e.g. `jpg_q90_420` or `png_c0`).'''
+        parts = [self.format]
+        if self.format == "jpg":
+            if self.quality is not None: parts.append("q{}".format(self.quality))
+            if self.subsampling is not None: parts.append(self.subsampling)
+        elif self.compression is not None:
+            parts.append("c{}".format(self.compression))
+        return '_'.join(parts)
+
+    def params(self):
+        '''Retrieves the write parameters as list of opencv flags (`IMWRITE_*`) and values.'''
+        params = []
+        if self.format == "jpg":
+            if self.quality is not None: params += [1, int(self.quality)]
+            if self.subsampling is not None: params += [7, JPEG_SUBSAMPLING[self.subsampling]]
+        elif self.compression is not None:
+            params += [16, int(self.compression)]
+        return params
+
+    def __repr__(self):
+        return "Encoding({})".format(self.name)
+
+def encoding(policy, btype=None):
+    '''Retrieves the `Encoding` of a datatype from the policy.
+
+    Args:
+        policy: Either None (default jpg), a format string, an `Encoding` or a dict of `DataType` to one of these
+        btype (DataType): Datatype of the image
+    '''
+    if isinstance(policy, dict):
+        policy = policy.get(btype, None)
+    if policy is None:
+        return Encoding()
+    if isinstance(policy, str):
+        return Encoding(policy)
+    return policy
+
 def dict_folders():
     '''Returns dict with all folder combinations.'''
     return {
@@ -49,27 +122,52 @@ def only_folders(only):
         folders = {k: v for k, v in folders.items() if k in only}
     return folders
 
+# possible names of the image and label folders
+IMG_FOLDERS = ['image', 'images', 'img', 'imgs']
+LBL_FOLDERS = ['label', 'labels', 'lbl', 'lbls']
+
 def detect_folders(path):
     '''Retrieves the path for the images and labels folders.'''
     img = None
-    for folder in ['image', 'images', 'img', 'imgs']:
+    for folder in IMG_FOLDERS:
         img = os.path.join(path, folder)
         if os.path.exists(img):
             break
 
     lbl = None
-    for folder in ['label', 'labels', 'lbl', 'lbls']:
+    for folder in LBL_FOLDERS:
         lbl = os.path.join(path, folder)
         if os.path.exists(lbl):
             break
 
     return img, lbl
 
+# extensions of the supported images
+IMG_EXTS = (".jpg", ".jpeg", ".png")
+
 def search_imgs(img_dir):
     imgs = []
-    for ext in ("*.jpg", "*.jpeg", "*.png"):
-        imgs += glob.glob(os.path.join(img_dir, ext), recursive=True)
+    for ext in IMG_EXTS:
+        imgs += glob.glob(os.path.join(img_dir, "*" + ext), recursive=True)
     return imgs
 
+def file_key(path):
+    '''Retrieves modification time and size of a file to detect changes (used for incremental sidecar files).'''
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def read_sidecar(path):
+    '''Reads a json sidecar file (returns None if it does not exist).'''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def write_sidecar(path, data):
+    '''Writes a json sidecar file atomically (an interrupted write keeps the old file).'''
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
 def num_imgs(img_dir):
     return len(_search_imgs(img_dir))
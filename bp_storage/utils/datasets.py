@@ -3,8 +3,123 @@
 from .common import *
 from .images import *
 from . import const
+from . import boxes
+from .rng import *
 import numpy as np
-import random
+
+class LazySample(object):
+    '''Sample that decodes the image on the first access of `img` (and keeps it afterwards).
+
+    The labels are available without decoding, so filters (e.g. on the classes of the boxes or the `complexity`)
+    can discard samples before the image is read. The sample also behaves like the tuple `(img, gdata, mdata, btype)`
+    (without `btype` if `show_btype` is False), unpacking it decodes the image.
+
+    Args:
+        load (fct): Function without arguments that decodes (and resizes) the image
+        gdata (dict): Global data of the sample
+        mdata (list): Metadata of the sample (list of dicts)
+        btype (DataType): Split of the sample
+        path (str): Path of the source image file
+        show_btype (bool): Includes the `btype` in the tuple representation
+        label (str): Path of the source label file
+    '''
+    __slots__ = ('_img', '_load', 'gdata', 'mdata', 'btype', 'path', 'show_btype', 'label')
+
+    def __init__(self, load, gdata, mdata, btype=None, path=None, show_btype=True, label=None):
+        self._img = None
+        self._load = load
+        self.gdata = gdata
+        self.mdata = mdata
+        self.btype = btype
+        self.path = path
+        self.show_btype = show_btype
+        self.label = label
+
+    @property
+    def img(self):
+        '''Decoded image (decoded on the first access).'''
+        if self._load is not None:
+            self._img = self._load()
+            self._load = None
+        return self._img
+
+    @img.setter
+    def img(self, img):
+        self._img = img
+        self._load = None
+
+    @property
+    def decoded(self):
+        '''Checks if the image is already decoded.'''
+        return self._load is None
+
+    def __len__(self):
+        return 4 if self.show_btype else 3
+
+    def __getitem__(self, id):
+        # note: only the image element triggers the decoding
+        if isinstance(id, slice):
+            return tuple(self[i] for i in range(len(self))[id])
+        if id < 0:
+            id += len(self)
+        if id == 0:
+            return self.img
+        if 0 < id < len(self):
+            return (None, self.gdata, self.mdata, self.btype)[id]
+        raise IndexError("Sample index out of range ({})".format(id))
+
+    def __iter__(self):
+        return iter(self[:])
+
+def derive_sample(sample, img, gdata, mdata, btype):
+    '''Creates an output sample of a transformation that keeps the source files of a `LazySample` (e.g. for the incremental `beard.store`).
+
+    Returns:
+        sample: Decoded `LazySample` if the input is one, otherwise the tuple `(img, gdata, mdata, btype)`
+    '''
+    if not isinstance(sample, LazySample):
+        return img, gdata, mdata, btype
+    out = LazySample(None, gdata, mdata, btype, sample.path, sample.show_btype, sample.label)
+    out.img = img
+    return out
+
+def stratified_sample(strata, count, rng=None):
+    '''Selects `count` items without replacement, spread evenly over the strata (e.g. the classes of the items).
+
+    Strata with fewer items than their share are taken completely and the rest is distributed over the others.
+
+    Args:
+        strata (list): Stratum of each item (any hashable value)
+        count (int): Number of items to select
+        rng (RNG): Generator of the selection (default generator if None, see `get_rng`)
+
+    Returns:
+        ids (np.ndarray): Indices of the selected items (in random order)
+    '''
+    rng = get_rng(rng)
+    groups = {}
+    for id, key in enumerate(strata):
+        groups.setdefault(key, []).append(id)
+    groups = [np.array(groups[key]) for key in sorted(groups, key=str)]
+    sizes = np.array([len(group) for group in groups], dtype=np.int64)
+
+    # distribute the count over the strata
+    take = np.zeros([len(groups)], dtype=np.int64)
+    remaining = min(int(count), int(sizes.sum()))
+    while remaining > 0:
+        avail = np.where(take < sizes)[0]
+        share = max(1, remaining // len(avail))
+        for group in rng.permutation(avail):
+            add = min(share, sizes[group] - take[group], remaining)
+            take[group] += add
+            remaining -= add
+            if remaining == 0: break
+
+    ids = [rng.choice(group, int(num), replace=False) for group, num in zip(groups, take) if num > 0]
+    if len(ids) == 0:
+        return np.zeros([0], dtype=np.int64)
+    ids = np.concatenate(ids)
+    return ids[rng.permutation(len(ids))]
 
 def set_dtype(value, dtype):
     '''Converts the value to the given dtype.'''
@@ -16,7 +131,7 @@ def set_dtype(value, dtype):
         value = value
     return value
 
-def augment(gen, config, keep=False, stages=None, params=None, meta_udf=None):
+def augment(gen, config, keep=False, stages=None, params=None, meta_udf=None, rng=None):
     '''Augments the dataset if required.
 
     This function pays special respect to objects of type `box-array` to update them according to the transformations.
@@ -32,6 +147,7 @@ def augment(gen, config, keep=False, stages=None, params=None, meta_udf=None):
         keep (bool): Defines if the original image should be preserved
         params (dict): Dict of all relevant elements
         meta_udf (fct): user defined function that allows to update use-case specific metadata. Signature: (mdata, gdata, transform) => (mdata)
+        rng (RNG): Seeds the random state of imgaug (None to use the global state of imgaug)
     '''
     # import relevant libs (do here, to avoid global crash if not installed!)
     import imgaug as ia
@@ -68,17 +184,19 @@ def augment(gen, config, keep=False, stages=None, params=None, meta_udf=None):
             )) )
 
     # create the augmentation model
-    seq = iaa.Sequential(iaa.SomeOf((min(1, len(augs)), None), augs), random_order=True)
+    seed = {} if rng is None else {"random_state": int(rng.randint(0, 2**31 - 1))}
+    seq = iaa.Sequential(iaa.SomeOf((min(1, len(augs)), None), augs), random_order=True, **seed)
 
     # iterate through all data
-    for img, gdata, mdata, btype in gen:
-        # check if stage is augmented
-        if stages is not None and btype not in stages:
-            yield img, gdata, mdata, btype
+    for sample in gen:
+        # check if stage is augmented (note: lazy samples of other stages are not decoded)
+        if stages is not None and sample[3] not in stages:
+            yield sample
             continue
         # output original if keep
         if keep:
-            yield img, gdata, mdata, btype
+            yield sample
+        img, gdata, mdata, btype = sample
         orig = img
 
         # iterate through all images that shall be generated
@@ -129,33 +247,34 @@ def augment(gen, config, keep=False, stages=None, params=None, meta_udf=None):
                 mdata = meta_udf(mdata, gdata, config, params)
 
             # send to gen
-            yield aug_img, gdata, aug_mdata, btype
+            yield derive_sample(sample, aug_img, gdata, aug_mdata, btype)
 
-def merge(gens, shuffle=True, debug=True):
+def merge(gens, shuffle=True, debug=True, rng=None):
     '''Merges multiple given geneators (in beard format).
 
     Args:
         gens (List[Generator]): Generators in Beard format
         shuffle (bool): Defines if the two generators should be shuffled together
+        rng (RNG): Generator for the shuffling (default generator if None, see `get_rng`)
 
     Returns:
-        gen (Generator): Generator in Beard format
+        gen (Generator): Generator in Beard format (the samples are passed on as they are, so lazy samples stay undecoded)
     '''
     # merge the generators
     if not shuffle:
         for gen in gens:
-            for img, gdata, mdata, btype in gen:
-                yield img, gdata, mdata, btype
+            for sample in gen:
+                yield sample
     else:
+        rng = get_rng(rng)
         while len(gens) > 0:
-            id = random.randint(0, len(gens) - 1)
+            id = int(rng.randint(0, len(gens)))
             try:
-                img, gdata, mdata, btype = next(gens[id])
-                yield img, gdata, mdata, btype
+                yield next(gens[id])
             except StopIteration as err:
                 del gens[id]
 
-def gen_negative(gen, mode=FillMode.COLOR, color=(0,0,0), is_rel=True, is_xy=False, scale=0.1, str_boxes=None, str_class=None):
+def gen_negative(gen, mode=FillMode.COLOR, color=(0,0,0), is_rel=True, is_xy=False, scale=0.1, str_boxes=None, str_class=None, mean=None, rng=None):
     '''Converts a beard-style dataset into a negative dataset.
 
     Args:
@@ -163,6 +282,8 @@ def gen_negative(gen, mode=FillMode.COLOR, color=(0,0,0), is_rel=True, is_xy=Fal
         mode (FillMode): The mode in which data should be filled
         color (tuple): Int tuple that defines a fill color (if mode is color)
         str_boxes (str): Name of the config element that contains the boxes
+        mean (list): Precomputed mean color for `FillMode.MEAN` (e.g. `stats.ImageStats.mean`)
+        rng (RNG): Generator of the noise for `FillMode.RANDOM` (default generator if None)
 
     Returns:
         gen (Generator): Beard-Style generator that contains only blacked images
@@ -170,21 +291,25 @@ def gen_negative(gen, mode=FillMode.COLOR, color=(0,0,0), is_rel=True, is_xy=Fal
     # update values
     str_boxes = const.ITEM_BBOX if str_boxes is None else str_boxes
     str_class = const.ITEM_CLASS if str_class is None else str_class
-    # create new generator
-    for img, gdata, mdata, btype in gen:
-        for item in mdata:
-            # retrieve boxes
-            if str_boxes in item:
-                bbox = item[str_boxes]
-                if is_rel:
-                    bbox = [bbox[0], bbox[1], bbox[2] + bbox[0], bbox[3] + bbox[1]]
-                if is_xy:
-                    bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
-                bbox = (np.array(bbox) * np.array([1-scale, 1-scale, 1+scale, 1+scale])).astype(np.int32)
-                img = fill_patch(img, bbox, mode, color)
+    # create new generator (note: lazy samples are only decoded if they contain boxes)
+    for sample in gen:
+        items = [item for item in sample[2] if str_boxes in item]
+        if len(items) > 0:
+            img = sample[0]
+            # convert all boxes to absolute y-x format
+            bbs = boxes.convert([item[str_boxes] for item in items], "relative" if is_rel else "absolute", "x-y" if is_xy else "y-x")
+            bbs = (bbs * np.array([1-scale, 1-scale, 1+scale, 1+scale])).astype(np.int32)
+            for item, bbox in zip(items, bbs):
+                img = fill_patch(img, bbox, mode, color, mean, rng)
                 # replace the element
                 item[str_boxes] = [0,0,0,0]
                 item[str_class] = "DONTCARE"
 
+            # update the image of the sample
+            if isinstance(sample, LazySample):
+                sample.img = img
+            else:
+                sample = (img,) + tuple(sample[1:])
+
         # return data
-        yield img, gdata, mdata, btype
+        yield sample
@@ -2,31 +2,130 @@
 
 
 from .common import *
-import math
+from .rng import *
+import math, struct
+import tempfile
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 
+def _gray(img):
+    '''Converts a BGR(A) uint8 image into a single channel (mean of the color channels, rounded in integers).'''
+    total = img[..., 0].astype(np.uint16 if img.dtype == np.uint8 else np.uint64) + img[..., 1] + img[..., 2]
+    return ((total * 2 + 3) // 6).astype(img.dtype)[..., None]
+
+def _convert_channels(img, channels=3):
+    '''Converts a decoded image (gray or BGR(A) as provided by the backends) into RGB(A) with the given number of channels.
+
+    Args:
+        img (np.ndarray): Decoded image
+        channels (int): Number of output channels (1, 3 or 4), None to keep the channels of the file
+
+    Returns:
+        img (np.ndarray): `(HEIGHT, WIDTH, channels)` uint8 array (no float promotion)
+    '''
+    if len(img.shape) == 2:
+        img = img[..., None]
+    # note: 16 bit files (e.g. png) are decoded unchanged for other than 3 channels, scale them to 8 bit
+    if img.dtype == np.uint16:
+        img = ((img.astype(np.uint32) * 255 + 32767) // 65535).astype(np.uint8)
+    count = img.shape[2]
+    if channels is None:
+        return img[..., [2,1,0] + list(range(3, count))] if count >= 3 else img
+    if channels == 1:
+        # note: gray images with alpha (2 channels) drop the alpha
+        return img if count == 1 else img[..., :1] if count == 2 else _gray(img)
+
+    # expand gray images and add or drop the alpha channel
+    if count == 1:
+        img = np.repeat(img, 3, axis=2)
+    elif count == 2:
+        img = np.concatenate([np.repeat(img[..., :1], 3, axis=2), img[..., 1:]], axis=2)
+    if channels == 3:
+        return img[..., [2,1,0]]
+    if channels == 4:
+        if img.shape[2] == 3:
+            alpha = np.full(img.shape[:2] + (1,), np.iinfo(img.dtype).max if np.issubdtype(img.dtype, np.integer) else 1, dtype=img.dtype)
+            img = np.concatenate([img, alpha], axis=2)
+        return img[..., [2,1,0,3]]
+    raise ValueError("Unsupported number of channels ({}), expected 1, 3 or 4".format(channels))
+
+def fill_color(color, channels):
+    '''Adapts a fill color to the number of channels (mean of the color for gray images, opaque alpha for RGBA).
+
+    Returns:
+        color (np.ndarray): float array with one value per channel
+    '''
+    color = np.atleast_1d(np.asarray(color, dtype=np.float64))
+    if len(color) == channels:
+        return color
+    if len(color) == 1:
+        return np.repeat(color, channels)
+    if channels == 1:
+        return np.round(np.mean(color[:3], keepdims=True))
+    if channels == 4 and len(color) == 3:
+        return np.concatenate([color, [255.0]])
+    return np.resize(color, channels)
+
+def to_bgr(img):
+    '''Converts an RGB(A) or gray image into the channel order of the backends (e.g. before `imwrite`).'''
+    if len(img.shape) < 3 or img.shape[2] < 3:
+        return img
+    return img[..., [2,1,0] + list(range(3, img.shape[2]))]
+
+def _cv2_flags(channels):
+    '''Retrieves the cv2 decode flags for the number of channels.
+
+    Only color images are decoded in color mode, the others keep the channels of the file. The EXIF orientation
+    is ignored for all of them, so the geometry matches the file header (see `imsize`) and the lycon backend.
+    '''
+    import cv2
+    return cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION if channels == 3 else cv2.IMREAD_UNCHANGED
+
+def _cv2_decode(data, channels=3):
+    '''Decodes the encoded bytes in memory with cv2 (BGR(A) or gray as provided by the backend).'''
+    import cv2
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), _cv2_flags(channels))
+    if img is None:
+        raise IOError("Could not decode the image ({} bytes)".format(len(data)))
+    return img
+
 # HANDLE IMAGE LOADING
 try:
     import lycon
 
     # define functions
-    def imwrite(img_path, img):
-        '''Stores image to disk.'''
+    def imwrite(img_path, img, encoding=None):
+        '''Stores image to disk (the format is defined by the extension, `encoding` provides the parameters).'''
         img = np.ascontiguousarray(img, dtype=np.uint8)
-        lycon.save(img_path, img)
+        params = encoding.params() if encoding is not None else []
+        if len(params) > 0:
+            lycon.save(img_path, img, options=params)
+        else:
+            lycon.save(img_path, img)
 
     def imread(img_path, channels=3):
-        '''Loads an image from the given path.'''
-        img = lycon.load(img_path)
-        if channels == 3:
-            img = img[...,[2,1,0]]
-        elif channels == 1:
-            img = np.mean(img, axis=-1, keepdims=True)
-        return img
+        '''Loads an image from the given path as RGB(A) uint8 array with 1, 3 or 4 channels (None to keep the channels of the file).'''
+        return _convert_channels(lycon.load(img_path), channels)
 
     def imresize(img, width, height):
-        return lycon.resize(img, width=width, height=height, interpolation=lycon.Interpolation.LINEAR)
+        out = lycon.resize(img, width=int(width), height=int(height), interpolation=lycon.Interpolation.LINEAR)
+        return out.reshape((int(height), int(width)) + img.shape[2:])
+
+    def imdecode(data, channels=3):
+        '''Decodes an image from the encoded bytes (in memory with cv2 if installed, lycon only reads files).'''
+        try:
+            import cv2
+            return _convert_channels(_cv2_decode(data, channels), channels)
+        except ImportError:
+            pass
+        # fallback: decode a temporary file
+        suffix = '.png' if data[:8] == b'\x89PNG\r\n\x1a\n' else '.jpg'
+        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+            f.write(data)
+            f.flush()
+            return imread(f.name, channels)
 
 except ImportError:
     print("WARNING: Could not find lycon, using cv2 instead!")
@@ -36,24 +135,122 @@ except ImportError:
         raise RuntimeError("storage library requires either cv2 or lycon to be installed!")
 
     # define functions
-    def imwrite(img_path, img):
-        '''Stores image to disk.'''
-        cv2.imwrite(img_path, img)
+    def imwrite(img_path, img, encoding=None):
+        '''Stores image to disk (the format is defined by the extension, `encoding` provides the parameters).'''
+        params = encoding.params() if encoding is not None else []
+        if len(params) > 0:
+            cv2.imwrite(img_path, img, params)
+        else:
+            cv2.imwrite(img_path, img)
 
     def imread(img_path, channels=3):
-        '''Loads an image from the given path.'''
-        img = cv2.imread(img_path, 1)
-        if channels == 3:
-            img = img[...,[2,1,0]]
-        elif channels == 1:
-            img = np.mean(img, axis=-1, keepdims=True)
-        return img
+        '''Loads an image from the given path as RGB(A) uint8 array with 1, 3 or 4 channels (None to keep the channels of the file).'''
+        img = cv2.imread(img_path, _cv2_flags(channels))
+        if img is None:
+            raise IOError("Could not read the image ({})".format(img_path))
+        return _convert_channels(img, channels)
 
     def imresize(img, width, height):
-        return cv2.resize(img, (int(width), int(height)), interpolation=cv2.INTER_LINEAR)
+        # note: cv2 drops the channel axis of single channel images
+        out = cv2.resize(img, (int(width), int(height)), interpolation=cv2.INTER_LINEAR)
+        return out.reshape((int(height), int(width)) + img.shape[2:])
+
+    def imdecode(data, channels=3):
+        '''Decodes an image from the encoded bytes (see `imread`).'''
+        return _convert_channels(_cv2_decode(data, channels), channels)
 
 # ----
 
+def imsize(img_path):
+    '''Reads the size of an image from its file header (without decoding the image).
+
+    Supports png and jpeg files, other files are decoded completely.
+
+    Returns:
+        shape (tuple): Tuple of `(height, width, channels)`
+    '''
+    with open(img_path, 'rb') as f:
+        head = f.read(26)
+        # check for png (IHDR is always the first chunk)
+        if head[:8] == b'\x89PNG\r\n\x1a\n':
+            width, height = struct.unpack('>II', head[16:24])
+            channels = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}.get(head[25], 3)
+            return height, width, channels
+        # check for jpeg (search the start of frame marker)
+        if head[:2] == b'\xff\xd8':
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    break
+                # skip fill bytes and markers without payload
+                if marker[1] == 0xFF:
+                    f.seek(-1, 1)
+                    continue
+                if marker[1] in (0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7):
+                    continue
+                length = struct.unpack('>H', f.read(2))[0]
+                if marker[1] in (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF):
+                    _, height, width, channels = struct.unpack('>BHHB', f.read(6))
+                    return height, width, channels
+                f.seek(length - 2, 1)
+
+    # fallback: decode the image
+    shape = imread(img_path).shape
+    return shape[0], shape[1], shape[2] if len(shape) > 2 else 1
+
+def imwarp(img, matrix, size, mode="constant", color=(0,0,0)):
+    '''Warps the image with an affine matrix (bilinear interpolation).
+
+    Uses cv2 if installed and a numpy implementation otherwise.
+
+    Args:
+        img (np.ndarray): Image array
+        matrix (np.ndarray): `3x3` (or `2x3`) affine matrix that maps pixel centers `(x, y, 1)` of the input to the output
+        size (tuple): Size of the output as `(HEIGHT, WIDTH)`
+        mode (str): Either `constant` (fill with `color`), `edge` (repeat the border pixels) or `random` (uint8 noise)
+            for regions outside the image
+        color (tuple): Fill color for `constant` mode
+        rng (RNG): Generator of the noise for `random` mode (default generator if None, see `get_rng`)
+
+    Returns:
+        img (np.ndarray): Warped image (same dtype as input)
+    '''
+    matrix = np.asarray(matrix, dtype=np.float64)[:2]
+    size = (int(size[0]), int(size[1]))
+    try:
+        import cv2
+        border = cv2.BORDER_REPLICATE if mode == "edge" else cv2.BORDER_CONSTANT
+        channels = img.shape[2] if len(img.shape) > 2 else 1
+        out = cv2.warpAffine(img, matrix, (size[1], size[0]), flags=cv2.INTER_LINEAR, borderMode=border, borderValue=tuple([float(x) for x in fill_color(color, min(channels, 4))]))
+        return out.reshape(size + img.shape[2:])
+    except ImportError:
+        pass
+
+    # compute the source position of all output pixels
+    inv = np.linalg.inv(np.concatenate([matrix, [[0, 0, 1]]], axis=0))
+    ys, xs = np.mgrid[0:size[0], 0:size[1]].astype(np.float64)
+    sx = inv[0, 0] * xs + inv[0, 1] * ys + inv[0, 2]
+    sy = inv[1, 0] * xs + inv[1, 1] * ys + inv[1, 2]
+
+    # bilinear interpolation (with clamped indices)
+    x0 = np.floor(sx).astype(np.int64)
+    y0 = np.floor(sy).astype(np.int64)
+    fx = (sx - x0)[..., None] if len(img.shape) > 2 else sx - x0
+    fy = (sy - y0)[..., None] if len(img.shape) > 2 else sy - y0
+    x0c, x1c = np.clip(x0, 0, img.shape[1] - 1), np.clip(x0 + 1, 0, img.shape[1] - 1)
+    y0c, y1c = np.clip(y0, 0, img.shape[0] - 1), np.clip(y0 + 1, 0, img.shape[0] - 1)
+    src = img.astype(np.float32)
+    out = (src[y0c, x0c] * (1 - fx) + src[y0c, x1c] * fx) * (1 - fy) + (src[y1c, x0c] * (1 - fx) + src[y1c, x1c] * fx) * fy
+
+    # fill the outside region
+    if mode != "edge":
+        outside = (sx < -0.5) | (sy < -0.5) | (sx > img.shape[1] - 0.5) | (sy > img.shape[0] - 0.5)
+        out[outside] = fill_color(color, img.shape[2]) if len(img.shape) > 2 else fill_color(color, 1)[0]
+    if np.issubdtype(img.dtype, np.integer):
+        out = np.clip(np.round(out), np.iinfo(img.dtype).min, np.iinfo(img.dtype).max)
+    return out.astype(img.dtype)
+
 def get_padding(params):
     if "padding" not in params.training:
         raise KeyError("Could not find value 'padding' in 'training'!")
@@ -96,9 +293,14 @@ def imread_resize(img_path, params):
     img, _, _ = resize(img, params.network.input_size, res_mode, pad_color, mode)
     return img
 
-def pad(img, size, resize=ResizeMode.FIT, pad_color=(0,0,0), pad_mode=PadMode.EDGE):
+def pad(img, size, resize=ResizeMode.FIT, pad_color=(0,0,0), pad_mode=PadMode.EDGE, mean=None, rng=None):
     '''Pads an image to a new size.
 
+    Args:
+        mean (list): Precomputed mean color for `ResizeMode.PAD_MEAN` (e.g. from `stats`), otherwise computed from the image
+            (in both cases the padding is filled with the mean color of the entire image)
+        rng (RNG): Generator of the noise for `ResizeMode.PAD_RANDOM` (default generator if None, see `get_rng`)
+
     Returns:
         img (np.array): padded image
         offset (tuple): integer tuple that stores the offset from the upper left corner in format `[TOP, LEFT]`
@@ -117,42 +319,44 @@ def pad(img, size, resize=ResizeMode.FIT, pad_color=(0,0,0), pad_mode=PadMode.ED
 
     # check additional padding modes
     if resize == ResizeMode.PAD_COLOR:
-        img_new = np.stack([np.full(size, col) for col in pad_color], axis=-1)
-        img_new[padding[0][0]:padding[0][0]+img.shape[0], padding[1][0]:padding[1][0]+img.shape[1], :] = img
+        img_new = np.empty([int(size[0]), int(size[1])] + list(img.shape[2:]), dtype=img.dtype)
+        img_new[...] = fill_color(pad_color, img.shape[2]) if len(img.shape) > 2 else fill_color(pad_color, 1)[0]
+        img_new[padding[0][0]:padding[0][0]+img.shape[0], padding[1][0]:padding[1][0]+img.shape[1]] = img
         img = img_new
     elif resize == ResizeMode.PAD_MEAN:
-        mode = "mean"
+        if mean is None:
+            mean = np.mean(img.reshape(img.shape[0], img.shape[1], -1), (0, 1), dtype=np.float64)
+        fill = np.round(fill_color(np.asarray(mean, dtype=np.float64).reshape(-1), img.shape[2] if len(img.shape) > 2 else 1))
+        img_new = np.empty([int(size[0]), int(size[1])] + list(img.shape[2:]), dtype=img.dtype)
+        img_new[...] = fill if len(img.shape) > 2 else fill[0]
+        img_new[padding[0][0]:padding[0][0]+img.shape[0], padding[1][0]:padding[1][0]+img.shape[1]] = img
+        return img_new, (padding[0][0], padding[1][0])
     elif resize == ResizeMode.PAD_EDGE:
         mode = "edge"
     elif resize == ResizeMode.PAD_RANDOM:
-        img_new = np.random.randint(low=0, high=255, size=[size[0], size[1], 3])
-        img_new[padding[0][0]:padding[0][0]+img.shape[0], padding[1][0]:padding[1][0]+img.shape[1], :] = img
+        img_new = np.array(noise([int(size[0]), int(size[1])] + list(img.shape[2:]), rng), dtype=img.dtype)
+        img_new[padding[0][0]:padding[0][0]+img.shape[0], padding[1][0]:padding[1][0]+img.shape[1]] = img
         img = img_new
     else:
         return img, (0, 0)
 
     # update the image
     if resize not in (ResizeMode.PAD_COLOR, ResizeMode.PAD_RANDOM):
-        padding = padding if len(img.shape)>=3 and img.shape[2]>1 else padding[:2]
+        padding = padding[:len(img.shape)]
         img = np.pad(img, padding, mode=mode)
 
     return img, (padding[0][0], padding[1][0])
 
-def resize(img, size=None, resize=ResizeMode.FIT, pad_color=(0,0,0), pad_mode=PadMode.EDGE):
-    '''Resizes the image and provides the scale.
+def resize_shape(shape, size, resize=ResizeMode.FIT):
+    '''Computes the size of the resized image (before padding).
 
     Returns:
-        img (np.array): Array of the image
+        nsize (list): Size of the resized image as `[HEIGHT, WIDTH]`
+        size (tuple): Size of the output image (after padding)
         scale (tuple): Tuple of float values containing the scale of the image in both dimensions
-        offset (tuple): Tuple of int values containing the offset of the image from top left corner (through padding)
     '''
-    # check if valid
-    if size is None:
-        return img, (1.0, 1.0), (0, 0)
-
     # retrieve some params
-    img_size = img.shape[:2]
-    offset = (0, 0)
+    img_size = shape[:2]
     scale = (1.0, 1.0)
 
     # check the type of data
@@ -180,18 +384,197 @@ def resize(img, size=None, resize=ResizeMode.FIT, pad_color=(0,0,0), pad_mode=Pa
     else:
         raise ValueError("Size has unkown type ({}: {})".format(type(size), size))
 
-    # scale image and set padding
-    #img = scipy.misc.imresize(img, frac)
-    nsize = img.shape
+    # compute the new size
     if isinstance(frac, float):
-        nsize = [min(np.ceil(nsize[0] * frac), size[0]), min(np.ceil(nsize[1] * frac), size[1])]
+        nsize = [min(np.ceil(img_size[0] * frac), size[0]), min(np.ceil(img_size[1] * frac), size[1])]
     else:
         nsize = frac
+    return nsize, size, scale
+
+def resize_params(shape, size=None, resize=ResizeMode.FIT, pad_mode=PadMode.EDGE):
+    '''Computes the scale and offset of `resize` from the shape of an image (e.g. from `imsize`) without resizing it.
+
+    Returns:
+        scale (tuple): Tuple of float values containing the scale of the image in both dimensions
+        offset (tuple): Tuple of int values containing the offset of the image from top left corner (through padding)
+    '''
+    if size is None:
+        return (1.0, 1.0), (0, 0)
+    nsize, size, scale = resize_shape(shape, size, resize)
+
+    # note: only the padding modes move the image (see `pad`)
+    offset = (0, 0)
+    if resize not in (ResizeMode.FIT, ResizeMode.STRETCH) and pad_mode == PadMode.CENTER:
+        offset = (math.floor((size[0] - int(nsize[0])) / 2), math.floor((size[1] - int(nsize[1])) / 2))
+    return scale, offset
+
+def resize(img, size=None, resize=ResizeMode.FIT, pad_color=(0,0,0), pad_mode=PadMode.EDGE, mean=None, rng=None):
+    '''Resizes the image and provides the scale (`mean` and `rng` are used for `PAD_MEAN` and `PAD_RANDOM`, see `pad`).
+
+    Returns:
+        img (np.array): Array of the image
+        scale (tuple): Tuple of float values containing the scale of the image in both dimensions
+        offset (tuple): Tuple of int values containing the offset of the image from top left corner (through padding)
+    '''
+    # check if valid
+    if size is None:
+        return img, (1.0, 1.0), (0, 0)
+
+    # scale image and set padding
+    nsize, size, scale = resize_shape(img.shape, size, resize)
     img = imresize(img, width=nsize[1], height=nsize[0])
-    img, offset = pad(img, size, resize, pad_color, pad_mode)
+    img, offset = pad(img, size, resize, pad_color, pad_mode, mean, rng)
 
     return img, scale, offset
 
+def ordered_map(fct, items, workers=4, prefetch=None):
+    '''Applies the function to all items in a thread pool and yields the results in order of the items.
+
+    lycon and cv2 release the GIL while decoding and resizing, so threads scale without the pickling overhead
+    of processes (and also work in environments that should not fork, e.g. notebook kernels). At most `prefetch`
+    items are in flight, errors are raised when the regarding result is reached.
+
+    Args:
+        fct (fct): Function that is applied to each item
+        items (iterable): Items to process (consumed lazily)
+        workers (int): Number of threads (0 or None processes the items sequentially in the calling thread)
+        prefetch (int): Maximal number of items in flight (default: `2 * workers`)
+    '''
+    # safty: sequential processing
+    if workers is None or workers <= 0:
+        for item in items:
+            yield fct(item)
+        return
+
+    prefetch = max(1, prefetch if prefetch is not None else 2 * workers)
+    pool = ThreadPoolExecutor(workers)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(fct, item))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        # cancel outstanding work if the generator is closed early
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+def _imread_resize(img_path, size, res_mode, pad_color, pad_mode, channels):
+    '''Loads and resizes a single image.'''
+    return resize(imread(img_path, channels), size, res_mode, pad_color, pad_mode)
+
+def imread_many(img_paths, size=None, resize=ResizeMode.FIT, pad_color=(0,0,0), pad_mode=PadMode.EDGE, channels=3, workers=4, prefetch=None):
+    '''Loads and resizes the images in a thread pool (see `ordered_map`).
+
+    Returns:
+        gen (Generator): Generator that returns tuples of `(img, scale, offset)` in order of the paths (see `resize`)
+    '''
+    return ordered_map(lambda x: _imread_resize(x, size, resize, pad_color, pad_mode, channels), img_paths, workers, prefetch)
+
+def _out_shape(shape, size=None, resize=ResizeMode.FIT):
+    '''Computes the output size of `resize` (as `(HEIGHT, WIDTH)`) from the shape of the input image.'''
+    if size is None:
+        return int(shape[0]), int(shape[1])
+    nsize, size, _ = resize_shape(shape, size, resize)
+    if resize == ResizeMode.FIT:
+        return int(nsize[0]), int(nsize[1])
+    return int(size[0]), int(size[1])
+
+def _decode_into(imgs, id, img_path, size, res_mode, pad_color, pad_mode, channels, rng):
+    '''Loads and resizes a single image into the given slot of the output array.'''
+    img, scale, offset = resize(imread(img_path, channels), size, res_mode, pad_color, pad_mode, None, rng)
+    img = img.reshape(img.shape[:2] + (-1,))
+    # safty: the slot is sized from the header, which can differ from the decoded image
+    if img.shape != imgs.shape[1:]:
+        raise ValueError("Decoded image has the output size {}, but the header size results in {} ({})".format(img.shape, imgs.shape[1:], img_path))
+    imgs[id] = img
+    return scale, offset
+
+def imread_into(img_paths, size=None, resize=ResizeMode.FIT, pad_color=(0,0,0), pad_mode=PadMode.EDGE, channels=3, workers=4, rng=None):
+    '''Decodes and resizes the images in a thread pool directly into a preallocated array.
+
+    The output size is computed from the image headers (see `imsize`) before decoding, so all images need the
+    same output size (e.g. `size` with a padding or stretch resize mode). A ValueError is raised if a decoded image
+    does not match the size of its header.
+
+    Args:
+        channels (int): Number of channels (see `imread`, None to use the channels of the first file)
+        rng (RNG): Generator of the noise for `PAD_RANDOM` (independent stream per image, see `streams`)
+
+    Returns:
+        imgs (np.ndarray): `(N, HEIGHT, WIDTH, C)` uint8 array
+        scales (list): Scale of each image (see `resize`)
+        offsets (list): Offset of each image (see `resize`)
+    '''
+    shapes = [imsize(img_path) for img_path in img_paths]
+    out_shapes = set([_out_shape(shape, size, resize) for shape in shapes])
+    if len(out_shapes) > 1:
+        raise ValueError("Images have different output sizes ({}), use a size with a padding or stretch resize mode".format(sorted(out_shapes)))
+    height, width = out_shapes.pop() if len(out_shapes) > 0 else (0, 0)
+    channels = channels if channels is not None else (shapes[0][2] if len(shapes) > 0 else 3)
+    imgs = np.empty([len(img_paths), height, width, channels], dtype=np.uint8)
+    sample_rng = streams(rng) if resize == ResizeMode.PAD_RANDOM else lambda id: None
+
+    # note: each thread writes its image into the output array (no list of intermediate images)
+    _load = lambda id: _decode_into(imgs, id, img_paths[id], size, resize, pad_color, pad_mode, channels, sample_rng(id))
+    params = list(ordered_map(_load, range(len(img_paths)), workers))
+    return imgs, [x[0] for x in params], [x[1] for x in params]
+
+def crop_windows(bbs, margin=0.0):
+    '''Computes the crop regions of absolute `y-x` boxes with a context margin (fraction of the box size per side).'''
+    bbs = np.asarray(bbs, dtype=np.float64).reshape(-1, 4)
+    ext = (bbs[:, 2:] - bbs[:, :2]) * margin
+    return np.concatenate([bbs[:, :2] - ext, bbs[:, 2:] + ext], axis=1)
+
+def crop_boxes(img, bbs, size, margin=0.0, mode="constant", color=(0,0,0), rng=None):
+    '''Crops the regions of all boxes and resizes them to a fixed size in a single vectorized gather (bilinear).
+
+    Args:
+        img (np.ndarray): Image array
+        bbs (np.ndarray): `(N, 4)` array of absolute boxes in `y-x` order
+        size (int): Either single int or tuple of ints that defines the size of the crops as `(HEIGHT, WIDTH)`
+        margin (float): Context around the boxes as fraction of the box size per side (see `crop_windows`)
+        mode (str): Either `constant` (fill with `color`), `edge` (repeat the border pixels) or `random` (uint8 noise)
+            for regions outside the image
+        color (tuple): Fill color for `constant` mode
+        rng (RNG): Generator of the noise for `random` mode (default generator if None, see `get_rng`)
+
+    Returns:
+        crops (np.ndarray): `(N, HEIGHT, WIDTH, ...)` array of the crops (same dtype as the image)
+        windows (np.ndarray): `(N, 4)` array of the cropped regions in `y-x` order
+    '''
+    size = (size, size) if isinstance(size, int) else (int(size[0]), int(size[1]))
+    windows = crop_windows(bbs, margin)
+    src = img.reshape(img.shape[0], img.shape[1], -1)
+
+    # compute the source positions of the pixel centers (separable for rows and columns)
+    def _positions(start, end, count, limit):
+        pos = start[:, None] + (np.arange(count) + 0.5)[None, :] * ((end - start) / count)[:, None] - 0.5
+        low = np.floor(pos).astype(np.int64)
+        frac = (pos - low).astype(np.float32)
+        outside = (pos < -0.5) | (pos > limit - 0.5)
+        return np.clip(low, 0, limit - 1), np.clip(low + 1, 0, limit - 1), frac, outside
+    y0, y1, fy, out_y = _positions(windows[:, 0], windows[:, 2], size[0], src.shape[0])
+    x0, x1, fx, out_x = _positions(windows[:, 1], windows[:, 3], size[1], src.shape[1])
+
+    # gather the four neighbours of all crops at once: (N, HEIGHT, WIDTH, C)
+    y0, y1, fy = y0[:, :, None], y1[:, :, None], fy[:, :, None, None]
+    x0, x1, fx = x0[:, None, :], x1[:, None, :], fx[:, None, :, None]
+    top = src[y0, x0].astype(np.float32) * (1 - fx) + src[y0, x1].astype(np.float32) * fx
+    bottom = src[y1, x0].astype(np.float32) * (1 - fx) + src[y1, x1].astype(np.float32) * fx
+    crops = top * (1 - fy) + bottom * fy
+
+    # fill the regions outside of the image
+    if mode != "edge":
+        outside = out_y[:, :, None] | out_x[:, None, :]
+        crops[outside] = noise((int(np.sum(outside)), src.shape[2]), rng) if mode == "random" else fill_color(color, src.shape[2])
+    if np.issubdtype(img.dtype, np.integer):
+        crops = np.clip(np.round(crops), np.iinfo(img.dtype).min, np.iinfo(img.dtype).max)
+    return crops.astype(img.dtype).reshape((len(windows),) + size + img.shape[2:]), windows
+
 def get_spaced_colors(n):
     '''Retrieves n colors distributed over the color space.'''
     max_value = 16581375 #255**3
@@ -200,35 +583,36 @@ def get_spaced_colors(n):
 
     return [(int(i[:2], 16), int(i[2:4], 16), int(i[4:], 16)) for i in colors][:n]
 
-def fill_patch(img, bbox, mode, color):
+def fill_patch(img, bbox, mode, color, mean=None, rng=None):
     '''Fills the given image patch in the given mode.
 
     Args:
         img (np.ndarray): Image array
         bbox (list): Bounding box for the patch in absolute coordinates and yx format
         mode (FillMode): FillMode that is used to fill the item
+        mean (list): Precomputed mean color for `FillMode.MEAN` (e.g. from `stats`), otherwise computed from the image
+        rng (RNG): Generator of the noise for `FillMode.RANDOM` (default generator if None)
     '''
     # safty: check size of the box against image size
     bbox = [max(0, bbox[0]), max(0, bbox[1]), min(img.shape[0], bbox[2]), min(img.shape[1], bbox[3])]
 
+    # note: the patch is broadcasted, so it keeps the dtype and the channels of the image
+    channels = img.shape[2] if len(img.shape) > 2 else 1
     def _gen_patch(color):
-        arr = []
-        for i in range(len(color)):
-            el = np.full([bbox[2] - bbox[0], bbox[3] - bbox[1]], color[i])
-            arr.append(el)
-        return np.stack(arr, axis=-1)
+        color = fill_color(color, channels)
+        return color if len(img.shape) > 2 else color[0]
 
     # generate the element
     if mode == FillMode.MEAN:
-        color = np.mean(img, (0, 1), dtype=np.float)
+        color = np.mean(img.reshape(img.shape[0], img.shape[1], -1), (0, 1), dtype=np.float64) if mean is None else np.asarray(mean).reshape(-1)
         patch = _gen_patch(color)
     elif mode == FillMode.COLOR:
         patch = _gen_patch(color)
     elif mode == FillMode.RANDOM:
-        patch = np.random.randint(0, 255, [bbox[2] - bbox[0], bbox[3] - bbox[1], img.shape[2]])
+        patch = noise([bbox[2] - bbox[0], bbox[3] - bbox[1]] + list(img.shape[2:]), rng)
     else:
         raise ValueError("Unkown value for fillmode ({})".format(mode))
 
-    img[bbox[0]:bbox[2], bbox[1]:bbox[3], :] = patch
+    img[bbox[0]:bbox[2], bbox[1]:bbox[3]] = patch
 
     return img
@@ -0,0 +1,172 @@
+'''Memory instrumentation of the generator stages of a pipeline (opt-in, based on `tracemalloc`).'''
+
+import numpy as np
+import os, sys
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _rss():
+    '''Retrieves the current resident set size of the process in bytes (peak RSS if not available).'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return _maxrss()
+
+def _maxrss():
+    '''Retrieves the peak resident set size of the process in bytes (0 if not available).'''
+    if resource is None:
+        return 0
+    # note: linux reports kilobytes, macos bytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def _arrays(sample):
+    '''Retrieves the image array of a sample (without decoding lazy samples).'''
+    if isinstance(sample, np.ndarray):
+        return [sample]
+    if getattr(sample, 'decoded', True) is False:
+        return []
+    try:
+        img = sample[0]
+    except (TypeError, IndexError, KeyError):
+        return []
+    return [img] if isinstance(img, np.ndarray) else []
+
+class MemoryStats(object):
+    '''Collects the memory usage of generator stages (wrap each stage with `track`).
+
+    The numbers of a stage only contain the memory of its own code: memory of upstream stages that are pulled
+    by a stage (and also wrapped by `track`) is attributed to them. Per stage the following values are stored in `stages`:
+
+    * `samples` - number of yielded samples
+    * `peak` - largest allocation peak of a single sample (bytes above the start of the step, see `tracemalloc`)
+    * `retained` - bytes that are still allocated after the steps (summed, e.g. the yielded arrays)
+    * `rss` - largest change of the resident set size in a single step (bytes)
+    * `peak_rss` - increase of the peak resident set size of the process (bytes, summed)
+    * `bytes`, `max_bytes` - size of the yielded image arrays (summed and largest)
+    * `dtypes` - number of yielded image arrays per dtype
+
+    Note: The allocations of threads (e.g. `workers` of the loaders) are attributed to the stage that is active
+    at that time, use `workers=0` for an exact attribution. The stages have to be consumed by a single thread.
+    Before python 3.9 (no `tracemalloc.reset_peak`) the peaks are only sampled at the stage boundaries, so
+    transient allocations inside a step are not visible.
+
+    Args:
+        verbose (bool): Prints the summary when the outermost stage is exhausted
+        trace (bool): Traces the python and numpy allocations (starts `tracemalloc` if required), otherwise only the RSS is measured
+    '''
+    def __init__(self, verbose=True, trace=True):
+        self.verbose = verbose
+        self.trace = trace
+        self.stages = {}
+        self._stack = []
+        self._started = False
+
+    def _measure(self):
+        '''Retrieves the current and peak traced memory and the current and peak RSS.'''
+        mem, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        # note: without `reset_peak` the peak covers the entire trace, use the current memory instead
+        if not hasattr(tracemalloc, 'reset_peak'):
+            peak = mem
+        return mem, peak, _rss(), _maxrss()
+
+    def _reset_peak(self):
+        '''Resets the peak of the traced memory for the next segment (if supported).'''
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    def _segment(self, frame, peak, maxrss):
+        '''Attributes the peak of the last code segment to the frame (and resets the peak for the next segment).'''
+        frame["peak"] = max(frame["peak"], peak - frame["mem"] - frame["child_mem"])
+        frame["peak_rss"] += max(0, maxrss - frame["seg_maxrss"])
+        self._reset_peak()
+
+    def _enter(self, name):
+        '''Starts the measurement of a step of the stage.'''
+        if len(self._stack) == 0 and self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+        mem, peak, rss, maxrss = self._measure()
+        if len(self._stack) > 0:
+            self._segment(self._stack[-1], peak, maxrss)
+        else:
+            self._reset_peak()
+        self._stack.append({"name": name, "mem": mem, "rss": rss, "seg_maxrss": maxrss, "child_mem": 0, "child_rss": 0, "peak": 0, "peak_rss": 0})
+
+    def _exit(self, sample=None):
+        '''Finishes the measurement of the current step and records it (`sample` is None if the stage is exhausted).'''
+        mem, peak, rss, maxrss = self._measure()
+        frame = self._stack.pop()
+        self._segment(frame, peak, maxrss)
+
+        # note: the memory of the step (including the upstream stages) is excluded from the parent
+        if len(self._stack) > 0:
+            parent = self._stack[-1]
+            parent["child_mem"] += mem - frame["mem"]
+            parent["child_rss"] += rss - frame["rss"]
+            parent["seg_maxrss"] = maxrss
+
+        entry = self.stages.setdefault(frame["name"], {"samples": 0, "peak": 0, "retained": 0, "rss": 0, "peak_rss": 0, "bytes": 0, "max_bytes": 0, "dtypes": {}})
+        entry["peak"] = max(entry["peak"], frame["peak"])
+        entry["retained"] += mem - frame["mem"] - frame["child_mem"]
+        entry["rss"] = max(entry["rss"], rss - frame["rss"] - frame["child_rss"])
+        entry["peak_rss"] += frame["peak_rss"]
+        if sample is None:
+            return
+        entry["samples"] += 1
+        for arr in _arrays(sample):
+            entry["bytes"] += arr.nbytes
+            entry["max_bytes"] = max(entry["max_bytes"], arr.nbytes)
+            entry["dtypes"][str(arr.dtype)] = entry["dtypes"].get(str(arr.dtype), 0) + 1
+
+    def track(self, gen, name):
+        '''Wraps a generator stage and measures each step.
+
+        Args:
+            gen (Generator): Generator of the stage (any iterable)
+            name (str): Name of the stage in the stats
+
+        Returns:
+            gen (Generator): Generator with the same samples
+        '''
+        it = iter(gen)
+        try:
+            while True:
+                self._enter(name)
+                try:
+                    sample = next(it)
+                except StopIteration:
+                    self._exit()
+                    break
+                except BaseException:
+                    self._exit()
+                    raise
+                self._exit(sample)
+                yield sample
+
+            # summary at the exhaustion of the outermost stage
+            if len(self._stack) == 0 and self.verbose:
+                print(self.summary())
+        finally:
+            # note: also stops the tracing if the consumer stops early (closed generator)
+            if len(self._stack) == 0 and self._started:
+                tracemalloc.stop()
+                self._started = False
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def summary(self):
+        '''Generates a text summary of all stages.'''
+        lines = []
+        for name, entry in self.stages.items():
+            count = max(1, entry["samples"])
+            dtypes = ", ".join(["{} x{}".format(k, v) for k, v in entry["dtypes"].items()])
+            lines.append("{}: {} samples, peak {:.2f} MB/sample, retained {:.1f} kB/sample, RSS +{:.1f} MB (max step), peak RSS +{:.1f} MB, arrays {:.1f} kB/sample (max {:.1f} kB{})".format(
+                name, entry["samples"], entry["peak"] / 1e6, entry["retained"] / 1e3 / count, entry["rss"] / 1e6, entry["peak_rss"] / 1e6,
+                entry["bytes"] / 1e3 / count, entry["max_bytes"] / 1e3, ", " + dtypes if len(dtypes) > 0 else ""))
+        return '\n'.join(lines)
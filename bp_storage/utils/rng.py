@@ -0,0 +1,117 @@
+'''Seedable random number generation for the loaders and augmenters (based on `np.random.Generator`).'''
+
+import numpy as np
+import zlib
+
+# note: first spawn key element of the streams (separates them from the children of `spawn`)
+_STREAM_TAG = 0x5354524d
+
+class RNG(object):
+    '''Random number generator with independent streams and direct uint8 noise.
+
+    Provides the subset of the `np.random.RandomState` api that is used in the library (`randint`, `uniform`,
+    `permutation`, `choice`), so it can be passed to all `rng` parameters.
+
+    Args:
+        seed (int): Seed of the generator (None to use the entropy of the os)
+        pool (int): Size (in bytes) of a pre-generated noise pool that is reused by `noise` (0 to draw fresh noise)
+        seq (np.random.SeedSequence): Seed sequence of the generator (overwrites `seed`)
+    '''
+    def __init__(self, seed=None, pool=0, seq=None):
+        self.seq = seq if seq is not None else np.random.SeedSequence(seed)
+        self.generator = np.random.Generator(np.random.PCG64(self.seq))
+        self._pool = None
+        if pool > 0:
+            self._pool = self.generator.integers(0, 256, int(pool), dtype=np.uint8)
+            self._pool.flags.writeable = False
+
+    def _child(self, seq):
+        '''Creates a generator from the seed sequence that shares the noise pool.'''
+        child = RNG(seq=seq)
+        child._pool = self._pool
+        return child
+
+    def spawn(self, count):
+        '''Creates `count` independent generators (each call returns new generators).'''
+        return [self._child(seq) for seq in self.seq.spawn(count)]
+
+    def stream(self, id, domain=None):
+        '''Retrieves the independent generator with the given id (e.g. of a worker process or a sample).
+
+        The stream only depends on the seed, the domain and the id (not on the previous usage of the generator), so
+        parallel workers generate the same numbers regardless of their scheduling. The streams are independent of
+        the generators of `spawn`.
+
+        Args:
+            id (int): Id of the stream
+            domain (str): Name of the user (e.g. `shard`), so different users of the same seed get different streams
+        '''
+        domain = zlib.crc32(domain.encode('utf-8')) if domain is not None else 0
+        return self._child(np.random.SeedSequence(self.seq.entropy, spawn_key=tuple(self.seq.spawn_key) + (_STREAM_TAG, domain, int(id))))
+
+    def noise(self, shape):
+        '''Generates uniform uint8 noise of the given shape.
+
+        Note: Noise from the pool is a read-only view, copy it before modifying it.
+        '''
+        shape = tuple(int(x) for x in np.atleast_1d(shape))
+        count = int(np.prod(shape))
+        if self._pool is None or count > len(self._pool):
+            return self.generator.integers(0, 256, shape, dtype=np.uint8)
+        start = self.generator.integers(0, len(self._pool) - count + 1)
+        return self._pool[start:start + count].reshape(shape)
+
+    def randint(self, low, high=None, size=None):
+        return self.generator.integers(low, high, size)
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return self.generator.uniform(low, high, size)
+
+    def permutation(self, x):
+        return self.generator.permutation(x)
+
+    def choice(self, a, size=None, replace=True, p=None):
+        return self.generator.choice(a, size, replace, p)
+
+# default generator of the library (see `seed_rng`)
+_DEFAULT = None
+
+def seed_rng(seed=None, pool=0):
+    '''Resets the default generator that is used if no `rng` is provided.
+
+    Args:
+        seed (int): Seed of the generator
+        pool (int): Size of the noise pool in bytes (see `RNG`)
+
+    Returns:
+        rng (RNG): The new default generator
+    '''
+    global _DEFAULT
+    _DEFAULT = RNG(seed, pool)
+    return _DEFAULT
+
+def get_rng(rng=None):
+    '''Retrieves the given generator or the default generator of the library (if `rng` is None).'''
+    if rng is not None:
+        return rng
+    if _DEFAULT is None:
+        seed_rng()
+    return _DEFAULT
+
+def streams(rng=None):
+    '''Creates a function that retrieves an independent generator for each id (e.g. the index of a sample).
+
+    Each call draws a new base generator, so repeated passes differ, while the generators of a pass are
+    independent of the order in which threads or processes use them.
+    '''
+    rng = get_rng(rng)
+    if not isinstance(rng, RNG):
+        return lambda id: rng
+    return rng.spawn(1)[0].stream
+
+def noise(shape, rng=None):
+    '''Generates uniform uint8 noise (also supports `np.random.RandomState` as `rng`).'''
+    rng = get_rng(rng)
+    if isinstance(rng, RNG):
+        return rng.noise(shape)
+    return rng.randint(0, 256, size=shape).astype(np.uint8)
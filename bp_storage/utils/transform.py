@@ -0,0 +1,175 @@
+'''Geometric transformations that combine resizing and augmentation into a single warp.
+
+Matrices map continuous `(x, y, 1)` coordinates, where pixel `i` covers `[i, i+1]`, so the same matrix
+is used for the image and the bounding boxes.
+'''
+
+from .common import *
+from .images import *
+from .datasets import *
+from . import boxes
+import numpy as np
+import math
+
+
+def _shift(x, y):
+    '''Generates a translation matrix.'''
+    return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=np.float64)
+
+def resize_matrix(shape, size=None, resize=ResizeMode.FIT, pad_mode=PadMode.EDGE):
+    '''Generates the matrix that resizes (and pads) an image like `resize`.
+
+    Args:
+        shape (tuple): Shape of the input image
+        size (int): Either single int of tuple of ints to indiciate the size of the image (see `resize`)
+
+    Returns:
+        matrix (np.ndarray): `3x3` affine matrix
+        out_size (tuple): Size of the output image as `(HEIGHT, WIDTH)`
+    '''
+    if size is None:
+        return np.eye(3), (shape[0], shape[1])
+    nsize, size, _ = resize_shape(shape, size, resize)
+    nsize = (int(nsize[0]), int(nsize[1]))
+
+    # compute the offset through padding (only for padding modes)
+    offset = (0, 0)
+    out_size = nsize
+    if resize not in (ResizeMode.FIT, ResizeMode.STRETCH):
+        out_size = (int(size[0]), int(size[1]))
+        if pad_mode == PadMode.CENTER:
+            offset = (math.floor((out_size[0] - nsize[0]) / 2), math.floor((out_size[1] - nsize[1]) / 2))
+
+    matrix = np.array([[nsize[1] / shape[1], 0, offset[1]], [0, nsize[0] / shape[0], offset[0]], [0, 0, 1]], dtype=np.float64)
+    return matrix, out_size
+
+def augment_matrix(shape, params, rng=None):
+    '''Samples a geometric augmentation for an image of the given shape.
+
+    Uses the same parameters as `augment`: `flip` (probability), `crop` (max pixels per side), `transform`
+    (probability) with `scale`, `translate`, `rotate` and `shear`. Other augmentations are ignored.
+
+    Returns:
+        matrix (np.ndarray): `3x3` affine matrix
+    '''
+    height, width = shape[0], shape[1]
+    matrix = np.eye(3)
+    if params is None:
+        return matrix
+    rng = get_rng(rng)
+
+    # crop the image and scale back to the original size
+    if 'crop' in params:
+        t, l, b, r = rng.randint(0, params['crop'] + 1, size=4)
+        t, b = min(t, (height - 1) // 2), min(b, (height - 1) // 2)
+        l, r = min(l, (width - 1) // 2), min(r, (width - 1) // 2)
+        crop = np.array([[width / (width - l - r), 0, 0], [0, height / (height - t - b), 0], [0, 0, 1]])
+        matrix = np.dot(np.dot(crop, _shift(-l, -t)), matrix)
+    # flip horizontal
+    if 'flip' in params and rng.uniform(0, 1) < params['flip']:
+        matrix = np.dot(np.array([[-1, 0, width], [0, 1, 0], [0, 0, 1]], dtype=np.float64), matrix)
+    # affine transformation around the image center
+    if 'transform' in params and rng.uniform(0, 1) < params['transform']:
+        shear = math.radians(rng.uniform(-params.get('shear', 0), params.get('shear', 0)))
+        rot = math.radians(rng.uniform(-params.get('rotate', 0), params.get('rotate', 0)))
+        trans = params.get('translate', 0)
+        scale = params.get('scale', (1, 1))
+        sx, sy = rng.uniform(scale[0], scale[1]), rng.uniform(scale[0], scale[1])
+        tx, ty = rng.uniform(-trans, trans) * width, rng.uniform(-trans, trans) * height
+
+        affine = np.array([[math.cos(rot), -math.sin(rot), 0], [math.sin(rot), math.cos(rot), 0], [0, 0, 1]])
+        affine = np.dot(affine, np.array([[1, -math.tan(shear), 0], [0, 1, 0], [0, 0, 1]]))
+        affine = np.dot(affine, np.diag([sx, sy, 1]))
+        affine = np.dot(_shift(width / 2 + tx, height / 2 + ty), np.dot(affine, _shift(-width / 2, -height / 2)))
+        matrix = np.dot(affine, matrix)
+    return matrix
+
+def warp(img, matrix, size, resize=ResizeMode.FIT, pad_color=(0,0,0), rng=None, mean=None):
+    '''Warps the image and fills the regions outside of the image according to the resize mode.
+
+    Args:
+        img (np.ndarray): Image array
+        matrix (np.ndarray): `3x3` affine matrix (see `resize_matrix` and `augment_matrix`)
+        size (tuple): Size of the output image as `(HEIGHT, WIDTH)`
+        resize (ResizeMode): Defines the fill of outside regions (edge, mean, color, random - black otherwise)
+        rng (RNG): Generator of the noise for `PAD_RANDOM` (default generator if None)
+        mean (list): Precomputed mean color for `PAD_MEAN` (e.g. from `stats`), otherwise computed from the image
+
+    Returns:
+        img (np.ndarray): Warped image
+    '''
+    # convert to pixel centers
+    center = np.dot(_shift(-0.5, -0.5), np.dot(matrix, _shift(0.5, 0.5)))
+    channels = img.shape[2] if len(img.shape) > 2 else 1
+
+    if resize == ResizeMode.PAD_EDGE:
+        return imwarp(img, center, size, "edge")
+    elif resize == ResizeMode.PAD_COLOR:
+        return imwarp(img, center, size, "constant", pad_color)
+    elif resize == ResizeMode.PAD_MEAN:
+        mean = np.mean(img, axis=(0, 1)) if mean is None else np.asarray(mean)
+        return imwarp(img, center, size, "constant", mean.reshape(-1))
+    elif resize == ResizeMode.PAD_RANDOM:
+        out = imwarp(img, center, size, "constant")
+        outside = imwarp(np.ones(img.shape[:2], dtype=np.uint8), center, size, "constant") == 0
+        out[outside] = noise((int(outside.sum()), channels), rng).astype(out.dtype).reshape(out[outside].shape)
+        return out
+    return imwarp(img, center, size, "constant")
+
+def warp_boxes(mdata, config, matrix, size):
+    '''Transforms all `box-array` elements of the metadata with the matrix (boxes are clipped to the output).
+
+    Returns:
+        mdata (list): Copy of the metadata with transformed boxes
+    '''
+    mdata = [x.copy() for x in mdata]
+    for item in config["boxes"]:
+        if item["type"] != "box-array":
+            continue
+        metas = [meta for meta in mdata if meta.get(item["name"], None) is not None]
+        if len(metas) == 0:
+            continue
+        bbs = boxes.from_item([meta[item["name"]] for meta in metas], item)
+        bbs = boxes.clip(boxes.warp(bbs, matrix), size)
+        bbs = np.round(boxes.to_item(bbs, item)).astype(int)
+        for meta, bb in zip(metas, bbs):
+            meta[item["name"]] = bb
+    return mdata
+
+def fused_augment(gen, config, size=None, resize=ResizeMode.FIT, pad_color=(0,0,0), pad_mode=PadMode.EDGE, params=None, keep=False, stages=None, rng=None):
+    '''Resizes and augments the dataset with a single warp per sample.
+
+    The generator should provide the original images (i.e. loaded with `size=None`). The resize matrix
+    is combined with the sampled augmentation, so each output is resampled only once from the original
+    image. Only geometric augmentations are applied (see `augment_matrix`), other augmentations can be
+    added by chaining `augment`.
+
+    Args:
+        gen (Generator): Beard-Style generator with original images
+        config (dict): Configuration of the dataset
+        size (int): Either single int of tuple of ints to indiciate the size of the image (see `resize`)
+        params (dict): Augmentation parameters (see `augment`), `per_img` defines the number of augmented images per sample
+        keep (bool): Defines if the (resized) original image should be preserved
+        stages (list): List of dataset-stages (dev, train, etc.) that should be augmented (None=Augment all)
+        rng (RNG): Generator of the augmentations and the noise (default generator if None, see `get_rng`)
+
+    Returns:
+        gen (Generator): Beard-Style generator with resized and augmented data
+    '''
+    rng = get_rng(rng)
+    per_img = params.get("per_img", 1) if params is not None else 1
+    for sample in gen:
+        img, gdata, mdata, btype = sample
+        matrix, out_size = resize_matrix(img.shape, size, resize, pad_mode)
+
+        # only resize the data that should not be augmented
+        augment_stage = params is not None and (stages is None or btype in stages)
+        if keep or not augment_stage:
+            yield derive_sample(sample, warp(img, matrix, out_size, resize, pad_color, rng), gdata, warp_boxes(mdata, config, matrix, out_size), btype)
+        if not augment_stage:
+            continue
+
+        # generate the augmented images
+        for _ in range(per_img):
+            aug = np.dot(augment_matrix(out_size, params, rng), matrix)
+            yield derive_sample(sample, warp(img, aug, out_size, resize, pad_color, rng), gdata, warp_boxes(mdata, config, aug, out_size), btype)
@@ -0,0 +1,137 @@
+'''Write-behind of files through background threads.'''
+
+import os
+import queue
+import threading
+
+
+class AsyncWriter(object):
+    '''Executes write jobs in background threads with a bounded queue.
+
+    `submit` only blocks if `queue_size` jobs are pending, so the memory stays bounded. The written data is synced
+    to disk in batches of `sync_every` jobs. The first error of a job is raised by the next call of `submit` or by
+    `close`, which also acts as barrier that waits for all pending jobs.
+
+    Args:
+        workers (int): Number of writer threads
+        queue_size (int): Maximal number of pending jobs
+        sync_every (int): Number of jobs between syncs to disk (0 to never sync explicitly)
+    '''
+    def __init__(self, workers=2, queue_size=64, sync_every=256):
+        self.sync_every = sync_every
+        self._queue = queue.Queue(max(1, queue_size))
+        self._lock = threading.Lock()
+        self._error = None
+        self._pending = []
+        self._closed = False
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        '''Processes the jobs of the queue until the stop signal (None) is received.'''
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            fct, args, paths = job
+            try:
+                # skip the remaining jobs after an error
+                if self._error is None:
+                    fct(*args)
+                    self._written(paths)
+            except Exception as err:
+                with self._lock:
+                    if self._error is None: self._error = err
+
+    def _written(self, paths):
+        '''Records the written files and syncs them in batches.'''
+        with self._lock:
+            self._pending += paths
+            if self.sync_every <= 0 or len(self._pending) < self.sync_every:
+                return
+            paths, self._pending = self._pending, []
+        _sync(paths)
+
+    def _raise(self):
+        '''Raises the error of a failed job.'''
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def failed(self):
+        '''Checks if a job failed (the remaining jobs are skipped).'''
+        return self._error is not None
+
+    def submit(self, fct, *args, paths=()):
+        '''Adds a write job (blocks if the queue is full).
+
+        Args:
+            fct (fct): Function that writes the data
+            paths (list): Files written by the job (used for the syncs)
+        '''
+        self._raise()
+        if self._closed:
+            raise RuntimeError("Writer is already closed!")
+        self._queue.put((fct, args, list(paths)))
+
+    def close(self):
+        '''Waits for all pending jobs, syncs the remaining files and raises the first error of the jobs.'''
+        if not self._closed:
+            self._closed = True
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            if self.sync_every > 0 and len(self._pending) > 0 and self._error is None:
+                _sync(self._pending)
+            self._pending = []
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class EncodeReport(object):
+    '''Thread-safe counter of the encode time and written bytes per encoding policy.'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.policies = {}
+
+    def add(self, name, seconds, size):
+        '''Adds a written image of the policy `name`.'''
+        with self._lock:
+            entry = self.policies.setdefault(name, {"images": 0, "bytes": 0, "seconds": 0.0})
+            entry["images"] += 1
+            entry["bytes"] += size
+            entry["seconds"] += seconds
+
+    def summary(self):
+        '''Generates a text summary of all policies.'''
+        lines = []
+        for name, entry in self.policies.items():
+            count = max(1, entry["images"])
+            lines.append("{}: {} images, {:.1f} MB ({:.1f} kB/image), {:.2f} s encoding ({:.2f} ms/image)".format(
+                name, entry["images"], entry["bytes"] / 1e6, entry["bytes"] / 1e3 / count, entry["seconds"], entry["seconds"] * 1e3 / count))
+        return '\n'.join(lines)
+
+def _sync(paths):
+    '''Flushes the given files and their folders to disk.'''
+    folders = set()
+    for path in paths:
+        _fsync(path)
+        folders.add(os.path.dirname(os.path.abspath(path)))
+    # note: the folder entries of new files are only durable after a sync of the folder (not supported on windows)
+    if os.name != 'nt':
+        for folder in folders:
+            _fsync(folder)
+
+def _fsync(path):
+    '''Flushes a single file (or folder) to disk.'''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
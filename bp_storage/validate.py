@@ -0,0 +1,202 @@
+'''Validation (and repair) of the label files of beard and kitti datasets.
+
+All label files are checked in a pool of worker processes against the config: number of fields, enum values,
+numeric types and the ordering and bounds of the boxes (against the image size from the image header, so no
+image is decoded). The result is a json-serializable report and an exclusion list next to the config, which
+is honoured by all loaders that list the dataset (see `beard._list_beard`).
+
+author: Felix Geilert
+'''
+
+import numpy as np
+import os, json
+import csv
+import multiprocessing
+from . import utils
+from . import beard
+from . import kitti
+
+
+# error types that can be repaired (all other rows are removed during the repair)
+REPAIRABLE = ["order", "bounds"]
+
+#--------------------------------------------------------------------------------------------------
+# CHECKS
+
+def _width(item):
+    '''Retrieves the number of fields of a config item.'''
+    return item["length"] if item["type"] in ("array", "box-array") else 1
+
+def _format(value, item):
+    '''Formats a repaired box coordinate.'''
+    return str(int(round(value))) if item["dtype"] == "int" else str(float(value))
+
+def _check_row(row, items, shape):
+    '''Checks a single row of a label file against the config items.
+
+    Args:
+        row (list): Fields of the row
+        items (list): Sorted config items (global or boxes)
+        shape (tuple): Size of the image (None to skip the box checks)
+
+    Returns:
+        errors (list): List of tuples `(type, message)`
+        row (list): Repaired row (only repairable errors are fixed)
+    '''
+    errors = []
+    row = list(row)
+    pos = 0
+    for item in items:
+        width = _width(item)
+        # check the number of fields
+        if pos >= len(row) and item.get("optional", False):
+            break
+        fields = row[pos:pos + width]
+        if len(fields) < width:
+            return errors + [("fields", "missing fields for ({}), expected {} but got {}".format(item["name"], pos + width, len(row)))], row
+
+        # check the values
+        try:
+            if item["type"] == "enum":
+                if item["dtype"] == "str" and fields[0] not in utils.classes.from_item(item):
+                    errors.append(("enum", "unkown value ({}) for ({})".format(fields[0], item["name"])))
+                elif item["dtype"] == "int" and not 0 <= int(fields[0]) < len(item["values"]):
+                    errors.append(("enum", "value ({}) out of range for ({})".format(fields[0], item["name"])))
+            else:
+                values = [utils.set_dtype(x, item["dtype"]) for x in fields]
+        except ValueError:
+            errors.append(("dtype", "fields ({}) of ({}) are not of type {}".format(' '.join(fields), item["name"], item["dtype"])))
+            pos += width
+            continue
+
+        # check ordering and bounds of the boxes
+        if item["type"] == "box-array" and shape is not None:
+            bbs = utils.boxes.from_item(np.array(values, dtype=np.float64), item)[0]
+            fixed = bbs
+            if bbs[2] < bbs[0] or bbs[3] < bbs[1]:
+                errors.append(("order", "box ({}) of ({}) has negative size".format(' '.join(fields), item["name"])))
+                fixed = np.array([min(bbs[0], bbs[2]), min(bbs[1], bbs[3]), max(bbs[0], bbs[2]), max(bbs[1], bbs[3])])
+            if np.any(fixed < 0) or fixed[2] > shape[0] or fixed[3] > shape[1]:
+                errors.append(("bounds", "box ({}) of ({}) is outside of the image ({}x{})".format(' '.join(fields), item["name"], shape[0], shape[1])))
+                fixed = utils.boxes.clip(fixed, shape)[0]
+            if fixed is not bbs:
+                row[pos:pos + width] = [_format(x, item) for x in utils.boxes.to_item(fixed, item)[0]]
+        pos += width
+
+    # check for additional fields
+    if pos < len(row):
+        errors.append(("fields", "too many fields, expected {} but got {}".format(pos, len(row))))
+    return errors, row
+
+def _validate_file(args):
+    '''Validates a single label file (executed inside the worker processes).
+
+    Returns:
+        errors (list): List of tuples `(line, type, message)`
+        repaired (bool): Defines if the file was repaired (all remaining errors were fixed)
+    '''
+    img_path, lbl_path, global_config, boxes_config, repair = args
+    if not os.path.exists(img_path) or not os.path.exists(lbl_path):
+        return [(0, "missing", "image or label file does not exist")], False
+    shape = utils.imsize(img_path)
+    with open(lbl_path, 'r') as f:
+        lines = f.read().split('\n')
+    # note: a trailing newline is no additional row
+    if len(lines) > 0 and lines[-1] == '':
+        lines = lines[:-1]
+
+    errors = []
+    out = []
+    fatal = False
+    for i, line in enumerate(lines):
+        row = next(csv.reader([line], delimiter=' '), [])
+        if i == 0 and len(global_config) > 0:
+            row_errors, fixed = _check_row(row, global_config, None)
+        else:
+            row_errors, fixed = _check_row(row, boxes_config, shape)
+        errors += [(i + 1, etype, msg) for etype, msg in row_errors]
+
+        # repair the row (if possible)
+        if all([etype in REPAIRABLE for etype, _ in row_errors]):
+            out.append(' '.join(fixed))
+        elif i == 0 and len(global_config) > 0:
+            fatal = True
+    if len(lines) == 0 and len(global_config) > 0:
+        errors.append((1, "fields", "missing global line"))
+        fatal = True
+
+    # write the repaired file
+    repaired = False
+    if repair and len(errors) > 0 and not fatal:
+        with open(lbl_path, 'w') as f:
+            f.write('\n'.join(out))
+        repaired = True
+    return errors, repaired
+
+#--------------------------------------------------------------------------------------------------
+# PUBLIC FUNCTIONS
+
+def validate(folder, fmt="beard", only=None, classes=None, repair=False, exclude=True, report=None, workers=None, json_name="*.json", debug=False):
+    '''Validates all label files of the dataset.
+
+    Args:
+        folder (str): Folder of the dataset
+        fmt (str): Format of the dataset (`beard` or `kitti`)
+        only (list): List of `DataType` to limit the validation
+        classes (list): Classes of kitti datasets (default: kitti classes)
+        repair (bool): Rewrites the label files: boxes are reordered and clipped to the image, other invalid rows are removed
+        exclude (bool): Writes the exclusion list of the dataset (files with errors that are not repaired)
+        report (str): Path to write the report as json file
+        workers (int): Number of worker processes (default: number of cpus)
+
+    Returns:
+        report (dict): json-serializable report with:
+            `files` - number of validated files
+            `invalid` - number of files with errors
+            `repaired` - number of repaired files
+            `counts` - number of errors for each error type
+            `errors` - list of errors as dicts of `image`, `label`, `line`, `type` and `message`
+            `excluded` - list of excluded image paths
+    '''
+    # safty: check if the folder exists
+    if not os.path.exists(folder):
+        raise IOError("Specified folder ({}) does not exist!".format(folder))
+    if fmt == "kitti":
+        config = kitti.create_config(classes if classes is not None else kitti.DEFAULT_CLASSES)
+    elif fmt == "beard":
+        config = beard._read_config(folder, json_name)
+    else:
+        raise ValueError("Validation only supports beard and kitti datasets, but got ({})".format(fmt))
+    global_config, boxes_config = beard._sort_config(config)
+    files = beard._list_beard(folder, only, debug, exclude=False)
+
+    # validate the files
+    tasks = [(img_path, lbl_path, global_config, boxes_config, repair) for img_path, lbl_path, _ in files]
+    workers = workers if workers is not None else multiprocessing.cpu_count()
+    if workers <= 1 or len(tasks) <= 1:
+        results = [_validate_file(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_validate_file, tasks, chunksize=64)
+
+    # generate the report
+    out = {"files": len(files), "invalid": 0, "repaired": 0, "counts": {}, "errors": [], "excluded": []}
+    for (img_path, lbl_path, _), (errors, repaired) in zip(files, results):
+        if len(errors) == 0:
+            continue
+        out["invalid"] += 1
+        out["repaired"] += int(repaired)
+        for line, etype, msg in errors:
+            out["counts"][etype] = out["counts"].get(etype, 0) + 1
+            out["errors"].append({"image": img_path, "label": lbl_path, "line": line, "type": etype, "message": msg})
+        if not repaired:
+            out["excluded"].append(img_path)
+
+    # write the results
+    if exclude:
+        utils.write_sidecar(os.path.join(folder, beard.EXCLUDE_FILE), {"files": [os.path.relpath(x, folder) for x in out["excluded"]]})
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump(out, f, indent=2)
+    if debug: print("Validated {} files: {} invalid, {} repaired, {} excluded".format(out["files"], out["invalid"], out["repaired"], len(out["excluded"])))
+    return out
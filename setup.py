@@ -41,5 +41,6 @@ setup(name='bp_storage',
       license='MIT License',
       packages=find_packages(),
       install_requires=[ 'numpy', 'imgaug' ],
+      entry_points={'console_scripts': ['bp-convert=bp_storage.convert:main']},
       include_package_data=True,
       zip_safe=False)